@@ -4,26 +4,57 @@ Expone endpoints para procesar imágenes de facturas y guardar datos validados.
 """
 import os
 import uuid
-import json
 import time
+import asyncio
+import anyio
 from datetime import datetime
-from typing import Optional
-from threading import Lock
-from fastapi import FastAPI, File, UploadFile, HTTPException, Depends, Header
+from typing import Dict, Optional
+from threading import Lock, Thread
+from fastapi import FastAPI, File, UploadFile, HTTPException, Depends, Header, Form, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from pydantic import BaseModel, Field
+from fastapi.concurrency import run_in_threadpool
+from pydantic import BaseModel, Field, ValidationError
 from dotenv import load_dotenv
 import requests
-from requests.adapters import HTTPAdapter
+from urllib3.exceptions import PoolError
 from urllib3.util.retry import Retry
 import logging
 import traceback
+from urllib.parse import urlsplit
 from google.cloud import bigquery
-from google.oauth2 import id_token
-from google.auth.transport import requests as google_requests
-from invoice_parser import parse_and_map_invoice, parse_structured_data
+import invoice_parser
+from invoice_parser import parse_structured_data
+from n8n_formats import detect_and_parse, StructuredDataError
+from invoice_record import InvoiceRecord
+import fast_json
+import metrics
+from fast_json import FastJSONResponse
+from response_encoding import CompressionMiddleware, conditional_json
+from job_store import JobStore, JobRunner, JobError, TERMINAL_STATES
+from ocr_endpoints import EndpointPool, HedgedCaller
+from http_pools import InstrumentedAdapter, PoolKeeper, PoolStats, pool_size_for
+from google_jwks import GoogleCertCache, InvalidIdToken, UnknownKeyId, looks_like_jwt
+from bigquery_sinks import create_sink
+from invoice_archive import InvoiceArchive, table_to_rows
+from invoice_export import ExportError, ExportFilters, FORMATS as EXPORT_FORMATS, create_read_source, export_invoices
+from invoice_index import InvoiceIndex, InvalidCursor
+from invoice_rollups import InvoiceRollups, classify_momento
+from ocr_recorder import OcrRecorder
+from ocr_engines import create_engines, EngineSaturated, OcrEngineError
+from image_dedup import NearDuplicateIndex, dhash, dedup_available
+from invoice_confidence import parse_thresholds, failing_fields
+from store_index import StoreIndex, load_store_file, bigquery_store_loader, normalize_store
+from sampling_profiler import ProfilerManager, ProfilingMiddleware
+import memory_stats
+from memory_stats import MemoryTracker
+from loop_watchdog import LoopWatchdog
+from upload_store import UploadStore, UploadError, parse_upload_checksum
+from session_tokens import (
+    SessionTokenSigner, SessionVersions, InvalidSessionToken, is_session_token, parse_signing_keys
+)
 
 # Cargar variables de entorno
 load_dotenv()
@@ -38,7 +69,11 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Invoice Processing API", version="1.0.0")
+# Backend de JSON: auto (orjson > msgspec > json estándar), orjson, msgspec o json
+JSON_BACKEND = fast_json.set_backend(os.getenv('JSON_BACKEND', 'auto'))
+logger.info(f"✅ Serialización JSON con backend: {JSON_BACKEND}")
+
+app = FastAPI(title="Invoice Processing API", version="1.0.0", default_response_class=FastJSONResponse)
 
 # Cargar lista de usuarios autorizados
 # Buscar authorized_users.json en el directorio del script o en el directorio actual
@@ -49,6 +84,8 @@ authorized_emails = set()
 superadmin_emails = set()
 # Lock para proteger escrituras concurrentes al archivo
 _users_file_lock = Lock()
+# Versión de sesión por usuario (incrementarla revoca sus tokens de sesión emitidos)
+session_versions = SessionVersions()
 
 def load_authorized_users():
     """Cargar lista de usuarios autorizados y superadmins desde el archivo JSON o variables de entorno"""
@@ -108,8 +145,8 @@ def load_authorized_users():
         # Luego, intentar cargar desde archivo (puede tener usuarios adicionales agregados desde el frontend)
         if os.path.exists(AUTHORIZED_USERS_FILE):
             try:
-                with open(AUTHORIZED_USERS_FILE, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
+                with open(AUTHORIZED_USERS_FILE, 'rb') as f:
+                    data = fast_json.loads(f.read())
                     # Agregar usuarios del archivo a los de variables de entorno (merge)
                     file_authorized = set(email.lower().strip() for email in data.get('authorized_emails', []))
                     file_superadmins = set(email.lower().strip() for email in data.get('superadmin_emails', []))
@@ -119,6 +156,8 @@ def load_authorized_users():
                     superadmin_emails.update(file_superadmins)
                     # Asegurar que superadmins también estén en authorized
                     authorized_emails.update(superadmin_emails)
+                    # Restaurar versiones de sesión (revocaciones hechas antes del reinicio)
+                    session_versions.update(data.get('session_versions', {}))
                     
                     logger.info(f"📂 Archivo encontrado. Merge: {len(file_authorized)} usuarios del archivo + usuarios de variables de entorno")
             except Exception as e:
@@ -145,10 +184,11 @@ def save_authorized_users():
             data = {
                 "superadmin_emails": list(superadmin_emails),
                 "authorized_emails": list(authorized_emails),
+                "session_versions": session_versions.as_dict(),
                 "note": "Los superadmins pueden gestionar usuarios. Los emails deben coincidir exactamente con los emails de Google."
             }
-            with open(AUTHORIZED_USERS_FILE, 'w', encoding='utf-8') as f:
-                json.dump(data, f, indent=2, ensure_ascii=False)
+            with open(AUTHORIZED_USERS_FILE, 'wb') as f:
+                f.write(fast_json.dumps(data, indent=True))
             logger.info(f"✅ Usuarios guardados exitosamente")
             return True
         except Exception as e:
@@ -162,29 +202,144 @@ def is_superadmin(email: str) -> bool:
 # Cargar usuarios autorizados al iniciar
 load_authorized_users()
 
+# Configuración de llamadas a la API de Google (verificación de tokens)
+GOOGLE_USERINFO_URL = 'https://www.googleapis.com/oauth2/v2/userinfo'
+GOOGLE_CONNECT_TIMEOUT = float(os.getenv('GOOGLE_CONNECT_TIMEOUT', '3'))  # Timeout de conexión (segundos)
+GOOGLE_READ_TIMEOUT = float(os.getenv('GOOGLE_READ_TIMEOUT', '5'))  # Timeout de lectura (segundos)
+GOOGLE_MAX_RETRIES = int(os.getenv('GOOGLE_MAX_RETRIES', '2'))  # Presupuesto pequeño de reintentos
+GOOGLE_POOL_WARM = int(os.getenv('GOOGLE_POOL_WARM', '2'))  # Conexiones a googleapis.com abiertas y listas
+
+# Pools de conexiones HTTP (n8n y Google): el tamaño se deriva de cuántos hilos pueden llamar a la
+# vez; las conexiones ociosas se precalientan al arrancar y se reabren antes de que el servidor las cierre
+HTTP_THREADPOOL_SIZE = int(os.getenv('HTTP_THREADPOOL_SIZE', '40'))  # Hilos de run_in_threadpool (40 = default de anyio)
+HTTP_POOL_REFRESH_INTERVAL = float(os.getenv('HTTP_POOL_REFRESH_INTERVAL', '30'))  # Segundos entre refrescos
+HTTP_POOL_MAX_IDLE = float(os.getenv('HTTP_POOL_MAX_IDLE', '50'))  # Ociosas más viejas se reabren (< idle timeout del servidor)
+http_pool_keeper = PoolKeeper(HTTP_POOL_REFRESH_INTERVAL, HTTP_POOL_MAX_IDLE)
+google_pool_stats = PoolStats('google', acquire_timeout=GOOGLE_CONNECT_TIMEOUT)
+
+def create_google_session():
+    """Crear sesión HTTP con keep-alive para las llamadas a googleapis.com (reutiliza conexiones TLS)"""
+    session = requests.Session()
+    
+    # Reintentos solo ante errores transitorios; un 401 (token inválido) no se reintenta
+    retry_strategy = Retry(
+        total=GOOGLE_MAX_RETRIES,
+        backoff_factor=0.2,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["GET"]
+    )
+    
+    adapter = InstrumentedAdapter(
+        google_pool_stats,
+        max_retries=retry_strategy,
+        pool_connections=2,  # Solo se habla con googleapis.com
+        pool_maxsize=HTTP_THREADPOOL_SIZE + 1,  # Un request por hilo del threadpool + el refresco de certificados
+        pool_block=True  # Esperar una conexión libre en vez de abrir una que después se descarta
+    )
+    
+    session.mount("https://", adapter)
+    
+    return session
+
+# Sesión global para verificar tokens sin abrir una conexión TCP+TLS por request
+google_session = create_google_session()
+http_pool_keeper.add(google_session, GOOGLE_USERINFO_URL, GOOGLE_POOL_WARM)
+
+def fetch_google_userinfo(token: str) -> requests.Response:
+    """Consultar el endpoint userinfo de Google con el access token del usuario"""
+    return google_session.get(
+        GOOGLE_USERINFO_URL,
+        headers={'Authorization': f'Bearer {token}'},
+        timeout=(GOOGLE_CONNECT_TIMEOUT, GOOGLE_READ_TIMEOUT)
+    )
+
+# Modo de autenticación:
+#   'auto'     -> ID tokens (JWT) se verifican localmente; access tokens vía userinfo
+#   'jwt'      -> solo se aceptan ID tokens verificados localmente
+#   'userinfo' -> siempre se consulta el endpoint userinfo de Google
+AUTH_MODE = os.getenv('AUTH_MODE', 'auto').lower()
+# Client ID de OAuth (audiencia 'aud' esperada en los ID tokens)
+GOOGLE_CLIENT_ID = os.getenv('GOOGLE_CLIENT_ID', '')
+GOOGLE_CLOCK_SKEW = int(os.getenv('GOOGLE_CLOCK_SKEW', '30'))  # Tolerancia de reloj para exp/iat (segundos)
+
+# Caché de certificados de Google para validar ID tokens sin llamadas de red
+google_certs = GoogleCertCache(google_session)
+
+def use_local_jwt(token: str) -> bool:
+    """Decidir si el token se verifica localmente como ID token de Google"""
+    if AUTH_MODE == 'userinfo' or not GOOGLE_CLIENT_ID:
+        return False
+    return AUTH_MODE == 'jwt' or looks_like_jwt(token)
+
+async def get_google_email(token: str) -> str:
+    """
+    Obtener el email verificado de un token de Google.
+    Los ID tokens se validan localmente contra los certificados cacheados (solo CPU);
+    los access tokens se validan con el endpoint userinfo.
+    """
+    if use_local_jwt(token):
+        try:
+            try:
+                claims = google_certs.verify(token, GOOGLE_CLIENT_ID, GOOGLE_CLOCK_SKEW)
+            except UnknownKeyId:
+                # Posible rotación de claves: refrescar la caché (con límite de frecuencia) y reintentar
+                await run_in_threadpool(google_certs.refresh)
+                claims = google_certs.verify(token, GOOGLE_CLIENT_ID, GOOGLE_CLOCK_SKEW)
+        except InvalidIdToken as e:
+            logger.error(f"❌ ID token inválido: {e}")
+            raise HTTPException(status_code=401, detail="Token inválido o expirado")
+        return str(claims.get('email', '')).lower().strip()
+    
+    if AUTH_MODE == 'jwt':
+        raise HTTPException(status_code=401, detail="Se requiere un ID token de Google")
+    
+    # Verificar el token con Google usando la API
+    user_info_response = await run_in_threadpool(fetch_google_userinfo, token)
+    
+    if user_info_response.status_code != 200:
+        logger.error(f"❌ Token inválido según Google API: {user_info_response.status_code}")
+        raise HTTPException(status_code=401, detail="Token inválido o expirado")
+    
+    google_user_data = user_info_response.json()
+    return google_user_data.get('email', '').lower().strip()
+
+# Tokens de sesión del backend (se emiten en /api/verify-user tras verificar con Google)
+SESSION_TOKEN_TTL = int(os.getenv('SESSION_TOKEN_TTL', '900'))  # Duración del token de sesión (15 min)
+# Claves HMAC 'kid:secreto' separadas por coma; la primera firma, las demás solo verifican (rotación)
+session_signer = SessionTokenSigner(parse_signing_keys(os.getenv('SESSION_SIGNING_KEYS', '')), SESSION_TOKEN_TTL)
+
+def issue_session_token(email: str) -> dict:
+    """Emitir un token de sesión para un usuario autorizado"""
+    role = "superadmin" if is_superadmin(email) else "user"
+    return {
+        "session_token": session_signer.issue(email, role, session_versions.get(email)),
+        "session_expires_in": SESSION_TOKEN_TTL
+    }
+
+def verify_session_token(token: str) -> str:
+    """Validar localmente un token de sesión y retornar el email (sin llamadas de red)"""
+    try:
+        claims = session_signer.verify(token, session_versions.get)
+    except InvalidSessionToken as e:
+        logger.info(f"Token de sesión rechazado: {e}")
+        raise HTTPException(status_code=401, detail="Token de sesión inválido o expirado")
+    return claims['sub']
+
 # Security
 security = HTTPBearer(auto_error=False)
 
 async def verify_token(credentials: Optional[HTTPAuthorizationCredentials] = Depends(security)):
-    """Verificar token de Google OAuth usando la API de Google"""
+    """Verificar token de sesión del backend o token de Google OAuth (ID token local o access token vía API)"""
     if not credentials:
         raise HTTPException(status_code=401, detail="Token de autenticación requerido")
     
     token = credentials.credentials
     try:
-        # Verificar el token con Google usando la API
-        user_info_response = requests.get(
-            'https://www.googleapis.com/oauth2/v2/userinfo',
-            headers={'Authorization': f'Bearer {token}'},
-            timeout=10
-        )
-        
-        if user_info_response.status_code != 200:
-            logger.error(f"❌ Token inválido según Google API: {user_info_response.status_code}")
-            raise HTTPException(status_code=401, detail="Token inválido o expirado")
-        
-        google_user_data = user_info_response.json()
-        email = google_user_data.get('email', '').lower().strip()
+        if is_session_token(token):
+            # Token de sesión propio: validación local, sin llamar a Google
+            email = verify_session_token(token)
+        else:
+            email = await get_google_email(token)
         
         if not email:
             raise HTTPException(status_code=401, detail="Email no encontrado en el token")
@@ -197,6 +352,9 @@ async def verify_token(credentials: Optional[HTTPAuthorizationCredentials] = Dep
         return email
     except HTTPException:
         raise
+    except PoolError as e:
+        logger.error(f"❌ Pool de conexiones a Google saturado: {e}")
+        raise HTTPException(status_code=503, detail="Pool de conexiones a Google saturado, reintentar en unos segundos")
     except requests.exceptions.RequestException as e:
         logger.error(f"❌ Error al verificar token con Google API: {e}")
         raise HTTPException(status_code=401, detail="Error al verificar token con Google")
@@ -228,8 +386,62 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "Upload-Offset", "Upload-Length", "Location", "X-Profile-File"],
 )
 
+# Compresión de respuestas (brotli si está instalado, si no gzip). Los streams SSE nunca se comprimen.
+COMPRESSION_ENABLED = os.getenv('COMPRESSION_ENABLED', 'true').lower() == 'true'
+COMPRESSION_MIN_SIZE = int(os.getenv('COMPRESSION_MIN_SIZE', '1024'))  # Bytes; cuerpos más chicos van sin comprimir
+COMPRESSION_GZIP_LEVEL = int(os.getenv('COMPRESSION_GZIP_LEVEL', '6'))
+COMPRESSION_BROTLI_QUALITY = int(os.getenv('COMPRESSION_BROTLI_QUALITY', '4'))  # 0-11; 4 es rápido para respuestas dinámicas
+COMPRESSION_BROTLI_ENABLED = os.getenv('COMPRESSION_BROTLI_ENABLED', 'true').lower() == 'true'
+
+if COMPRESSION_ENABLED:
+    app.add_middleware(
+        CompressionMiddleware,
+        minimum_size=COMPRESSION_MIN_SIZE,
+        gzip_level=COMPRESSION_GZIP_LEVEL,
+        brotli_quality=COMPRESSION_BROTLI_QUALITY,
+        brotli_enabled=COMPRESSION_BROTLI_ENABLED,
+    )
+
+# Profiler por muestreo (POST /api/admin/profile y perfil por request con PROFILE_REQUEST_HEADER)
+PROFILE_DIR = os.getenv('PROFILE_DIR', os.path.join(_script_dir, 'data', 'profiles'))
+PROFILE_INTERVAL_MS = float(os.getenv('PROFILE_INTERVAL_MS', '10'))  # Intervalo de muestreo de las pilas
+PROFILE_MAX_SECONDS = float(os.getenv('PROFILE_MAX_SECONDS', '60'))  # Duración máxima de un perfil del proceso
+PROFILE_MAX_FILES = int(os.getenv('PROFILE_MAX_FILES', '50'))  # Perfiles que se conservan en PROFILE_DIR
+PROFILE_REQUEST_HEADER = os.getenv('PROFILE_REQUEST_HEADER', 'X-Profile')
+PROFILE_REQUEST_TOKEN = os.getenv('PROFILE_REQUEST_TOKEN', '')  # Valor secreto del header; vacío = deshabilitado
+PROFILE_REQUEST_SAMPLE_RATE = float(os.getenv('PROFILE_REQUEST_SAMPLE_RATE', '0.1'))  # Fracción de requests con header que se perfilan
+
+profiler = ProfilerManager(PROFILE_DIR, interval=PROFILE_INTERVAL_MS / 1000, max_files=PROFILE_MAX_FILES)
+
+# Introspección de memoria (GET /api/admin/memory). tracemalloc agrega costo a cada asignación:
+# se activa bajo demanda salvo que MEMORY_TRACEMALLOC_ON_START lo encienda desde el arranque
+MEMORY_TRACEMALLOC_ON_START = os.getenv('MEMORY_TRACEMALLOC_ON_START', 'false').lower() == 'true'
+MEMORY_TRACEMALLOC_FRAMES = int(os.getenv('MEMORY_TRACEMALLOC_FRAMES', '1'))  # Frames guardados por asignación
+MEMORY_MAX_SNAPSHOTS = int(os.getenv('MEMORY_MAX_SNAPSHOTS', '5'))  # Snapshots conservados para comparar
+
+memory_tracker = MemoryTracker(frames=MEMORY_TRACEMALLOC_FRAMES, max_snapshots=MEMORY_MAX_SNAPSHOTS)
+if MEMORY_TRACEMALLOC_ON_START:
+    memory_tracker.start()
+
+# Watchdog del event loop: publica el lag en /api/admin/metrics y registra la pila de las
+# llamadas que bloquean el loop más de LOOP_BLOCK_THRESHOLD (una vez por sitio de llamada)
+LOOP_WATCHDOG_ENABLED = os.getenv('LOOP_WATCHDOG_ENABLED', 'true').lower() == 'true'
+LOOP_WATCHDOG_INTERVAL = float(os.getenv('LOOP_WATCHDOG_INTERVAL', '0.1'))  # Segundos entre latidos
+LOOP_BLOCK_THRESHOLD = float(os.getenv('LOOP_BLOCK_THRESHOLD', '0.2'))  # Segundos sin latir para capturar la pila
+
+loop_watchdog = LoopWatchdog(LOOP_WATCHDOG_INTERVAL, LOOP_BLOCK_THRESHOLD, project_root=_script_dir) if LOOP_WATCHDOG_ENABLED else None
+if PROFILE_REQUEST_TOKEN:
+    app.add_middleware(
+        ProfilingMiddleware,
+        manager=profiler,
+        token=PROFILE_REQUEST_TOKEN,
+        header=PROFILE_REQUEST_HEADER,
+        sample_rate=PROFILE_REQUEST_SAMPLE_RATE,
+    )
+
 # Configuración
 N8N_WEBHOOK_URL = os.getenv('N8N_WEBHOOK_URL')
 BIGQUERY_PROJECT_ID = os.getenv('BIGQUERY_PROJECT_ID')
@@ -254,12 +466,13 @@ def create_n8n_session():
         allowed_methods=["POST"]  # Solo reintentar POST
     )
     
-    # Configurar adapter con connection pooling
-    adapter = HTTPAdapter(
+    # Configurar adapter con connection pooling (un pool por host de n8n)
+    adapter = InstrumentedAdapter(
+        n8n_pool_stats,
         max_retries=retry_strategy,
-        pool_connections=10,  # Número de pools de conexión
-        pool_maxsize=20,  # Máximo de conexiones por pool
-        pool_block=False  # No bloquear si el pool está lleno
+        pool_connections=max(1, len(N8N_WEBHOOK_URLS)),  # Número de pools de conexión
+        pool_maxsize=N8N_POOL_MAXSIZE,  # Máximo de conexiones por pool
+        pool_block=True  # Esperar una conexión libre (hasta N8N_POOL_TIMEOUT) en vez de descartar
     )
     
     session.mount("http://", adapter)
@@ -267,8 +480,89 @@ def create_n8n_session():
     
     return session
 
+# Endpoints de n8n: N8N_WEBHOOK_URLS (lista separada por comas) o N8N_WEBHOOK_URL (uno solo)
+N8N_WEBHOOK_URLS = [
+    url.strip() for url in os.getenv('N8N_WEBHOOK_URLS', N8N_WEBHOOK_URL or '').split(',') if url.strip()
+]
+N8N_LB_STRATEGY = os.getenv('N8N_LB_STRATEGY', 'least_outstanding')  # 'least_outstanding' o 'ewma'
+N8N_HEDGING = os.getenv('N8N_HEDGING', 'false').lower() == 'true'  # Duplicar requests lentos
+N8N_HEDGE_MIN_DELAY = float(os.getenv('N8N_HEDGE_MIN_DELAY', '2'))  # Espera mínima antes de duplicar
+N8N_HEDGE_DEFAULT_DELAY = float(os.getenv('N8N_HEDGE_DEFAULT_DELAY', '15'))  # Espera si aún no hay p95
+N8N_ENDPOINT_FAILURE_THRESHOLD = int(os.getenv('N8N_ENDPOINT_FAILURE_THRESHOLD', '3'))
+N8N_ENDPOINT_COOLDOWN = float(os.getenv('N8N_ENDPOINT_COOLDOWN', '30'))
+
+n8n_endpoints = EndpointPool(
+    N8N_WEBHOOK_URLS,
+    strategy=N8N_LB_STRATEGY,
+    failure_threshold=N8N_ENDPOINT_FAILURE_THRESHOLD,
+    cooldown_seconds=N8N_ENDPOINT_COOLDOWN,
+)
+
+# Configuración de jobs asíncronos (POST /api/jobs)
+JOBS_DIR = os.getenv('JOBS_DIR', os.path.join(_script_dir, 'data', 'jobs'))
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '4'))  # Hilos que procesan jobs en paralelo
+JOB_TTL_SECONDS = int(os.getenv('JOB_TTL_SECONDS', '86400'))  # Tiempo de vida de un job (24h)
+JOB_GC_INTERVAL = int(os.getenv('JOB_GC_INTERVAL', '300'))  # Cada cuánto se eliminan jobs expirados
+JOB_LONG_POLL_MAX = int(os.getenv('JOB_LONG_POLL_MAX', '30'))  # Espera máxima de long-poll/SSE por request
+JOB_POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', '0.5'))  # Intervalo interno de consulta del estado
+# Prefijos de URL permitidos para callbacks de finalización (vacío = callbacks deshabilitados)
+JOB_CALLBACK_ALLOWED_PREFIXES = [
+    prefix.strip() for prefix in os.getenv('JOB_CALLBACK_ALLOWED_PREFIXES', '').split(',') if prefix.strip()
+]
+
+
+def _url_origin_and_path(url: str):
+    """(esquema, host, puerto, path) de una URL con el puerto por defecto explícito; None si es inválida"""
+    try:
+        parts = urlsplit(url)
+        port = parts.port or {'http': 80, 'https': 443}.get(parts.scheme.lower())
+    except ValueError:
+        return None
+    if not parts.scheme or not parts.hostname:
+        return None
+    if any(segment in ('.', '..') for segment in parts.path.split('/')):
+        return None  # El servidor resolvería ../ fuera del path permitido
+    return parts.scheme.lower(), parts.hostname.lower(), port, parts.path or '/'
+
+
+_JOB_CALLBACK_ALLOWED = [origin for origin in map(_url_origin_and_path, JOB_CALLBACK_ALLOWED_PREFIXES) if origin]
+
+
+def callback_url_allowed(url: str) -> bool:
+    """
+    Esquema, host y puerto deben coincidir exactamente con un prefijo permitido y el path
+    empezar con el del prefijo (un startswith sobre la URL aceptaría hooks.example.com.evil.net).
+    """
+    target = _url_origin_and_path(url)
+    if target is None:
+        return False
+    scheme, host, port, path = target
+    for allowed_scheme, allowed_host, allowed_port, allowed_path in _JOB_CALLBACK_ALLOWED:
+        if (scheme, host, port) != (allowed_scheme, allowed_host, allowed_port):
+            continue
+        # El path coincide completo o por segmentos: /hooks permite /hooks/x pero no /hooks-x
+        if path == allowed_path or path.startswith(allowed_path.rstrip('/') + '/'):
+            return True
+    return False
+
+# Pool de conexiones a n8n: una conexión por hilo que puede llamar a la vez (workers de jobs y
+# requests en el threadpool); con hedging cada llamada puede ocupar dos
+N8N_POOL_MAXSIZE = int(os.getenv('N8N_POOL_MAXSIZE', '0')) or pool_size_for(JOB_WORKERS + HTTP_THREADPOOL_SIZE, N8N_HEDGING)
+N8N_POOL_TIMEOUT = float(os.getenv('N8N_POOL_TIMEOUT', '10'))  # Espera máxima por una conexión libre
+N8N_POOL_WARM = int(os.getenv('N8N_POOL_WARM', str(JOB_WORKERS)))  # Conexiones abiertas y listas por endpoint
+n8n_pool_stats = PoolStats('n8n', acquire_timeout=N8N_POOL_TIMEOUT)
+
 # Crear sesión global para reutilizar conexiones
 n8n_session = create_n8n_session()
+for url in N8N_WEBHOOK_URLS:
+    http_pool_keeper.add(n8n_session, url, N8N_POOL_WARM)
+n8n_caller = HedgedCaller(
+    n8n_endpoints,
+    hedging=N8N_HEDGING,
+    hedge_min_delay=N8N_HEDGE_MIN_DELAY,
+    hedge_default_delay=N8N_HEDGE_DEFAULT_DELAY,
+    max_workers=N8N_POOL_MAXSIZE,  # Con hedging todas las llamadas pasan por este executor
+)
 
 # Logging de configuración al inicio
 logger.info("=" * 60)
@@ -307,6 +601,94 @@ if BIGQUERY_PROJECT_ID:
 else:
     logger.warning("⚠️ BIGQUERY_PROJECT_ID no está configurada en .env")
 
+# Destino de las filas guardadas: 'streaming' (insert_rows_json), 'storage_write' (Storage Write API)
+# o 'memory' (fake local para desarrollo y pruebas, no requiere BigQuery)
+BIGQUERY_SINK = os.getenv('BIGQUERY_SINK', 'streaming')
+BQ_WRITE_BATCH_SIZE = int(os.getenv('BQ_WRITE_BATCH_SIZE', '50'))  # Filas máximas por append
+BQ_WRITE_LINGER_MS = int(os.getenv('BQ_WRITE_LINGER_MS', '50'))  # Espera para agrupar filas en un append
+invoice_sink = None
+
+if BIGQUERY_SINK == 'memory' or (bigquery_client and BIGQUERY_DATASET_ID and BIGQUERY_TABLE_ID):
+    try:
+        invoice_sink = create_sink(
+            BIGQUERY_SINK, bigquery_client, BIGQUERY_PROJECT_ID, BIGQUERY_DATASET_ID, BIGQUERY_TABLE_ID,
+            batch_size=BQ_WRITE_BATCH_SIZE, linger_seconds=BQ_WRITE_LINGER_MS / 1000
+        )
+        logger.info(f"✅ Destino de BigQuery: {invoice_sink.name}")
+    except Exception as e:
+        logger.error(f"❌ Error al inicializar destino '{BIGQUERY_SINK}': {e}. Usando streaming insert.")
+        invoice_sink = create_sink('streaming', bigquery_client, BIGQUERY_PROJECT_ID, BIGQUERY_DATASET_ID, BIGQUERY_TABLE_ID)
+
+# Archivo local Parquet de las filas guardadas (consultas sin BigQuery y backfill)
+INVOICE_ARCHIVE_ENABLED = os.getenv('INVOICE_ARCHIVE_ENABLED', 'true').lower() == 'true'
+INVOICE_ARCHIVE_DIR = os.getenv('INVOICE_ARCHIVE_DIR', os.path.join(_script_dir, 'data', 'archive'))
+INVOICE_ARCHIVE_FLUSH_INTERVAL = float(os.getenv('INVOICE_ARCHIVE_FLUSH_INTERVAL', '60'))  # Segundos entre volcados a Parquet
+INVOICE_ARCHIVE_COMPACT_MIN_FILES = int(os.getenv('INVOICE_ARCHIVE_COMPACT_MIN_FILES', '8'))  # Archivos por partición antes de compactar
+invoice_archive = None
+
+if INVOICE_ARCHIVE_ENABLED:
+    try:
+        invoice_archive = InvoiceArchive(
+            INVOICE_ARCHIVE_DIR,
+            flush_interval=INVOICE_ARCHIVE_FLUSH_INTERVAL,
+            compact_min_files=INVOICE_ARCHIVE_COMPACT_MIN_FILES,
+        )
+        logger.info(f"✅ Archivo local de facturas en {INVOICE_ARCHIVE_DIR}")
+    except Exception as e:
+        logger.warning(f"⚠️ Archivo local de facturas deshabilitado: {e}")
+
+# Exportación CSV/Parquet (GET /api/export): 'storage_read' (BigQuery Storage Read API) o
+# 'memory' (fake local que lee las filas del sink en memoria)
+EXPORT_SOURCE = os.getenv('EXPORT_SOURCE', 'memory' if BIGQUERY_SINK == 'memory' else 'storage_read')
+EXPORT_MAX_STREAMS = int(os.getenv('EXPORT_MAX_STREAMS', '4'))  # Streams de lectura en paralelo
+EXPORT_PREFETCH_BATCHES = int(os.getenv('EXPORT_PREFETCH_BATCHES', '8'))  # Batches en cola (acota la memoria)
+export_source = None
+
+if EXPORT_SOURCE == 'memory' or (BIGQUERY_PROJECT_ID and BIGQUERY_DATASET_ID and BIGQUERY_TABLE_ID):
+    try:
+        export_source = create_read_source(
+            EXPORT_SOURCE, BIGQUERY_PROJECT_ID, BIGQUERY_DATASET_ID, BIGQUERY_TABLE_ID,
+            load_rows=lambda: list(getattr(invoice_sink, 'rows', [])),
+        )
+        logger.info(f"✅ Fuente de exportación: {export_source.name}")
+    except Exception as e:
+        logger.warning(f"⚠️ Exportación deshabilitada: {e}")
+
+# Índice en memoria de facturas recientes para GET /api/invoices
+INVOICE_INDEX_DAYS = int(os.getenv('INVOICE_INDEX_DAYS', '30'))  # Ventana de facturas indexadas (por fecha)
+INVOICE_INDEX_MAX_ROWS = int(os.getenv('INVOICE_INDEX_MAX_ROWS', '200000'))  # Tope de filas en memoria
+invoice_index = InvoiceIndex(retention_days=INVOICE_INDEX_DAYS, max_rows=INVOICE_INDEX_MAX_ROWS)
+
+# Agregados por tienda, día y tipo de momento para GET /api/stats
+INVOICE_ROLLUPS_PATH = os.getenv('INVOICE_ROLLUPS_PATH', os.path.join(_script_dir, 'data', 'rollups.json'))
+INVOICE_ROLLUPS_FLUSH_INTERVAL = float(os.getenv('INVOICE_ROLLUPS_FLUSH_INTERVAL', '30'))  # Segundos entre persistencias
+invoice_rollups = InvoiceRollups(INVOICE_ROLLUPS_PATH, flush_interval=INVOICE_ROLLUPS_FLUSH_INTERVAL)
+
+try:
+    if not invoice_rollups.load() and invoice_archive:
+        # Primera ejecución: reconstruir desde el archivo local (sin escanear BigQuery)
+        groups = invoice_rollups.rebuild(table_to_rows(invoice_archive.scan()))
+        logger.info(f"✅ Agregados de facturas reconstruidos desde el archivo local: {groups} grupos")
+except Exception as e:
+    logger.error(f"❌ Error al cargar agregados de facturas: {e}")
+
+
+def warm_invoice_index():
+    """Precargar el índice desde BigQuery (o desde el archivo local si BigQuery no está configurado)"""
+    try:
+        start_time = time.time()
+        if bigquery_client and BIGQUERY_DATASET_ID and BIGQUERY_TABLE_ID:
+            table_id = f"{BIGQUERY_PROJECT_ID}.{BIGQUERY_DATASET_ID}.{BIGQUERY_TABLE_ID}"
+            count = invoice_index.warm_from_bigquery(bigquery_client, table_id)
+        elif invoice_archive:
+            rows = table_to_rows(invoice_archive.scan(desde=invoice_index.cutoff()))
+            count = invoice_index.load(rows)
+        else:
+            count = invoice_index.load([])
+        logger.info(f"✅ Índice de facturas precargado: {count} filas en {time.time() - start_time:.1f}s")
+    except Exception as e:
+        logger.error(f"❌ Error al precargar índice de facturas: {e}")
+
 
 # Modelos Pydantic para validación
 class MappedInvoiceData(BaseModel):
@@ -329,6 +711,8 @@ class MappedInvoiceData(BaseModel):
     momento: Optional[str] = None
     a_c: Optional[str] = None
     raw_extracted_text: Optional[str] = None  # Texto crudo extraído por OCR
+    confidence: Optional[Dict[str, float]] = None  # Confianza por campo (0.0 a 1.0)
+    incomplete: bool = False  # El parseo se cortó por tiempo y faltan campos
 
 
 class ValidatedInvoiceData(BaseModel):
@@ -388,19 +772,8 @@ async def verify_user(request: dict):
         logger.info(f"Verificando usuario: {email}")
         logger.info(f"Emails autorizados: {list(authorized_emails)}")
         
-        # Verificar que el token es válido haciendo una petición a la API de Google
-        user_info_response = requests.get(
-            'https://www.googleapis.com/oauth2/v2/userinfo',
-            headers={'Authorization': f'Bearer {token}'},
-            timeout=10
-        )
-        
-        if user_info_response.status_code != 200:
-            logger.error(f"❌ Token inválido según Google API: {user_info_response.status_code}")
-            raise HTTPException(status_code=401, detail="Token inválido o expirado")
-        
-        google_user_data = user_info_response.json()
-        verified_email = google_user_data.get('email', '').lower().strip()
+        # Verificar que el token es válido (localmente si es un ID token, o con la API de Google)
+        verified_email = await get_google_email(token)
         received_email = email.lower().strip()
         
         logger.info(f"Email verificado desde Google API: {verified_email}")
@@ -420,13 +793,20 @@ async def verify_user(request: dict):
         
         is_superadmin_user = is_superadmin(verified_email)
         
-        return {
+        result = {
             "authorized": is_authorized,
             "is_superadmin": is_superadmin_user,
             "email": verified_email
         }
+        if is_authorized:
+            # Token de sesión para que las siguientes llamadas no vuelvan a consultar a Google
+            result.update(issue_session_token(verified_email))
+        return result
     except HTTPException:
         raise
+    except PoolError as e:
+        logger.error(f"❌ Pool de conexiones a Google saturado: {e}")
+        raise HTTPException(status_code=503, detail="Pool de conexiones a Google saturado, reintentar en unos segundos")
     except requests.exceptions.RequestException as e:
         logger.error(f"❌ Error al verificar token con Google API: {e}")
         raise HTTPException(status_code=401, detail="Error al verificar token con Google")
@@ -449,22 +829,17 @@ async def verify_token_endpoint(request: dict):
         }
     
     try:
-        # Verificar el token con Google usando la API
-        user_info_response = requests.get(
-            'https://www.googleapis.com/oauth2/v2/userinfo',
-            headers={'Authorization': f'Bearer {token}'},
-            timeout=10
-        )
-        
-        if user_info_response.status_code != 200:
+        try:
+            if is_session_token(token):
+                email = verify_session_token(token)
+            else:
+                email = await get_google_email(token)
+        except HTTPException:
             return {
                 "valid": False,
                 "authorized": False
             }
         
-        google_user_data = user_info_response.json()
-        email = google_user_data.get('email', '').lower().strip()
-        
         if not email:
             return {
                 "valid": False,
@@ -474,12 +849,20 @@ async def verify_token_endpoint(request: dict):
         is_authorized = email in authorized_emails
         is_superadmin_user = is_superadmin(email)
         
-        return {
+        result = {
             "valid": True,
             "authorized": is_authorized,
             "is_superadmin": is_superadmin_user,
             "email": email
         }
+        # Renovar la sesión solo con un token de Google: un token de sesión no puede extenderse a sí mismo
+        if is_authorized and not is_session_token(token):
+            result.update(issue_session_token(email))
+        return result
+    except PoolError as e:
+        # Saturación local, no un token inválido: no cerrar la sesión del usuario
+        logger.error(f"❌ Pool de conexiones a Google saturado: {e}")
+        raise HTTPException(status_code=503, detail="Pool de conexiones a Google saturado, reintentar en unos segundos")
     except requests.exceptions.RequestException:
         return {
             "valid": False,
@@ -501,9 +884,8 @@ async def test_parse(data: dict):
     try:
         logger.info(f"Recibidos datos de prueba: {data}")
         if isinstance(data, list):
-            mapped_data_dict = parse_structured_data(data)
-            mapped_data = MappedInvoiceData(**mapped_data_dict)
-            return {"success": True, "data": mapped_data.model_dump()}
+            mapped_data = parse_structured_data(data)
+            return {"success": True, "data": mapped_data.to_dict()}
         else:
             return {"success": False, "error": "Se espera un array de objetos"}
     except Exception as e:
@@ -511,17 +893,350 @@ async def test_parse(data: dict):
         return {"success": False, "error": str(e), "traceback": traceback.format_exc()}
 
 
+def call_n8n_webhook(filename: str, file_content: bytes, content_type: str):
+    """
+    Enviar la imagen al webhook de n8n y retornar el JSON decodificado.
+    Función bloqueante compartida por el endpoint síncrono y los jobs en segundo plano.
+    """
+    # Llamar al servicio n8n para extraer texto
+    if not n8n_endpoints:
+        raise HTTPException(
+            status_code=500,
+            detail="URL de webhook n8n no configurada"
+        )
+    
+    files = {'invoice_image': (filename, file_content, content_type)}
+    
+    def send(url: str):
+        # Usar sesión con connection pooling y retry logic
+        return n8n_session.post(
+            url, 
+            files=files, 
+            timeout=N8N_TIMEOUT,
+            stream=False  # No usar streaming para archivos pequeños
+        )
+    
+    start_time = time.time()
+    try:
+        # Balanceo entre endpoints (y hedging si está habilitado)
+        response = n8n_caller.call(send)
+        elapsed_time = time.time() - start_time
+        logger.info(f"✅ Respuesta de n8n recibida en {elapsed_time:.2f} segundos")
+    except requests.exceptions.Timeout:
+        elapsed_time = time.time() - start_time
+        logger.error(f"❌ Timeout después de {elapsed_time:.2f} segundos")
+        raise HTTPException(
+            status_code=504,
+            detail=f"Timeout al llamar al servicio de extracción (más de {N8N_TIMEOUT} segundos). El servicio n8n puede estar sobrecargado."
+        )
+    except requests.exceptions.ConnectionError as e:
+        logger.error(f"❌ Error de conexión con n8n: {e}")
+        raise HTTPException(
+            status_code=503,
+            detail=f"No se pudo conectar con el webhook de n8n. Verifica que el servicio esté disponible: {n8n_endpoints.describe()}"
+        )
+    except requests.exceptions.RequestException as e:
+        logger.error(f"❌ Error en request a n8n: {e}")
+        raise HTTPException(
+            status_code=502,
+            detail=f"Error al comunicarse con n8n: {str(e)}"
+        )
+    except PoolError as e:
+        # pool_block=True: no hubo conexión libre en N8N_POOL_TIMEOUT (EmptyPoolError no es un RequestException)
+        logger.error(f"❌ Pool de conexiones a n8n saturado: {e}")
+        raise EngineSaturated("Pool de conexiones a n8n saturado, reintentar en unos segundos")
+    
+    if response.status_code != 200:
+        error_detail = f"Error al llamar al servicio de extracción: {response.status_code}"
+        try:
+            error_body = fast_json.loads(response.content)
+            if 'message' in error_body:
+                error_detail += f" - {error_body['message']}"
+            elif 'detail' in error_body:
+                error_detail += f" - {error_body['detail']}"
+        except:
+            error_detail += f" - {response.text[:200]}"
+        
+        raise HTTPException(
+            status_code=500,
+            detail=error_detail
+        )
+    
+    # Extraer datos de la respuesta
+    try:
+        # Decodificar directo desde los bytes (sin pasar por response.text)
+        response_data = fast_json.loads(response.content)
+        logger.info(f"Respuesta de n8n recibida. Tipo: {type(response_data)}")
+        logger.info(f"Respuesta completa (primeros 500 chars): {str(response_data)[:500]}")
+        if isinstance(response_data, list):
+            logger.info(f"Es un array con {len(response_data)} elementos")
+            if len(response_data) > 0:
+                logger.info(f"Primer elemento: {response_data[0]}")
+        elif isinstance(response_data, dict):
+            logger.info(f"Es un dict con keys: {list(response_data.keys())[:5]}")
+            # Verificar si el dict contiene un array en alguna key
+            for key, value in response_data.items():
+                if isinstance(value, list):
+                    logger.info(f"  - Key '{key}' contiene un array con {len(value)} elementos")
+    except ValueError as e:
+        logger.error(f"Error al parsear JSON de n8n: {e}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"El webhook de n8n no devolvió JSON válido: {response.text[:200]}"
+        )
+    
+    return response_data
+
+
+# Maestro de tiendas para normalizar codigo_tienda/tienda_nombre (archivo local o tabla de BigQuery)
+STORE_MASTER_PATH = os.getenv('STORE_MASTER_PATH')  # CSV/JSON/JSONL con codigo_tienda y tienda_nombre
+STORE_MASTER_TABLE = os.getenv('STORE_MASTER_TABLE')  # proyecto.dataset.tabla (si no hay archivo)
+STORE_MASTER_REFRESH_SECONDS = float(os.getenv('STORE_MASTER_REFRESH_SECONDS', '3600'))
+STORE_MATCH_MIN_SIMILARITY = float(os.getenv('STORE_MATCH_MIN_SIMILARITY', '0.5'))  # Similitud mínima de nombre (0 a 1)
+store_index = None
+if STORE_MASTER_PATH:
+    store_index = StoreIndex(lambda: load_store_file(STORE_MASTER_PATH), STORE_MASTER_REFRESH_SECONDS, STORE_MATCH_MIN_SIMILARITY)
+elif STORE_MASTER_TABLE and bigquery_client:
+    store_index = StoreIndex(bigquery_store_loader(bigquery_client, STORE_MASTER_TABLE),
+                             STORE_MASTER_REFRESH_SECONDS, STORE_MATCH_MIN_SIMILARITY)
+else:
+    logger.info("Maestro de tiendas no configurado: codigo_tienda y tienda_nombre se guardan como se leyeron")
+
+
+# La respuesta se serializa directo desde el InvoiceRecord (response_model solo documenta):
+# validar el registro del parser contra MappedInvoiceData antes de responder o guardar
+VALIDATE_PARSER_OUTPUT = os.getenv('VALIDATE_PARSER_OUTPUT', 'true').lower() == 'true'
+
+
+def validate_mapped_invoice(mapped_data: InvoiceRecord) -> InvoiceRecord:
+    """Validar (y convertir a los tipos del modelo) el registro producido por el parser"""
+    try:
+        validated = MappedInvoiceData.model_validate(mapped_data.to_dict())
+    except ValidationError as e:
+        logger.error(f"❌ El parser produjo un registro inválido: {e}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Datos extraídos con formato inválido: {str(e)[:500]}"
+        )
+    for name in MappedInvoiceData.model_fields:
+        mapped_data[name] = getattr(validated, name)
+    return mapped_data
+
+
+def build_mapped_invoice(response_data) -> InvoiceRecord:
+    """Detectar el formato de la respuesta de n8n y construir el registro de la factura"""
+    try:
+        mapped_data, raw_extracted_text = detect_and_parse(response_data)
+    except StructuredDataError as parse_error:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error al procesar datos estructurados: {str(parse_error)}"
+        )
+    
+    if not mapped_data:
+        logger.error(f"❌ No se pudo detectar el formato de la respuesta")
+        logger.error(f"Tipo de respuesta: {type(response_data)}")
+        logger.error(f"Contenido completo: {response_data}")
+        raise HTTPException(
+            status_code=400,
+            detail=f"No se pudo procesar la respuesta del webhook. Formato no reconocido. Tipo recibido: {type(response_data).__name__}. Contenido: {str(response_data)[:500]}"
+        )
+    
+    # Agregar el texto crudo extraído para visualización/debug (acotado como el texto parseado)
+    mapped_data.raw_extracted_text = (raw_extracted_text or str(response_data))[:PARSE_MAX_TEXT_CHARS]
+    normalize_store(mapped_data, store_index)
+    if VALIDATE_PARSER_OUTPUT:
+        validate_mapped_invoice(mapped_data)
+    return mapped_data
+
+
+# Grabación de respuestas de n8n para replay offline (python ocr_recorder.py replay ...)
+OCR_RECORD_ENABLED = os.getenv('OCR_RECORD_ENABLED', 'false').lower() == 'true'
+OCR_RECORD_DIR = os.getenv('OCR_RECORD_DIR', os.path.join(_script_dir, 'data', 'recordings'))
+OCR_RECORD_SAMPLE_RATE = float(os.getenv('OCR_RECORD_SAMPLE_RATE', '1.0'))  # Fracción de requests grabados
+OCR_RECORD_STORE_IMAGES = os.getenv('OCR_RECORD_STORE_IMAGES', 'false').lower() == 'true'  # Guardar también la imagen
+ocr_recorder = OcrRecorder(OCR_RECORD_DIR, OCR_RECORD_SAMPLE_RATE, OCR_RECORD_STORE_IMAGES) if OCR_RECORD_ENABLED else None
+
+
+# Motor de OCR: n8n (webhook), tesseract (local) o auto (n8n con fallback local si falla o está lento)
+OCR_ENGINE = os.getenv('OCR_ENGINE', 'n8n').lower()
+OCR_LOCAL_WORKERS = int(os.getenv('OCR_LOCAL_WORKERS', '2'))  # Procesos de Tesseract
+OCR_LOCAL_LANG = os.getenv('OCR_LOCAL_LANG', 'spa')
+OCR_LOCAL_TIMEOUT = float(os.getenv('OCR_LOCAL_TIMEOUT', '60'))
+OCR_FALLBACK_AFTER = float(os.getenv('OCR_FALLBACK_AFTER', '8'))  # Segundos de espera a n8n antes de lanzar el OCR local
+OCR_FALLBACK_COOLDOWN = float(os.getenv('OCR_FALLBACK_COOLDOWN', '60'))  # Tras una falla de n8n, usar el local N segundos
+ocr_engines = create_engines(
+    OCR_ENGINE,
+    call_n8n_webhook,
+    local_workers=OCR_LOCAL_WORKERS,
+    local_lang=OCR_LOCAL_LANG,
+    local_timeout=OCR_LOCAL_TIMEOUT,
+    slow_after=OCR_FALLBACK_AFTER,
+    cooldown=OCR_FALLBACK_COOLDOWN,
+)
+if OCR_ENGINE not in ocr_engines:
+    logger.warning(f"⚠️ OCR_ENGINE='{OCR_ENGINE}' no disponible. Usando n8n.")
+    OCR_ENGINE = 'n8n'
+logger.info(f"✅ Motores de OCR: {sorted(ocr_engines)} (por defecto: {OCR_ENGINE})")
+
+
+# Límites del parseo del texto del OCR: el texto se acota antes de aplicar los patrones y, si aun
+# así el parseo supera el presupuesto, se retorna lo extraído con incomplete=true
+PARSE_MAX_TEXT_CHARS = int(os.getenv('PARSE_MAX_TEXT_CHARS', '20000'))
+PARSE_MAX_LINE_CHARS = int(os.getenv('PARSE_MAX_LINE_CHARS', '300'))
+PARSE_BUDGET_SECONDS = float(os.getenv('PARSE_BUDGET_SECONDS', '0.25'))  # 0 = sin límite
+invoice_parser.set_limits(PARSE_MAX_TEXT_CHARS, PARSE_MAX_LINE_CHARS, PARSE_BUDGET_SECONDS)
+
+
+def extract_invoice(filename: str, file_content: bytes, content_type: str,
+                    engine: Optional[str] = None) -> InvoiceRecord:
+    """Extraer con el motor de OCR (por defecto OCR_ENGINE) y parsear, grabando la extracción si está habilitado"""
+    ocr_engine = ocr_engines.get(engine or OCR_ENGINE)
+    if ocr_engine is None:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Motor de OCR '{engine}' no disponible. Opciones: {', '.join(sorted(ocr_engines))}"
+        )
+    ocr_start = time.perf_counter()
+    try:
+        response_data, used_engine = ocr_engine.extract(filename, file_content, content_type)
+    except OcrEngineError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    ocr_seconds = time.perf_counter() - ocr_start
+    metrics.observe(f'ocr_{used_engine}_seconds', ocr_seconds)
+    
+    parse_start = time.perf_counter()
+    mapped_data = None
+    error = None
+    try:
+        mapped_data = build_mapped_invoice(response_data)
+        metrics.inc('invoices_parsed_total')
+        return mapped_data
+    except HTTPException as e:
+        error = str(e.detail)
+        metrics.inc('invoices_parse_failed_total')
+        raise
+    finally:
+        metrics.observe('parse_seconds', time.perf_counter() - parse_start)
+        # Solo se graban respuestas de n8n: son la referencia para el replay y el benchmark del OCR local
+        if ocr_recorder and used_engine == 'n8n':
+            ocr_recorder.record(
+                filename, content_type, file_content, response_data,
+                mapped_data.to_dict() if mapped_data else None, error,
+                ocr_seconds, time.perf_counter() - parse_start
+            )
+
+
+# Detección de fotos casi duplicadas (hash perceptual; requiere Pillow)
+DEDUP_ENABLED = os.getenv('DEDUP_ENABLED', 'true').lower() == 'true' and dedup_available()
+DEDUP_MAX_DISTANCE = int(os.getenv('DEDUP_MAX_DISTANCE', '6'))  # Bits distintos (de 64) para considerar casi duplicado
+DEDUP_MAX_ENTRIES = int(os.getenv('DEDUP_MAX_ENTRIES', '5000'))  # Imágenes recientes recordadas
+DEDUP_TTL_SECONDS = int(os.getenv('DEDUP_TTL_SECONDS', str(6 * 3600)))
+DEDUP_REUSE_RESULT = os.getenv('DEDUP_REUSE_RESULT', 'false').lower() == 'true'  # Reusar el OCR previo en vez de repetirlo
+DEDUP_REUSE_MAX_DISTANCE = int(os.getenv('DEDUP_REUSE_MAX_DISTANCE', '2'))  # Umbral más estricto para reusar
+near_duplicates = NearDuplicateIndex(DEDUP_MAX_DISTANCE, DEDUP_MAX_ENTRIES, DEDUP_TTL_SECONDS) if DEDUP_ENABLED else None
+
+
+def extract_invoice_checked(filename: str, file_content: bytes, content_type: str,
+                            engine: Optional[str] = None, reuse: Optional[bool] = None,
+                            email: Optional[str] = None):
+    """
+    extract_invoice con detección de casi duplicados entre las fotos recientes del mismo
+    usuario (email). Retorna (registro, near_duplicate) donde near_duplicate describe la foto
+    previa parecida (o None). Con reuse (por defecto DEDUP_REUSE_RESULT) y una coincidencia muy
+    cercana se devuelve el resultado previo sin OCR, con un id_check nuevo: el guardado agrega
+    filas (no reemplaza), así que el duplicado nunca debe guardarse con el id_check previo.
+    Un casi duplicado (reusado o no) no se guarda automáticamente: pasa por revisión.
+    """
+    image_hash = dhash(file_content) if near_duplicates is not None else None
+    match = near_duplicates.find(image_hash, scope=email) if image_hash is not None else None
+    near_duplicate = None
+    if match:
+        distance, age_seconds, previous = match
+        near_duplicate = {
+            "distance": distance,
+            "age_seconds": round(age_seconds),
+            "id_check": previous["id_check"],
+            "filename": previous["filename"],
+            "reused": False,
+        }
+        logger.warning(f"⚠️ Posible foto duplicada de {previous['filename']} (distancia {distance})")
+        if (DEDUP_REUSE_RESULT if reuse is None else reuse) and distance <= DEDUP_REUSE_MAX_DISTANCE:
+            near_duplicate["reused"] = True
+            return InvoiceRecord(**{**previous["record"], "id_check": str(uuid.uuid4())}), near_duplicate
+    
+    mapped_data = extract_invoice(filename, file_content, content_type, engine)
+    if image_hash is not None:
+        near_duplicates.add(image_hash, {
+            "id_check": mapped_data.id_check,
+            "filename": filename,
+            "record": mapped_data.to_dict(),
+        }, scope=email)
+    return mapped_data, near_duplicate
+
+
+# Guardado automático: si todos los campos superan su umbral de confianza, la factura se guarda
+# en BigQuery en la misma llamada que la procesa (sin pasar por la validación manual)
+AUTO_COMMIT_ENABLED = os.getenv('AUTO_COMMIT_ENABLED', 'false').lower() == 'true'
+AUTO_COMMIT_THRESHOLDS = parse_thresholds(os.getenv('AUTO_COMMIT_THRESHOLDS', ''))  # campo:umbral,... (vacío = por defecto)
+logger.info(f"{'✅' if AUTO_COMMIT_ENABLED else '⚠️'} Guardado automático "
+            f"{'habilitado' if AUTO_COMMIT_ENABLED else 'deshabilitado'} (umbrales: {AUTO_COMMIT_THRESHOLDS})")
+
+
+def auto_commit_invoice(mapped_data: InvoiceRecord, email: str, canal: Optional[str] = None,
+                        near_duplicate: Optional[dict] = None) -> dict:
+    """
+    Guardar la factura sin revisión manual si todos los campos con umbral lo superan.
+    canal lo indica el operador (el OCR de texto no lo extrae) y cuenta con confianza total.
+    Retorna {"committed", "reason", "blocked_fields"}; si no se guarda, el resultado
+    sigue disponible para la validación manual.
+    """
+    if not AUTO_COMMIT_ENABLED:
+        return {"committed": False, "reason": "disabled", "blocked_fields": []}
+    if canal:
+        mapped_data.canal = canal
+        mapped_data.confidence = {**(mapped_data.confidence or {}), "canal": 1.0}
+    # Una foto casi duplicada siempre pasa por revisión: puede ser el mismo ticket cargado dos veces
+    if near_duplicate:
+        return {"committed": False, "reason": "near_duplicate", "blocked_fields": []}
+    if mapped_data.incomplete:
+        return {"committed": False, "reason": "incomplete", "blocked_fields": []}
+    blocked = failing_fields(mapped_data.confidence, AUTO_COMMIT_THRESHOLDS)
+    if not mapped_data.fecha and 'fecha' not in blocked:
+        blocked.append('fecha')
+    if blocked:
+        logger.info(f"Factura {mapped_data.id_check} requiere revisión (confianza baja: {', '.join(blocked)})")
+        return {"committed": False, "reason": "low_confidence", "blocked_fields": blocked}
+    
+    data = ValidatedInvoiceData(**{name: mapped_data[name] for name in ValidatedInvoiceData.model_fields})
+    try:
+        store_invoice(data, email)
+    except HTTPException as e:
+        logger.warning(f"⚠️ No se pudo guardar automáticamente la factura {mapped_data.id_check}: {e.detail}")
+        return {"committed": False, "reason": "save_failed", "blocked_fields": [], "detail": e.detail}
+    logger.info(f"✅ Factura {mapped_data.id_check} guardada automáticamente por {email}")
+    return {"committed": True, "reason": None, "blocked_fields": []}
+
+
 @app.post("/api/process-invoice", response_model=MappedInvoiceData)
 async def process_invoice(
     invoice_image: UploadFile = File(...),
+    ocr_engine: Optional[str] = Form(None),
+    reuse_duplicate: Optional[bool] = Form(None),
+    auto_commit: bool = Form(False),
+    canal: Optional[str] = Form(None),
     email: str = Depends(verify_token)
 ):
     """
     Endpoint para procesar una imagen de factura.
     1. Recibe la imagen del frontend
-    2. Llama al servicio n8n para extraer texto
-    3. Parsea y mapea el texto al esquema de BigQuery
+    2. Extrae el texto con el motor de OCR (ocr_engine: n8n, tesseract o auto; por defecto OCR_ENGINE)
+    3. Parsea y mapea el texto al esquema de BigQuery (con la confianza de cada campo)
     4. Retorna datos estructurados para validación
+    Si la foto es casi idéntica a una reciente se agrega "near_duplicate" a la respuesta
+    (reuse_duplicate=true reutiliza el resultado previo sin repetir el OCR).
+    Con auto_commit=true (y AUTO_COMMIT_ENABLED) la factura se guarda en BigQuery en la
+    misma llamada si todos los campos superan su umbral; "auto_commit" indica el resultado.
     """
     logger.info(f"Iniciando procesamiento de factura: {invoice_image.filename}")
     try:
@@ -532,225 +1247,26 @@ async def process_invoice(
         # Leer contenido del archivo
         file_content = await invoice_image.read()
         
-        # Llamar al servicio n8n para extraer texto
-        if not N8N_WEBHOOK_URL:
-            raise HTTPException(
-                status_code=500,
-                detail="URL de webhook n8n no configurada"
-            )
-        
-        files = {'invoice_image': (invoice_image.filename, file_content, invoice_image.content_type)}
-        
-        # Usar sesión con connection pooling y retry logic
-        try:
-            start_time = time.time()
-            response = n8n_session.post(
-                N8N_WEBHOOK_URL, 
-                files=files, 
-                timeout=N8N_TIMEOUT,
-                stream=False  # No usar streaming para archivos pequeños
-            )
-            elapsed_time = time.time() - start_time
-            logger.info(f"✅ Respuesta de n8n recibida en {elapsed_time:.2f} segundos")
-        except requests.exceptions.Timeout:
-            elapsed_time = time.time() - start_time if 'start_time' in locals() else N8N_TIMEOUT
-            logger.error(f"❌ Timeout después de {elapsed_time:.2f} segundos")
-            raise HTTPException(
-                status_code=504,
-                detail=f"Timeout al llamar al servicio de extracción (más de {N8N_TIMEOUT} segundos). El servicio n8n puede estar sobrecargado."
-            )
-        except requests.exceptions.ConnectionError as e:
-            logger.error(f"❌ Error de conexión con n8n: {e}")
-            raise HTTPException(
-                status_code=503,
-                detail=f"No se pudo conectar con el webhook de n8n. Verifica que el servicio esté disponible: {N8N_WEBHOOK_URL}"
-            )
-        except requests.exceptions.RequestException as e:
-            logger.error(f"❌ Error en request a n8n: {e}")
-            raise HTTPException(
-                status_code=502,
-                detail=f"Error al comunicarse con n8n: {str(e)}"
-            )
-        
-        if response.status_code != 200:
-            error_detail = f"Error al llamar al servicio de extracción: {response.status_code}"
-            try:
-                error_body = response.json()
-                if 'message' in error_body:
-                    error_detail += f" - {error_body['message']}"
-                elif 'detail' in error_body:
-                    error_detail += f" - {error_body['detail']}"
-            except:
-                error_detail += f" - {response.text[:200]}"
-            
-            raise HTTPException(
-                status_code=500,
-                detail=error_detail
-            )
-        
-        # Extraer datos de la respuesta
-        try:
-            response_data = response.json()
-            logger.info(f"Respuesta de n8n recibida. Tipo: {type(response_data)}")
-            logger.info(f"Respuesta completa (primeros 500 chars): {str(response_data)[:500]}")
-            if isinstance(response_data, list):
-                logger.info(f"Es un array con {len(response_data)} elementos")
-                if len(response_data) > 0:
-                    logger.info(f"Primer elemento: {response_data[0]}")
-            elif isinstance(response_data, dict):
-                logger.info(f"Es un dict con keys: {list(response_data.keys())[:5]}")
-                # Verificar si el dict contiene un array en alguna key
-                for key, value in response_data.items():
-                    if isinstance(value, list):
-                        logger.info(f"  - Key '{key}' contiene un array con {len(value)} elementos")
-        except ValueError as e:
-            logger.error(f"Error al parsear JSON de n8n: {e}")
-            raise HTTPException(
-                status_code=500,
-                detail=f"El webhook de n8n no devolvió JSON válido: {response.text[:200]}"
-            )
-        
-        # Detectar formato de respuesta de n8n
-        mapped_data_dict = None
-        raw_extracted_text = None
-        
-        # Formato 1: Array que contiene objeto con "data" [{"data": [{"clave": "...", "valor": "..."}, ...]}]
-        if isinstance(response_data, list) and len(response_data) > 0:
-            logger.info("Verificando si es array estructurado...")
-            # Verificar si el primer elemento es un dict con key "data" que contiene el array estructurado
-            if isinstance(response_data[0], dict) and 'data' in response_data[0]:
-                data_array = response_data[0]['data']
-                if isinstance(data_array, list) and len(data_array) > 0:
-                    if isinstance(data_array[0], dict) and 'clave' in data_array[0] and 'valor' in data_array[0]:
-                        logger.info(f"✅ Detectado formato estructurado (array con 'data' key) con {len(data_array)} items")
-                        try:
-                            mapped_data_dict = parse_structured_data(data_array)
-                            logger.info(f"Datos mapeados exitosamente. id_check: {mapped_data_dict.get('id_check')}")
-                        except Exception as parse_error:
-                            logger.error(f"Error al parsear datos estructurados: {parse_error}", exc_info=True)
-                            raise HTTPException(
-                                status_code=500,
-                                detail=f"Error al procesar datos estructurados: {str(parse_error)}"
-                            )
-                        # Guardar el formato estructurado como texto para visualización (JSON formateado)
-                        raw_extracted_text = json.dumps(data_array, indent=2, ensure_ascii=False)
-            # Formato 1a: Array estructurado directo [{"clave": "...", "valor": "..."}, ...]
-            elif isinstance(response_data[0], dict) and 'clave' in response_data[0] and 'valor' in response_data[0]:
-                logger.info(f"✅ Detectado formato estructurado (array directo) con {len(response_data)} items")
-                try:
-                    mapped_data_dict = parse_structured_data(response_data)
-                    logger.info(f"Datos mapeados exitosamente. id_check: {mapped_data_dict.get('id_check')}")
-                except Exception as parse_error:
-                    logger.error(f"Error al parsear datos estructurados: {parse_error}", exc_info=True)
-                    raise HTTPException(
-                        status_code=500,
-                        detail=f"Error al procesar datos estructurados: {str(parse_error)}"
-                    )
-                # Guardar el formato estructurado como texto para visualización (JSON formateado)
-                raw_extracted_text = json.dumps(response_data, indent=2, ensure_ascii=False)
-        
-        # Formato 1b: Objeto individual con estructura {"clave": "...", "valor": "..."}
-        # O dict que contiene un array en alguna key
-        elif isinstance(response_data, dict):
-            # Verificar si contiene un array estructurado en alguna key
-            structured_array_found = None
-            for key, value in response_data.items():
-                if isinstance(value, list) and len(value) > 0:
-                    if isinstance(value[0], dict) and 'clave' in value[0] and 'valor' in value[0]:
-                        logger.info(f"✅ Detectado formato estructurado (array dentro de dict, key: '{key}')")
-                        structured_array_found = value
-                        break
-            
-            if structured_array_found:
-                try:
-                    mapped_data_dict = parse_structured_data(structured_array_found)
-                    logger.info(f"Datos mapeados exitosamente. id_check: {mapped_data_dict.get('id_check')}")
-                except Exception as parse_error:
-                    logger.error(f"Error al parsear datos estructurados: {parse_error}", exc_info=True)
-                    raise HTTPException(
-                        status_code=500,
-                        detail=f"Error al procesar datos estructurados: {str(parse_error)}"
-                    )
-                raw_extracted_text = json.dumps(structured_array_found, indent=2, ensure_ascii=False)
-            elif 'clave' in response_data and 'valor' in response_data:
-                logger.warning("⚠️ Detectado formato estructurado (objeto individual) - n8n debería devolver un array completo")
-                logger.warning("⚠️ Solo se procesará este objeto individual. Verifica la configuración de n8n.")
-                # Convertir a array para procesar
-                structured_array = [response_data]
-                try:
-                    mapped_data_dict = parse_structured_data(structured_array)
-                    logger.info(f"Datos mapeados exitosamente. id_check: {mapped_data_dict.get('id_check')}")
-                except Exception as parse_error:
-                    logger.error(f"Error al parsear datos estructurados: {parse_error}", exc_info=True)
-                    raise HTTPException(
-                        status_code=500,
-                        detail=f"Error al procesar datos estructurados: {str(parse_error)}"
-                    )
-                # Guardar el formato estructurado como texto para visualización (JSON formateado)
-                raw_extracted_text = json.dumps(structured_array, indent=2, ensure_ascii=False)
-        
-        # Formato 2: {"extracted_text": "..."} - Texto crudo
-        elif isinstance(response_data, dict) and 'extracted_text' in response_data:
-            extracted_text = response_data.get('extracted_text', '')
-            if extracted_text:
-                mapped_data_dict = parse_and_map_invoice(extracted_text)
-                raw_extracted_text = extracted_text
-        
-        # Formato 3: Respuesta completa de Google Vision AI
-        elif isinstance(response_data, dict) and 'responses' in response_data and len(response_data['responses']) > 0:
-            first_response = response_data['responses'][0]
-            if 'fullTextAnnotation' in first_response and 'text' in first_response['fullTextAnnotation']:
-                extracted_text = first_response['fullTextAnnotation']['text']
-                mapped_data_dict = parse_and_map_invoice(extracted_text)
-                raw_extracted_text = extracted_text
-        
-        # Formato 4: {"fullTextAnnotation": {"text": "..."}}
-        elif isinstance(response_data, dict) and 'fullTextAnnotation' in response_data and 'text' in response_data['fullTextAnnotation']:
-            extracted_text = response_data['fullTextAnnotation']['text']
-            mapped_data_dict = parse_and_map_invoice(extracted_text)
-            raw_extracted_text = extracted_text
-        
-        # Formato 5: Texto directo en el campo "text"
-        elif isinstance(response_data, dict) and 'text' in response_data:
-            extracted_text = response_data.get('text', '')
-            if extracted_text:
-                mapped_data_dict = parse_and_map_invoice(extracted_text)
-                raw_extracted_text = extracted_text
-        
-        # Formato 6: Buscar cualquier campo que contenga texto
-        elif isinstance(response_data, dict):
-            for key in ['description', 'content', 'data']:
-                if key in response_data and isinstance(response_data[key], str):
-                    extracted_text = response_data[key]
-                    mapped_data_dict = parse_and_map_invoice(extracted_text)
-                    raw_extracted_text = extracted_text
-                    break
+        mapped_data, near_duplicate = await run_in_threadpool(
+            extract_invoice_checked, invoice_image.filename, file_content, invoice_image.content_type,
+            ocr_engine, reuse_duplicate, email
+        )
         
-        if not mapped_data_dict:
-            logger.error(f"❌ No se pudo detectar el formato de la respuesta")
-            logger.error(f"Tipo de respuesta: {type(response_data)}")
-            logger.error(f"Contenido completo: {response_data}")
-            raise HTTPException(
-                status_code=400,
-                detail=f"No se pudo procesar la respuesta del webhook. Formato no reconocido. Tipo recibido: {type(response_data).__name__}. Contenido: {str(response_data)[:500]}"
+        logger.info(f"Factura procesada exitosamente. id_check: {mapped_data.id_check}")
+        extras = {}
+        if near_duplicate:
+            extras["near_duplicate"] = near_duplicate
+        if auto_commit:
+            extras["auto_commit"] = await run_in_threadpool(
+                auto_commit_invoice, mapped_data, email, canal, near_duplicate
             )
-        
-        # Agregar el texto crudo extraído para visualización/debug
-        mapped_data_dict["raw_extracted_text"] = raw_extracted_text or str(response_data)
-        
-        # Convertir diccionario a modelo Pydantic
-        try:
-            mapped_data = MappedInvoiceData(**mapped_data_dict)
-        except Exception as validation_error:
-            logger.error(f"Error al validar datos mapeados: {validation_error}")
-            logger.error(f"Datos mapeados: {mapped_data_dict}")
-            raise HTTPException(
-                status_code=500,
-                detail=f"Error al validar los datos extraídos: {str(validation_error)}. Datos: {str(mapped_data_dict)[:300]}"
+        if extras:
+            return Response(
+                content=fast_json.dumps({**mapped_data.to_dict(), **extras}),
+                media_type="application/json"
             )
-        
-        logger.info(f"Factura procesada exitosamente. id_check: {mapped_data.id_check}")
-        return mapped_data
+        # Serializar el registro directamente (response_model queda solo para la documentación)
+        return Response(content=mapped_data.to_json(), media_type="application/json")
     
     except HTTPException:
         # Re-lanzar HTTPException sin modificar
@@ -772,129 +1288,450 @@ async def process_invoice(
         )
 
 
-@app.post("/api/save-invoice")
-async def save_invoice(
-    data: ValidatedInvoiceData,
+def run_invoice_job(filename: str, content_type: str, content: bytes, auto_commit: bool = False,
+                    canal: Optional[str] = None, email: Optional[str] = None, resumed: bool = False):
+    """
+    Procesar la imagen de un job en segundo plano (mismo flujo que /api/process-invoice).
+    Un job reanudado tras un reinicio (resumed) no se guarda automáticamente: el intento
+    interrumpido pudo haberlo guardado ya y el nuevo parseo tiene otro id_check.
+    """
+    try:
+        mapped_data, near_duplicate = extract_invoice_checked(filename, content, content_type, email=email)
+        extras = {}
+        if near_duplicate:
+            extras["near_duplicate"] = near_duplicate
+        if auto_commit and resumed:
+            logger.warning(f"⚠️ Factura {mapped_data.id_check} de un job reanudado: queda para revisión manual")
+            extras["auto_commit"] = {"committed": False, "reason": "resumed", "blocked_fields": []}
+        elif auto_commit:
+            extras["auto_commit"] = auto_commit_invoice(mapped_data, email, canal, near_duplicate)
+        if extras:
+            return {**mapped_data.to_dict(), **extras}
+        # El registro se serializa directo al guardar el resultado del job
+        return mapped_data
+    except HTTPException as e:
+        raise JobError(e.status_code, e.detail)
+    except requests.exceptions.RequestException as e:
+        raise JobError(500, f"Error al comunicarse con el servicio de extracción: {str(e)}")
+
+
+def notify_job_callback(job_id: str):
+    """Notificar la finalización de un job a su callback_url (si fue configurada)"""
+    row = job_store.get_internal(job_id)
+    if row is None or not row['callback_url']:
+        return
+    job = job_store.get(job_id)
+    payload = {key: job[key] for key in ("job_id", "status", "result", "error")}
+    response = requests.post(row['callback_url'], json=payload, timeout=10)
+    logger.info(f"📨 Callback del job {job_id} enviado: {response.status_code}")
+
+
+job_store = JobStore(JOBS_DIR, JOB_TTL_SECONDS)
+
+# Subidas reanudables por partes: los bloques se escriben en un spool junto a los jobs
+UPLOADS_DIR = os.getenv('UPLOADS_DIR', os.path.join(JOBS_DIR, 'uploads'))
+UPLOAD_TTL_SECONDS = int(os.getenv('UPLOAD_TTL_SECONDS', '86400'))  # Tiempo para completar una subida (24h)
+UPLOAD_MAX_SIZE = int(os.getenv('UPLOAD_MAX_SIZE', str(20 * 1024 * 1024)))  # Tamaño máximo de una imagen
+UPLOAD_CHUNK_SIZE = int(os.getenv('UPLOAD_CHUNK_SIZE', str(256 * 1024)))  # Tamaño de bloque sugerido al cliente
+UPLOAD_MAX_CHUNK_SIZE = int(os.getenv('UPLOAD_MAX_CHUNK_SIZE', str(4 * 1024 * 1024)))  # Máximo por PATCH
+upload_store = UploadStore(UPLOADS_DIR, UPLOAD_TTL_SECONDS, UPLOAD_MAX_SIZE, gc_interval=JOB_GC_INTERVAL)
+job_runner = JobRunner(
+    job_store,
+    run_invoice_job,
+    workers=JOB_WORKERS,
+    gc_interval=JOB_GC_INTERVAL,
+    on_finished=notify_job_callback,
+)
+
+
+@app.on_event("startup")
+def start_background_workers():
+    job_runner.start()
+    http_pool_keeper.start()
+    upload_store.start()
+    if GOOGLE_CLIENT_ID and AUTH_MODE != 'userinfo':
+        google_certs.start()
+    if invoice_archive:
+        invoice_archive.start()
+    Thread(target=warm_invoice_index, name="invoice-index-warm", daemon=True).start()
+    invoice_rollups.start()
+    if store_index is not None:
+        store_index.start()
+
+
+@app.on_event("startup")
+async def configure_event_loop():
+    if loop_watchdog is not None:
+        loop_watchdog.start(asyncio.get_running_loop())
+    # El tamaño de los pools HTTP asume este límite de hilos para run_in_threadpool
+    anyio.to_thread.current_default_thread_limiter().total_tokens = HTTP_THREADPOOL_SIZE
+
+
+@app.on_event("shutdown")
+def stop_background_workers():
+    http_pool_keeper.stop()
+    if loop_watchdog is not None:
+        loop_watchdog.stop()
+    job_runner.stop()
+    upload_store.stop()
+    google_certs.stop()
+    if invoice_sink:
+        invoice_sink.close()
+    if invoice_archive:
+        invoice_archive.stop()
+    invoice_rollups.stop()
+    if store_index is not None:
+        store_index.stop()
+    if ocr_recorder:
+        ocr_recorder.close()
+    for engine in ocr_engines.values():
+        engine.close()
+
+
+def job_options(email: str, auto_commit: bool, canal: Optional[str]) -> Optional[dict]:
+    """Opciones de procesamiento guardadas con el job (argumentos de run_invoice_job)"""
+    # El email siempre se pasa: la detección de duplicados es por usuario
+    if not auto_commit:
+        return {"email": email}
+    return {"auto_commit": True, "canal": canal, "email": email}
+
+
+def get_job_for_user(job_id: str, email: str) -> dict:
+    """Obtener un job verificando que pertenezca al usuario (o que sea superadmin)"""
+    job = job_store.get(job_id)
+    if job is None or (job["email"] != email and not is_superadmin(email)):
+        raise HTTPException(status_code=404, detail="Job no encontrado o expirado")
+    return job
+
+
+@app.post("/api/jobs", status_code=202)
+async def create_job(
+    invoice_image: UploadFile = File(...),
+    callback_url: Optional[str] = Form(None),
+    auto_commit: bool = Form(False),
+    canal: Optional[str] = Form(None),
     email: str = Depends(verify_token)
 ):
     """
-    Endpoint para guardar datos validados de factura en BigQuery.
-    1. Recibe datos validados del frontend
-    2. Formatea datos según esquema de BigQuery
-    3. Inserta fila en BigQuery
-    4. Retorna confirmación
+    Encolar el procesamiento de una factura y retornar inmediatamente un job_id.
+    El resultado se consulta con GET /api/jobs/{job_id} (long-poll con ?wait=) o
+    GET /api/jobs/{job_id}/events (SSE), o se recibe en callback_url al terminar.
+    auto_commit y canal funcionan igual que en /api/process-invoice.
+    """
+    if not invoice_image.content_type or not invoice_image.content_type.startswith('image/'):
+        raise HTTPException(status_code=400, detail="El archivo debe ser una imagen")
+    
+    if callback_url and not callback_url_allowed(callback_url):
+        raise HTTPException(status_code=400, detail="callback_url no permitida")
+    
+    file_content = await invoice_image.read()
+    job_id = job_store.create(email, invoice_image.filename, invoice_image.content_type, file_content, callback_url,
+                              job_options(email, auto_commit, canal))
+    job_runner.submit(job_id)
+    logger.info(f"📥 Job {job_id} encolado por {email}: {invoice_image.filename}")
+    
+    return {
+        "job_id": job_id,
+        "status": "queued",
+        "status_url": f"/api/jobs/{job_id}",
+        "events_url": f"/api/jobs/{job_id}/events"
+    }
+
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str, wait: float = 0, email: str = Depends(verify_token)):
+    """
+    Consultar el estado de un job. Con ?wait=N (segundos) espera hasta que el job
+    termine o se cumpla el plazo (long-poll).
+    """
+    job = get_job_for_user(job_id, email)
+    deadline = time.monotonic() + min(max(wait, 0), JOB_LONG_POLL_MAX)
+    while job["status"] not in TERMINAL_STATES and time.monotonic() < deadline:
+        await asyncio.sleep(JOB_POLL_INTERVAL)
+        job = get_job_for_user(job_id, email)
+    return job
+
+
+@app.get("/api/jobs/{job_id}/events")
+async def job_events(job_id: str, email: str = Depends(verify_token)):
+    """Stream SSE con los cambios de estado de un job hasta que termine"""
+    job = get_job_for_user(job_id, email)
+    
+    async def event_stream():
+        current = job
+        last_status = None
+        deadline = time.monotonic() + JOB_LONG_POLL_MAX
+        while True:
+            if current["status"] != last_status:
+                last_status = current["status"]
+                yield f"event: status\ndata: {fast_json.dumps_str(current)}\n\n"
+            if current["status"] in TERMINAL_STATES:
+                return
+            if time.monotonic() >= deadline:
+                # El cliente debe reconectarse para seguir esperando
+                yield "event: timeout\ndata: {}\n\n"
+                return
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+            current = job_store.get(job_id)
+            if current is None:
+                yield "event: expired\ndata: {}\n\n"
+                return
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+class UploadCreateRequest(BaseModel):
+    """Creación de una subida reanudable"""
+    filename: str
+    content_type: str
+    length: int = Field(..., description="Tamaño total del archivo en bytes")
+    sha256: Optional[str] = Field(None, description="sha256 (hex) del archivo completo, verificado al finalizar")
+    callback_url: Optional[str] = None
+    auto_commit: bool = Field(False, description="Guardar en BigQuery si la confianza de todos los campos es alta")
+    canal: Optional[str] = None
+
+
+class UploadFinalizeRequest(BaseModel):
+    sha256: Optional[str] = None
+
+
+def upload_headers(upload: dict) -> dict:
+    return {
+        "Upload-Offset": str(upload["offset"]),
+        "Upload-Length": str(upload["length"]),
+        "Cache-Control": "no-store",
+    }
+
+
+@app.post("/api/uploads", status_code=201)
+async def create_upload(data: UploadCreateRequest, email: str = Depends(verify_token)):
     """
+    Crear una subida reanudable. El cliente envía la imagen en bloques con
+    PATCH /api/uploads/{upload_id} (header Upload-Offset) y al terminar llama a
+    POST /api/uploads/{upload_id}/finalize, que encola el OCR como un job.
+    Si la conexión se corta, HEAD /api/uploads/{upload_id} indica desde qué offset seguir.
+    """
+    if not data.content_type.startswith('image/'):
+        raise HTTPException(status_code=400, detail="El archivo debe ser una imagen")
+    if data.callback_url and not callback_url_allowed(data.callback_url):
+        raise HTTPException(status_code=400, detail="callback_url no permitida")
     try:
-        if not bigquery_client:
-            raise HTTPException(
-                status_code=500,
-                detail="BigQuery no está configurado correctamente"
-            )
-        
-        # Validar fecha requerida
-        if not data.fecha:
-            raise HTTPException(status_code=400, detail="El campo 'fecha' es requerido")
-        
-        # Convertir fecha string a DATE
+        upload = await run_in_threadpool(
+            upload_store.create, email, data.filename, data.content_type, data.length, data.sha256, data.callback_url,
+            job_options(email, data.auto_commit, data.canal)
+        )
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    logger.info(f"📤 Subida {upload['upload_id']} creada por {email}: {data.filename} ({data.length} bytes)")
+    return JSONResponse(
+        status_code=201,
+        content={**upload, "chunk_size": UPLOAD_CHUNK_SIZE, "upload_url": f"/api/uploads/{upload['upload_id']}"},
+        headers={**upload_headers(upload), "Location": f"/api/uploads/{upload['upload_id']}"}
+    )
+
+
+@app.head("/api/uploads/{upload_id}")
+async def head_upload(upload_id: str, email: str = Depends(verify_token)):
+    """Offset confirmado de una subida (para reanudar después de un corte)"""
+    try:
+        upload = await run_in_threadpool(upload_store.get, upload_id, email)
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    return Response(status_code=200, headers=upload_headers(upload))
+
+
+@app.get("/api/uploads/{upload_id}")
+async def get_upload(upload_id: str, email: str = Depends(verify_token)):
+    """Estado de una subida (offset confirmado y job_id si ya fue finalizada)"""
+    try:
+        upload = await run_in_threadpool(upload_store.get, upload_id, email)
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    return JSONResponse(content=upload, headers=upload_headers(upload))
+
+
+@app.patch("/api/uploads/{upload_id}")
+async def patch_upload(
+    upload_id: str,
+    request: Request,
+    upload_offset: int = Header(..., alias="Upload-Offset"),
+    upload_checksum: Optional[str] = Header(None, alias="Upload-Checksum"),
+    email: str = Depends(verify_token)
+):
+    """
+    Agregar un bloque (cuerpo crudo, application/offset+octet-stream) en la posición
+    Upload-Offset. Con Upload-Checksum: sha256 <base64> se verifica el bloque.
+    Responde 204 con el nuevo Upload-Offset; 409 si el offset no coincide con lo recibido.
+    """
+    chunk = bytearray()
+    async for part in request.stream():
+        chunk.extend(part)
+        if len(chunk) > UPLOAD_MAX_CHUNK_SIZE:
+            raise HTTPException(status_code=413, detail=f"El bloque supera el máximo de {UPLOAD_MAX_CHUNK_SIZE} bytes")
+    try:
+        checksum = parse_upload_checksum(upload_checksum)
+        offset = await run_in_threadpool(upload_store.append, upload_id, email, upload_offset, bytes(chunk), checksum)
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    return Response(status_code=204, headers={"Upload-Offset": str(offset), "Cache-Control": "no-store"})
+
+
+@app.post("/api/uploads/{upload_id}/finalize", status_code=202)
+async def finalize_upload(
+    upload_id: str,
+    data: Optional[UploadFinalizeRequest] = None,
+    email: str = Depends(verify_token)
+):
+    """
+    Verificar la subida completa (tamaño y sha256) y encolar el OCR. Retorna el job
+    igual que POST /api/jobs. Repetir el finalize retorna el mismo job.
+    """
+    def create_job(meta: dict, path: str) -> str:
+        job_id = job_store.create_from_file(email, meta["filename"], meta["content_type"], path,
+                                            meta.get("callback_url"), meta.get("options"))
+        job_runner.submit(job_id)
+        logger.info(f"📥 Job {job_id} encolado desde la subida {upload_id} por {email}: {meta['filename']}")
+        return job_id
+
+    try:
+        upload = await run_in_threadpool(
+            upload_store.finalize, upload_id, email, create_job, data.sha256 if data else None
+        )
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    job_id = upload["job_id"]
+    job = job_store.get(job_id)
+    return {
+        "upload_id": upload_id,
+        "job_id": job_id,
+        "status": job["status"] if job else "queued",
+        "status_url": f"/api/jobs/{job_id}",
+        "events_url": f"/api/jobs/{job_id}/events"
+    }
+
+
+@app.delete("/api/uploads/{upload_id}", status_code=204)
+async def delete_upload(upload_id: str, email: str = Depends(verify_token)):
+    """Cancelar una subida y descartar los bloques recibidos"""
+    try:
+        await run_in_threadpool(upload_store.delete, upload_id, email)
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    return Response(status_code=204)
+
+
+def archive_invoice_row(row: Dict):
+    """Registrar la fila en el archivo local (un reintento con el mismo id_check no duplica)"""
+    if not invoice_archive:
+        return
+    try:
+        invoice_archive.append(row)
+    except Exception as e:
+        logger.warning(f"⚠️ No se pudo archivar la factura localmente: {e}")
+
+
+def store_invoice(data, email: str) -> dict:
+    """
+    Guardar una factura validada en BigQuery (bloqueante; lo usan /api/save-invoice y el
+    guardado automático). data es un ValidatedInvoiceData.
+    1. Formatea datos según esquema de BigQuery
+    2. Inserta fila en BigQuery
+    3. Retorna confirmación
+    """
+    if not invoice_sink:
+        raise HTTPException(
+            status_code=500,
+            detail="BigQuery no está configurado correctamente"
+        )
+    
+    # Validar fecha requerida
+    if not data.fecha:
+        raise HTTPException(status_code=400, detail="El campo 'fecha' es requerido")
+    
+    # Convertir fecha string a DATE
+    try:
+        fecha_obj = datetime.strptime(data.fecha, '%Y-%m-%d')
+        fecha_bigquery = fecha_obj.strftime('%Y-%m-%d')
+    except ValueError:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Formato de fecha inválido: {data.fecha}. Use YYYY-MM-DD"
+        )
+    
+    # Convertir hora string a TIME (si existe)
+    hora_bigquery = None
+    if data.hora:
         try:
-            fecha_obj = datetime.strptime(data.fecha, '%Y-%m-%d')
-            fecha_bigquery = fecha_obj.strftime('%Y-%m-%d')
+            # Validar formato de hora
+            datetime.strptime(data.hora, '%H:%M:%S')
+            hora_bigquery = data.hora
         except ValueError:
             raise HTTPException(
                 status_code=400,
-                detail=f"Formato de fecha inválido: {data.fecha}. Use YYYY-MM-DD"
+                detail=f"Formato de hora inválido: {data.hora}. Use HH:MM:SS"
             )
-        
-        # Convertir hora string a TIME (si existe)
-        hora_bigquery = None
-        if data.hora:
-            try:
-                # Validar formato de hora
-                datetime.strptime(data.hora, '%H:%M:%S')
-                hora_bigquery = data.hora
-            except ValueError:
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"Formato de hora inválido: {data.hora}. Use HH:MM:SS"
-                )
-        
-        # Construir momento (DATETIME) si no está presente
-        momento_bigquery = data.momento
-        if not momento_bigquery and fecha_bigquery:
-            if hora_bigquery:
-                momento_bigquery = f"{fecha_bigquery}T{hora_bigquery}"
+    
+    # Construir momento (DATETIME) si no está presente
+    momento_bigquery = data.momento
+    if not momento_bigquery and fecha_bigquery:
+        if hora_bigquery:
+            momento_bigquery = f"{fecha_bigquery}T{hora_bigquery}"
+        else:
+            momento_bigquery = f"{fecha_bigquery}T00:00:00"
+    
+    # Validar y convertir momento a formato DATETIME de BigQuery
+    if momento_bigquery:
+        try:
+            # Parsear el momento y validar formato
+            # Manejar diferentes formatos de entrada
+            if 'T' in momento_bigquery:
+                momento_dt = datetime.fromisoformat(momento_bigquery.replace('Z', '+00:00').split('+')[0])
             else:
-                momento_bigquery = f"{fecha_bigquery}T00:00:00"
-        
-        # Validar y convertir momento a formato DATETIME de BigQuery
-        if momento_bigquery:
+                # Si no tiene 'T', asumir formato 'YYYY-MM-DD HH:MM:SS'
+                momento_dt = datetime.strptime(momento_bigquery, '%Y-%m-%d %H:%M:%S')
+            
+            # Formato para BigQuery: YYYY-MM-DDTHH:MM:SS
+            momento_bigquery = momento_dt.strftime('%Y-%m-%dT%H:%M:%S')
+        except (ValueError, AttributeError) as e:
+            logger.warning(f"Error al parsear momento: {e}. Usando valor original: {momento_bigquery}")
+            # Intentar formatear como string para BigQuery
             try:
-                # Parsear el momento y validar formato
-                # Manejar diferentes formatos de entrada
-                if 'T' in momento_bigquery:
-                    momento_dt = datetime.fromisoformat(momento_bigquery.replace('Z', '+00:00').split('+')[0])
-                else:
-                    # Si no tiene 'T', asumir formato 'YYYY-MM-DD HH:MM:SS'
-                    momento_dt = datetime.strptime(momento_bigquery, '%Y-%m-%d %H:%M:%S')
-                
-                # Formato para BigQuery: YYYY-MM-DDTHH:MM:SS
-                momento_bigquery = momento_dt.strftime('%Y-%m-%dT%H:%M:%S')
-                
-                # Determinar si es apertura o cierre basado en la hora (para logging)
-                hora_int = momento_dt.hour
-                if hora_int < 12:
-                    tipo_momento = "apertura"
-                elif hora_int >= 16:
-                    tipo_momento = "cierre"
+                momento_dt = datetime.strptime(momento_bigquery.split('T')[0], '%Y-%m-%d')
+                if hora_bigquery:
+                    momento_bigquery = f"{momento_dt.strftime('%Y-%m-%d')}T{hora_bigquery}"
                 else:
-                    tipo_momento = "medio_dia"
-                
-                logger.info(f"Momento calculado: {momento_bigquery} ({tipo_momento}, hora: {hora_int})")
-            except (ValueError, AttributeError) as e:
-                logger.warning(f"Error al parsear momento: {e}. Usando valor original: {momento_bigquery}")
-                # Intentar formatear como string para BigQuery
-                try:
-                    momento_dt = datetime.strptime(momento_bigquery.split('T')[0], '%Y-%m-%d')
-                    if hora_bigquery:
-                        momento_bigquery = f"{momento_dt.strftime('%Y-%m-%d')}T{hora_bigquery}"
-                    else:
-                        momento_bigquery = f"{momento_dt.strftime('%Y-%m-%d')}T00:00:00"
-                except:
-                    pass
-        
-        # Obtener timestamp actual para fecha_carga (formato ISO 8601 para BigQuery TIMESTAMP)
-        fecha_carga_timestamp = datetime.utcnow().isoformat() + 'Z'
-        
-        # Preparar fila para BigQuery con tipos correctos
-        row = {
-            "id_caja": data.id_caja,
-            "canal": data.canal,
-            "codigo_tienda": data.codigo_tienda,
-            "tienda_nombre": data.tienda_nombre,  # Ya viene de 'competidor' desde el parser
-            "fecha": fecha_bigquery,  # Formato YYYY-MM-DD (DATE)
-            "hora": hora_bigquery,  # Formato HH:MM:SS (TIME)
-            "ticket_electronico": data.ticket_electronico,
-            "id_boleta": data.id_boleta,
-            "id_check": data.id_check,
-            "monto_op_gravada": float(data.monto_op_gravada),
-            "importe_total": float(data.importe_total),
-            "recargo_consumo": float(data.recargo_consumo),
-            "monto_tarifario": float(data.monto_tarifario),
-            "mes": data.mes,
-            "anio": data.anio,
-            "momento": momento_bigquery,  # Formato YYYY-MM-DDTHH:MM:SS (DATETIME)
-            "a_c": data.a_c,
-            "fecha_carga": fecha_carga_timestamp,  # Timestamp de cuando se hizo la carga (TIMESTAMP)
-            "usuario_carga": email  # Email del usuario que hizo la carga (STRING)
-        }
-        
-        logger.info(f"Preparando inserción en BigQuery. id_check: {data.id_check}, momento: {momento_bigquery}, usuario: {email}, fecha_carga: {fecha_carga_timestamp}")
-        
-        # Insertar en BigQuery
-        table_id = f"{BIGQUERY_PROJECT_ID}.{BIGQUERY_DATASET_ID}.{BIGQUERY_TABLE_ID}"
-        logger.info(f"🔵 Insertando en tabla: {table_id}")
-        logger.info(f"🔵 Table ID desde .env: '{BIGQUERY_TABLE_ID}'")
-        
+                    momento_bigquery = f"{momento_dt.strftime('%Y-%m-%d')}T00:00:00"
+            except:
+                pass
+    
+    # Determinar si es apertura, medio día o cierre según la hora (para los agregados de /api/stats)
+    tipo_momento = classify_momento(momento_bigquery)
+    logger.info(f"Momento calculado: {momento_bigquery} ({tipo_momento})")
+    
+    # Obtener timestamp actual para fecha_carga (formato ISO 8601 para BigQuery TIMESTAMP)
+    fecha_carga_timestamp = datetime.utcnow().isoformat() + 'Z'
+    
+    # Preparar fila para BigQuery con tipos correctos (orden de INVOICE_ROW_SCHEMA):
+    # fecha YYYY-MM-DD (DATE), hora HH:MM:SS (TIME), momento YYYY-MM-DDTHH:MM:SS (DATETIME),
+    # fecha_carga TIMESTAMP de la carga y usuario_carga el email de quien la hizo
+    row = InvoiceRecord.bq_row(
+        data, fecha_carga_timestamp, email,
+        fecha=fecha_bigquery, hora=hora_bigquery, momento=momento_bigquery
+    )
+    
+    logger.info(f"Preparando inserción en BigQuery. id_check: {data.id_check}, momento: {momento_bigquery}, usuario: {email}, fecha_carga: {fecha_carga_timestamp}")
+    
+    # Insertar en BigQuery
+    table_id = f"{BIGQUERY_PROJECT_ID}.{BIGQUERY_DATASET_ID}.{BIGQUERY_TABLE_ID}"
+    logger.info(f"🔵 Insertando en tabla: {table_id}")
+    logger.info(f"🔵 Table ID desde .env: '{BIGQUERY_TABLE_ID}'")
+    
+    # Verificar el esquema de la tabla (el destino en memoria no tiene tabla)
+    if bigquery_client:
         try:
             table = bigquery_client.get_table(table_id)
             logger.info(f"Tabla obtenida. Esquema de id_check: {[field for field in table.schema if field.name == 'id_check']}")
@@ -918,58 +1755,85 @@ async def save_invoice(
                 status_code=500,
                 detail=f"Error al acceder a la tabla de BigQuery: {str(e)}"
             )
+    
+    # Insertar con el destino configurado (streaming insert o Storage Write API).
+    # La fila se archiva solo si BigQuery la aceptó o falló por un error que puede ser
+    # transitorio (queda para el backfill); una fila rechazada no debe reenviarse ni contarse.
+    try:
+        errors = invoice_sink.insert_rows([row])
+    except Exception:
+        archive_invoice_row(row)
+        raise
+    
+    if errors:
+        error_details = str(errors)
+        logger.error(f"Error al insertar en BigQuery: {error_details}")
         
-        errors = bigquery_client.insert_rows_json(table, [row])
-        
-        if errors:
-            error_details = str(errors)
-            logger.error(f"Error al insertar en BigQuery: {error_details}")
+        # Detectar errores de tipo de datos
+        if "cannot convert value" in error_details.lower() or "bad value" in error_details.lower():
+            # Extraer el campo problemático
+            field_name = None
+            if "'location':" in error_details or '"location":' in error_details:
+                import re
+                match = re.search(r'["\']location["\']:\s*["\']([^"\']+)["\']', error_details)
+                if match:
+                    field_name = match.group(1)
             
-            # Detectar errores de tipo de datos
-            if "cannot convert value" in error_details.lower() or "bad value" in error_details.lower():
-                # Extraer el campo problemático
-                field_name = None
-                if "'location':" in error_details or '"location":' in error_details:
-                    import re
-                    match = re.search(r'["\']location["\']:\s*["\']([^"\']+)["\']', error_details)
-                    if match:
-                        field_name = match.group(1)
-                
-                if field_name == "id_check":
-                    raise HTTPException(
-                        status_code=400,
-                        detail=f"Error de esquema en BigQuery: La columna 'id_check' está definida como INTEGER pero debe ser STRING. "
-                               f"Ejecuta el script 'bigquery_alter_table.sql' para corregir el esquema. Error: {error_details}"
-                    )
-                else:
-                    raise HTTPException(
-                        status_code=400,
-                        detail=f"Error de tipo de datos en BigQuery. Verifica que el esquema de la tabla coincida con los datos enviados. "
-                               f"Campo problemático: {field_name}. Error: {error_details}"
-                    )
-            # Detectar errores de permisos específicos
-            elif "permission" in error_details.lower() or "access denied" in error_details.lower() or "403" in error_details.lower():
-                raise HTTPException(
-                    status_code=403,
-                    detail=f"Error de permisos en BigQuery. Verifica que la cuenta de servicio tenga los roles necesarios: 'BigQuery Data Editor', 'BigQuery Job User', y 'BigQuery User'. Error: {error_details}"
-                )
-            elif "not found" in error_details.lower() or "404" in error_details.lower():
+            if field_name == "id_check":
                 raise HTTPException(
-                    status_code=404,
-                    detail=f"Tabla o dataset no encontrado en BigQuery. Verifica que la tabla '{table_id}' exista. Error: {error_details}"
+                    status_code=400,
+                    detail=f"Error de esquema en BigQuery: La columna 'id_check' está definida como INTEGER pero debe ser STRING. "
+                           f"Ejecuta el script 'bigquery_alter_table.sql' para corregir el esquema. Error: {error_details}"
                 )
             else:
                 raise HTTPException(
-                    status_code=500,
-                    detail=f"Error al insertar en BigQuery: {error_details}"
+                    status_code=400,
+                    detail=f"Error de tipo de datos en BigQuery. Verifica que el esquema de la tabla coincida con los datos enviados. "
+                           f"Campo problemático: {field_name}. Error: {error_details}"
                 )
-        
-        return {
-            "success": True,
-            "id_check": data.id_check,
-            "message": "Factura guardada exitosamente en BigQuery"
-        }
+        # Detectar errores de permisos específicos
+        elif "permission" in error_details.lower() or "access denied" in error_details.lower() or "403" in error_details.lower():
+            raise HTTPException(
+                status_code=403,
+                detail=f"Error de permisos en BigQuery. Verifica que la cuenta de servicio tenga los roles necesarios: 'BigQuery Data Editor', 'BigQuery Job User', y 'BigQuery User'. Error: {error_details}"
+            )
+        elif "not found" in error_details.lower() or "404" in error_details.lower():
+            raise HTTPException(
+                status_code=404,
+                detail=f"Tabla o dataset no encontrado en BigQuery. Verifica que la tabla '{table_id}' exista. Error: {error_details}"
+            )
+        else:
+            archive_invoice_row(row)
+            raise HTTPException(
+                status_code=500,
+                detail=f"Error al insertar en BigQuery: {error_details}"
+            )
+    
+    archive_invoice_row(row)
+    invoice_index.add(row)
+    invoice_rollups.record(row, tipo_momento)
     
+    return {
+        "success": True,
+        "id_check": data.id_check,
+            "message": "Factura guardada exitosamente en BigQuery"
+    }
+
+
+@app.post("/api/save-invoice")
+async def save_invoice(
+    data: ValidatedInvoiceData,
+    email: str = Depends(verify_token)
+):
+    """
+    Endpoint para guardar datos validados de factura en BigQuery.
+    1. Recibe datos validados del frontend
+    2. Formatea datos según esquema de BigQuery
+    3. Inserta fila en BigQuery
+    4. Retorna confirmación
+    """
+    try:
+        return await run_in_threadpool(store_invoice, data, email)
     except HTTPException:
         raise
     except Exception as e:
@@ -979,6 +1843,120 @@ async def save_invoice(
         )
 
 
+INVOICE_LIST_MAX_LIMIT = 500  # Tamaño máximo de página de GET /api/invoices
+
+
+@app.get("/api/invoices")
+async def list_invoices(
+    request: Request,
+    codigo_tienda: Optional[str] = None,
+    desde: Optional[str] = None,
+    hasta: Optional[str] = None,
+    usuario_carga: Optional[str] = None,
+    id_boleta: Optional[str] = None,
+    ticket_electronico: Optional[str] = None,
+    limit: int = 50,
+    cursor: Optional[str] = None,
+    email: str = Depends(verify_token)
+):
+    """
+    Listar facturas guardadas recientemente (de la más reciente a la más antigua).
+    Se sirve desde el índice en memoria: cubre los últimos INVOICE_INDEX_DAYS días.
+    Para la página siguiente enviar ?cursor=<next_cursor>.
+    """
+    for name, value in (("desde", desde), ("hasta", hasta)):
+        if value is not None:
+            try:
+                datetime.strptime(value, '%Y-%m-%d')
+            except ValueError:
+                raise HTTPException(status_code=400, detail=f"'{name}' debe tener formato YYYY-MM-DD")
+    if not 1 <= limit <= INVOICE_LIST_MAX_LIMIT:
+        raise HTTPException(status_code=400, detail=f"'limit' debe estar entre 1 y {INVOICE_LIST_MAX_LIMIT}")
+    
+    filters = {
+        "codigo_tienda": codigo_tienda,
+        "usuario_carga": usuario_carga,
+        "id_boleta": id_boleta,
+        "ticket_electronico": ticket_electronico,
+    }
+    try:
+        items, next_cursor = invoice_index.query(filters, desde=desde, hasta=hasta, limit=limit, cursor=cursor)
+    except InvalidCursor as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return conditional_json(request, {
+        "items": items,
+        "count": len(items),
+        "next_cursor": next_cursor,
+        "index": invoice_index.stats()
+    })
+
+@app.get("/api/stats")
+async def get_stats(
+    request: Request,
+    desde: Optional[str] = None,
+    hasta: Optional[str] = None,
+    codigo_tienda: Optional[str] = None,
+    email: str = Depends(verify_token)
+):
+    """
+    Totales por tienda y día (importe_total, recargo_consumo, monto_tarifario y tickets)
+    con desglose apertura / medio día / cierre. Se sirve desde los agregados incrementales.
+    """
+    for name, value in (("desde", desde), ("hasta", hasta)):
+        if value is not None:
+            try:
+                datetime.strptime(value, '%Y-%m-%d')
+            except ValueError:
+                raise HTTPException(status_code=400, detail=f"'{name}' debe tener formato YYYY-MM-DD")
+    
+    days = invoice_rollups.query(desde=desde, hasta=hasta, codigo_tienda=codigo_tienda)
+    return conditional_json(request, {
+        "days": days,
+        "count": len(days),
+        "tickets": sum(day["tickets"] for day in days),
+        "importe_total": round(sum(day["importe_total"] for day in days), 2)
+    })
+
+@app.get("/api/export")
+async def export_invoices_file(
+    anio: Optional[int] = None,
+    mes: Optional[int] = None,
+    codigo_tienda: Optional[str] = None,
+    format: str = "csv",
+    email: str = Depends(verify_token)
+):
+    """
+    Exportar las facturas guardadas en CSV o Parquet (format=csv|parquet), filtradas por
+    anio, mes y codigo_tienda. El archivo se arma y se envía por partes a medida que llegan
+    los batches de BigQuery, sin cargar el resultado completo en memoria.
+    """
+    if export_source is None:
+        raise HTTPException(status_code=503, detail="Exportación no disponible")
+    filters = ExportFilters(anio, mes, codigo_tienda)
+    try:
+        chunks = await run_in_threadpool(
+            export_invoices, export_source, filters, format,
+            max_streams=EXPORT_MAX_STREAMS, prefetch=EXPORT_PREFETCH_BATCHES,
+            on_batch=lambda rows: metrics.inc('export_rows_total', rows),
+        )
+    except ExportError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"❌ Error al abrir la exportación: {e}")
+        raise HTTPException(status_code=502, detail="Error al leer las facturas de BigQuery")
+    metrics.inc('exports_total')
+    logger.info(f"📤 Exportación {format} ({anio or '*'}-{mes or '*'}, tienda {codigo_tienda or '*'}) por {email}")
+    media_type, extension = EXPORT_FORMATS[format]
+    name = "_".join(["facturas"] + [str(v) for v in (anio, mes, codigo_tienda) if v is not None])
+    # La tarea de fondo corre también si el cliente se desconecta: corta los hilos lectores
+    # y libera los streams de BigQuery sin esperar a que se recolecte el generador
+    return StreamingResponse(
+        chunks,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{name}.{extension}"'},
+        background=BackgroundTask(chunks.close),
+    )
+
 # Endpoints para gestión de usuarios (solo superadmins)
 async def verify_superadmin(credentials: Optional[HTTPAuthorizationCredentials] = Depends(security)):
     """Verificar que el usuario es superadmin"""
@@ -988,14 +1966,15 @@ async def verify_superadmin(credentials: Optional[HTTPAuthorizationCredentials]
     return email
 
 @app.get("/api/admin/users")
-async def get_users(email: str = Depends(verify_superadmin)):
-    """Obtener lista de todos los usuarios autorizados"""
-    return {
-        "superadmins": list(superadmin_emails),
-        "authorized_users": list(authorized_emails),
+async def get_users(request: Request, email: str = Depends(verify_superadmin)):
+    """Obtener lista de todos los usuarios autorizados (ETag: responde 304 si no cambió)"""
+    # Listas ordenadas: el mismo conjunto de usuarios siempre produce el mismo ETag
+    return conditional_json(request, {
+        "superadmins": sorted(superadmin_emails),
+        "authorized_users": sorted(authorized_emails),
         "total_users": len(authorized_emails),
         "total_superadmins": len(superadmin_emails)
-    }
+    })
 
 @app.post("/api/admin/users/add")
 async def add_user(request: dict, email: str = Depends(verify_superadmin)):
@@ -1037,6 +2016,8 @@ async def remove_user(request: dict, email: str = Depends(verify_superadmin)):
         return {"success": True, "message": "Usuario no estaba autorizado", "email": user_email}
     
     authorized_emails.discard(user_email)
+    # Revocar los tokens de sesión ya emitidos para este usuario
+    session_versions.bump(user_email)
     
     if save_authorized_users():
         logger.info(f"✅ Usuario eliminado por {email}: {user_email}")
@@ -1045,13 +2026,180 @@ async def remove_user(request: dict, email: str = Depends(verify_superadmin)):
         authorized_emails.add(user_email)  # Revertir si falla el guardado
         raise HTTPException(status_code=500, detail="Error al guardar cambios")
 
+@app.get("/api/admin/metrics")
+async def get_metrics(format: str = "json", email: str = Depends(verify_superadmin)):
+    """Métricas internas del proceso (contadores y duraciones); format=prometheus para texto"""
+    metrics.set_gauge('job_queue_size', job_runner.queue_size())
+    for stats in (n8n_pool_stats, google_pool_stats):
+        snapshot = stats.snapshot()
+        for field in ("in_use", "idle", "created", "discarded", "reused"):
+            metrics.set_gauge(f'http_pool_{stats.name}_{field}', snapshot[field])
+    rss = memory_stats.process_memory()["rss_bytes"]
+    if rss is not None:
+        metrics.set_gauge('memory_rss_bytes', rss)
+    if format == "prometheus":
+        return Response(content=metrics.to_prometheus(), media_type="text/plain; version=0.0.4")
+    return metrics.snapshot()
+
+
+@app.post("/api/admin/profile")
+async def run_profile(seconds: float = 10, interval_ms: Optional[float] = None,
+                      email: str = Depends(verify_superadmin)):
+    """
+    Perfilar todo el proceso durante seconds con el profiler por muestreo. Guarda el perfil
+    como pilas colapsadas y JSON de speedscope y retorna las funciones con más muestras.
+    """
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        raise HTTPException(status_code=400, detail=f"seconds debe estar entre 0 y {PROFILE_MAX_SECONDS:g}")
+    if interval_ms is not None and not 1 <= interval_ms <= 1000:
+        raise HTTPException(status_code=400, detail="interval_ms debe estar entre 1 y 1000")
+    logger.info(f"🔬 Perfil del proceso por {seconds:g}s solicitado por {email}")
+    result = await profiler.profile(seconds, interval_ms / 1000 if interval_ms else None)
+    if result is None:
+        raise HTTPException(status_code=409, detail="Ya hay un perfil en curso")
+    metrics.inc('profiles_taken_total')
+    return result
+
+
+@app.get("/api/admin/profiles")
+async def list_profiles(email: str = Depends(verify_superadmin)):
+    """Archivos de perfil guardados (más recientes primero)"""
+    return {"profiles": await run_in_threadpool(profiler.list_files)}
+
+
+@app.get("/api/admin/profiles/{filename}")
+async def download_profile(filename: str, email: str = Depends(verify_superadmin)):
+    """Descargar un perfil (.speedscope.json para speedscope.app, .collapsed.txt para flamegraph.pl)"""
+    path = profiler.path_for(filename)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Perfil no encontrado")
+    media_type = "application/json" if filename.endswith('.json') else "text/plain; charset=utf-8"
+    return FileResponse(path, media_type=media_type, filename=filename)
+
+
+def cache_sizes() -> Dict[str, int]:
+    """Cantidad de elementos en las cachés y colas en memoria del backend"""
+    sizes = {
+        "authorized_emails": len(authorized_emails),
+        "superadmin_emails": len(superadmin_emails),
+        "session_versions": len(session_versions),
+        "google_certs": len(google_certs),
+        "invoice_index_rows": invoice_index.stats()["rows"],
+        "invoice_rollups_groups": len(invoice_rollups),
+        "job_queue": job_runner.queue_size(),
+        "n8n_endpoints": len(n8n_endpoints.snapshot()),
+        "ocr_engines": len(ocr_engines),
+    }
+    if invoice_sink:
+        sizes["invoice_sink_pending"] = invoice_sink.pending()
+    if near_duplicates is not None:
+        sizes["near_duplicates"] = len(near_duplicates)
+    if store_index is not None:
+        sizes["store_index"] = len(store_index)
+    return sizes
+
+
+def check_group_by(group_by: str):
+    if group_by not in memory_stats.GROUP_BY:
+        raise HTTPException(status_code=400, detail=f"group_by debe ser uno de: {', '.join(memory_stats.GROUP_BY)}")
+
+
+@app.get("/api/admin/memory")
+async def get_memory(email: str = Depends(verify_superadmin)):
+    """RSS del proceso, estado del GC y de tracemalloc, y tamaño de las cachés y colas"""
+    return {
+        "process": memory_stats.process_memory(),
+        "gc": await run_in_threadpool(memory_stats.gc_stats),
+        "tracemalloc": memory_tracker.status(),
+        "caches": cache_sizes(),
+    }
+
+
+@app.post("/api/admin/memory/tracemalloc")
+async def toggle_tracemalloc(enabled: bool, frames: Optional[int] = None,
+                             email: str = Depends(verify_superadmin)):
+    """Activar o desactivar tracemalloc (al desactivarlo se descartan los snapshots)"""
+    if frames is not None and not 1 <= frames <= 50:
+        raise HTTPException(status_code=400, detail="frames debe estar entre 1 y 50")
+    changed = memory_tracker.start(frames) if enabled else memory_tracker.stop()
+    logger.info(f"🧠 tracemalloc {'activado' if enabled else 'desactivado'} por {email}")
+    return {"changed": changed, **memory_tracker.status()}
+
+
+@app.post("/api/admin/memory/snapshots")
+async def take_memory_snapshot(name: Optional[str] = None, limit: int = 20, group_by: str = "lineno",
+                               email: str = Depends(verify_superadmin)):
+    """Tomar un snapshot de tracemalloc y retornar los sitios con más memoria asignada"""
+    check_group_by(group_by)
+    try:
+        name = await run_in_threadpool(memory_tracker.take_snapshot, name)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return await run_in_threadpool(memory_tracker.top, name, limit, group_by)
+
+
+@app.get("/api/admin/memory/snapshots/{name}")
+async def get_memory_snapshot(name: str, limit: int = 20, group_by: str = "lineno",
+                              email: str = Depends(verify_superadmin)):
+    check_group_by(group_by)
+    try:
+        return await run_in_threadpool(memory_tracker.top, name, limit, group_by)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Snapshot no encontrado")
+
+
+@app.get("/api/admin/memory/diff")
+async def diff_memory_snapshots(base: str, target: str, limit: int = 20, group_by: str = "lineno",
+                                email: str = Depends(verify_superadmin)):
+    """Sitios de asignación que más crecieron entre dos snapshots"""
+    check_group_by(group_by)
+    try:
+        return await run_in_threadpool(memory_tracker.diff, base, target, limit, group_by)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=f"Snapshot no encontrado: {e.args[0]}")
+
+
+@app.get("/api/admin/loop-blocks")
+async def get_loop_blocks(email: str = Depends(verify_superadmin)):
+    """Sitios de llamada que bloquearon el event loop, con su pila y cuántas veces ocurrió"""
+    if loop_watchdog is None:
+        raise HTTPException(status_code=404, detail="Watchdog del event loop deshabilitado")
+    return {
+        "threshold_seconds": LOOP_BLOCK_THRESHOLD,
+        "lag": metrics.snapshot()["summaries"].get("event_loop_lag_seconds"),
+        "sites": loop_watchdog.sites(),
+    }
+
+
+@app.get("/api/admin/http-pools")
+async def get_http_pools(email: str = Depends(verify_superadmin)):
+    """Estado de los pools de conexiones a n8n y Google (en uso, ociosas, creadas, descartadas)"""
+    return {
+        "n8n": {"maxsize": N8N_POOL_MAXSIZE, "warm": N8N_POOL_WARM, **n8n_pool_stats.snapshot()},
+        "google": {"maxsize": HTTP_THREADPOOL_SIZE + 1, "warm": GOOGLE_POOL_WARM, **google_pool_stats.snapshot()},
+        "wait_seconds": {
+            name: summary for name, summary in metrics.snapshot()["summaries"].items()
+            if name.startswith('http_pool_')
+        },
+    }
+
+
+@app.get("/api/admin/ocr-endpoints")
+async def get_ocr_endpoints(email: str = Depends(verify_superadmin)):
+    """Vista de salud por endpoint de n8n (latencias, requests en curso, fallos)"""
+    return {
+        "strategy": n8n_endpoints.strategy,
+        "hedging": N8N_HEDGING,
+        "endpoints": n8n_endpoints.snapshot()
+    }
+
 
 if __name__ == '__main__':
     import uvicorn
     import sys
     
     # Verificar configuración
-    if not N8N_WEBHOOK_URL:
+    if not N8N_WEBHOOK_URLS:
         print("ADVERTENCIA: N8N_WEBHOOK_URL no está configurada en .env")
     if not BIGQUERY_PROJECT_ID:
         print("ADVERTENCIA: BIGQUERY_PROJECT_ID no está configurada en .env")
@@ -1081,6 +2229,7 @@ if __name__ == '__main__':
             logger.info("🚀 Iniciando servidor en modo desarrollo (1 worker)")
     
     logger.info(f"📊 Configuración n8n: timeout={N8N_TIMEOUT}s, retries={N8N_MAX_RETRIES}, backoff={N8N_RETRY_BACKOFF}")
+    logger.info(f"📊 Endpoints n8n: {len(N8N_WEBHOOK_URLS)} ({N8N_LB_STRATEGY}, hedging={'sí' if N8N_HEDGING else 'no'})")
     logger.info(f"🌐 Escuchando en 0.0.0.0:{port}")
     
     # Siempre usar un solo worker para evitar problemas con Render
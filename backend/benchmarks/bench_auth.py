@@ -0,0 +1,69 @@
+"""
+Benchmark del costo de autenticación por request.
+Compara la validación local de tokens de sesión (HMAC) contra la verificación online
+con el endpoint userinfo de Google.
+
+Uso (desde backend/):
+    python benchmarks/bench_auth.py
+    GOOGLE_ACCESS_TOKEN=ya29.... python benchmarks/bench_auth.py  # incluye userinfo real
+"""
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests  # noqa: E402
+from session_tokens import SessionTokenSigner, SessionVersions  # noqa: E402
+
+ITERATIONS = int(os.getenv('BENCH_ITERATIONS', '20000'))
+USERINFO_ITERATIONS = int(os.getenv('BENCH_USERINFO_ITERATIONS', '20'))
+
+
+def measure(fn, iterations):
+    """Ejecutar fn N veces y retornar latencias en microsegundos"""
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1e6)
+    return samples
+
+
+def report(name, samples):
+    ordered = sorted(samples)
+    p50 = ordered[len(ordered) // 2]
+    p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+    print(f"{name:<32} n={len(samples):>6}  media={statistics.mean(samples):>12.1f}us  "
+          f"p50={p50:>12.1f}us  p99={p99:>12.1f}us")
+
+
+def main():
+    signer = SessionTokenSigner({'bench': b'x' * 32}, ttl_seconds=900)
+    versions = SessionVersions()
+    token = signer.issue('usuario@example.com', 'user', versions.get('usuario@example.com'))
+
+    report("session token (HMAC local)", measure(lambda: signer.verify(token, versions.get), ITERATIONS))
+    report("emisión de session token", measure(lambda: signer.issue('usuario@example.com', 'user', 0), ITERATIONS))
+
+    access_token = os.getenv('GOOGLE_ACCESS_TOKEN')
+    if access_token:
+        def userinfo(session):
+            return lambda: session.get(
+                'https://www.googleapis.com/oauth2/v2/userinfo',
+                headers={'Authorization': f'Bearer {access_token}'},
+                timeout=10,
+            )
+        # Conexión nueva por request (comportamiento original) y sesión con keep-alive
+        report("userinfo (requests.get)", measure(
+            lambda: requests.get('https://www.googleapis.com/oauth2/v2/userinfo',
+                                 headers={'Authorization': f'Bearer {access_token}'}, timeout=10),
+            USERINFO_ITERATIONS))
+        report("userinfo (sesión keep-alive)", measure(userinfo(requests.Session()), USERINFO_ITERATIONS))
+    else:
+        print("GOOGLE_ACCESS_TOKEN no definido: se omite la medición de userinfo")
+
+
+if __name__ == '__main__':
+    main()
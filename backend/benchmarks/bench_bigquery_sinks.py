@@ -0,0 +1,97 @@
+"""
+Benchmark de throughput de escritura: insert_rows_json vs Storage Write API.
+Envía N filas sintéticas desde varios hilos concurrentes (como requests de save_invoice)
+y reporta filas/segundo y latencia por fila.
+
+Uso (desde backend/, con credenciales de Google configuradas):
+    python benchmarks/bench_bigquery_sinks.py --project P --dataset D --table tabla_de_prueba
+    python benchmarks/bench_bigquery_sinks.py --sinks memory   # valida el harness sin BigQuery
+
+Usar siempre una tabla de prueba: el benchmark inserta filas reales.
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bigquery_sinks import create_sink  # noqa: E402
+
+
+def synthetic_row(i: int) -> dict:
+    return {
+        "id_caja": f"{i % 20:04d}",
+        "canal": "salon",
+        "codigo_tienda": f"{i % 150:03d}",
+        "tienda_nombre": "SAN MARTIN",
+        "fecha": "2024-11-06",
+        "hora": "16:05:47",
+        "ticket_electronico": str(74454216986289 + i),
+        "id_boleta": f"{i:08d}",
+        "id_check": str(uuid.uuid4()),
+        "monto_op_gravada": 2690.0,
+        "importe_total": 2690.0,
+        "recargo_consumo": 0.0,
+        "monto_tarifario": 0.0,
+        "mes": 11,
+        "anio": 2024,
+        "momento": "2024-11-06T16:05:47",
+        "a_c": "AC-04",
+        "fecha_carga": datetime.utcnow().isoformat() + 'Z',
+        "usuario_carga": "benchmark@example.com",
+    }
+
+
+def run(sink, rows: int, concurrency: int):
+    latencies = []
+
+    def save(i):
+        start = time.perf_counter()
+        errors = sink.insert_rows([synthetic_row(i)])
+        latencies.append(time.perf_counter() - start)
+        return errors
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        failed = sum(1 for errors in executor.map(save, range(rows)) if errors)
+    elapsed = time.perf_counter() - start
+    ordered = sorted(latencies)
+    print(f"{sink.name:<14} filas={rows} concurrencia={concurrency} errores={failed} "
+          f"throughput={rows / elapsed:8.1f} filas/s  p50={ordered[len(ordered) // 2] * 1000:7.1f}ms  "
+          f"p99={ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1000:7.1f}ms  "
+          f"media={statistics.mean(latencies) * 1000:7.1f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--project', default=os.getenv('BIGQUERY_PROJECT_ID'))
+    parser.add_argument('--dataset', default=os.getenv('BIGQUERY_DATASET_ID'))
+    parser.add_argument('--table', help="Tabla de prueba (mismo esquema que la tabla de facturas)")
+    parser.add_argument('--sinks', default='streaming,storage_write')
+    parser.add_argument('--rows', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=16)
+    args = parser.parse_args()
+
+    client = None
+    kinds = [kind.strip() for kind in args.sinks.split(',') if kind.strip()]
+    if any(kind != 'memory' for kind in kinds):
+        if not (args.project and args.dataset and args.table):
+            parser.error("--project, --dataset y --table son requeridos para sinks reales")
+        from google.cloud import bigquery
+        client = bigquery.Client(project=args.project)
+
+    for kind in kinds:
+        sink = create_sink(kind, client, args.project, args.dataset, args.table)
+        try:
+            run(sink, args.rows, args.concurrency)
+        finally:
+            sink.close()
+
+
+if __name__ == '__main__':
+    main()
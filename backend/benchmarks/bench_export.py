@@ -0,0 +1,71 @@
+"""
+Benchmark de la exportación en streaming (GET /api/export) contra la fuente fake en memoria:
+filas por segundo de CSV y Parquet y memoria pico del encoder según el tamaño del resultado.
+El pico no debería crecer con la cantidad de filas (solo con el tamaño de batch y la cola).
+
+Uso (desde backend/):
+    python benchmarks/bench_export.py
+"""
+import logging
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from invoice_archive import rows_to_table  # noqa: E402
+from invoice_export import EXPORT_COLUMNS, ExportFilters, ExportSession, MemoryReadSource, export_invoices  # noqa: E402
+
+BATCH_SIZE = int(os.getenv('BENCH_BATCH_SIZE', '2000'))
+SIZES = (20_000, 100_000, 400_000)
+
+
+def sample_rows(count):
+    return [{
+        "id_caja": "3", "canal": "salon", "codigo_tienda": f"{i % 40:03d}", "tienda_nombre": "SAN MARTIN",
+        "fecha": "2024-11-06", "hora": "12:30:00", "ticket_electronico": "74598230012345",
+        "id_boleta": str(100000 + i), "id_check": f"chk-{i}", "monto_op_gravada": 2690.0,
+        "importe_total": 2690.0, "recargo_consumo": 0.0, "monto_tarifario": 2690.0, "mes": 11, "anio": 2024,
+        "momento": "2024-11-06T12:30:00", "a_c": "12", "fecha_carga": "2024-11-06T12:31:00Z",
+        "usuario_carga": "finanzas@example.com",
+    } for i in range(count)]
+
+
+class RepeatingSource(MemoryReadSource):
+    """Repite un mismo batch para simular resultados grandes sin tenerlos en memoria"""
+
+    def __init__(self, total_rows):
+        super().__init__(lambda: [])
+        table = rows_to_table(sample_rows(BATCH_SIZE)).select(list(EXPORT_COLUMNS))
+        self.batch = table.to_batches()[0]
+        self.schema = table.schema
+        self.total_rows = total_rows
+
+    def open(self, filters, max_streams):
+        per_stream = self.total_rows // BATCH_SIZE // max_streams
+        return ExportSession(self.schema, [lambda: (self.batch for _ in range(per_stream))] * max_streams)
+
+
+def run(fmt, total_rows):
+    source = RepeatingSource(total_rows)
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+    written = sum(len(chunk) for chunk in export_invoices(source, ExportFilters(), fmt, max_streams=4))
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{fmt:<8} filas={total_rows:>8}  {elapsed:>6.2f}s  ({total_rows / elapsed:>9.0f} filas/s)  "
+          f"salida={written / 1e6:>7.1f}MB  pico={peak / 1e6:>6.1f}MB")
+
+
+def main():
+    logging.disable(logging.INFO)
+    for fmt in ("csv", "parquet"):
+        for size in SIZES:
+            run(fmt, size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+Benchmark de la detección de casi duplicados: búsqueda en NearDuplicateIndex (tabla multi-índice)
+contra un recorrido lineal, con distintas cantidades de imágenes recientes, y costo de dhash
+sobre una imagen real si se indica una (requiere Pillow).
+
+Uso (desde backend/):
+    python benchmarks/bench_image_dedup.py
+    python benchmarks/bench_image_dedup.py ticket.jpg
+"""
+import logging
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from image_dedup import NearDuplicateIndex, dhash, dedup_available, hamming  # noqa: E402
+
+ITERATIONS = int(os.getenv('BENCH_ITERATIONS', '2000'))
+MAX_DISTANCE = int(os.getenv('BENCH_MAX_DISTANCE', '6'))
+
+
+def measure(fn, iterations):
+    """Ejecutar fn N veces y retornar latencias en microsegundos"""
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1e6)
+    return samples
+
+
+def report(name, samples):
+    ordered = sorted(samples)
+    p50 = ordered[len(ordered) // 2]
+    p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+    print(f"{name:<40} n={len(samples):>6}  media={statistics.mean(samples):>9.2f}us  "
+          f"p50={p50:>9.2f}us  p99={p99:>9.2f}us  ({1e6 / statistics.mean(samples):>9.0f}/s)")
+
+
+def flip_bits(value: int, count: int) -> int:
+    for bit in random.sample(range(64), count):
+        value ^= 1 << bit
+    return value
+
+
+def main():
+    logging.disable(logging.INFO)
+    random.seed(42)
+    for size in (1000, 5000, 50000):
+        index = NearDuplicateIndex(max_distance=MAX_DISTANCE, max_entries=size)
+        hashes = [random.getrandbits(64) for _ in range(size)]
+        for i, value in enumerate(hashes):
+            index.add(value, {"i": i})
+        print(f"{size} imágenes recientes (max_distance={MAX_DISTANCE})")
+        report("  multi-índice: sin coincidencia", measure(lambda: index.find(random.getrandbits(64)), ITERATIONS))
+        report("  multi-índice: casi duplicado", measure(
+            lambda: index.find(flip_bits(random.choice(hashes), MAX_DISTANCE // 2)), ITERATIONS))
+        report("  recorrido lineal", measure(
+            lambda: min(hamming(random.getrandbits(64), other) for other in hashes), max(20, ITERATIONS // 20)))
+        print()
+
+    if len(sys.argv) > 1:
+        if not dedup_available():
+            print("Pillow no disponible: no se mide dhash")
+            return
+        with open(sys.argv[1], 'rb') as f:
+            content = f.read()
+        print(f"dhash de {sys.argv[1]} ({len(content) / 1024:.0f} KiB): {dhash(content):016x}")
+        report("  dhash", measure(lambda: dhash(content), max(20, ITERATIONS // 20)))
+
+
+if __name__ == '__main__':
+    main()
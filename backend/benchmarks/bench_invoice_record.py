@@ -0,0 +1,117 @@
+"""
+Benchmark de la representación de facturas: flujo anterior (dict del parser ->
+MappedInvoiceData -> serialización de FastAPI) contra InvoiceRecord (dataclass con slots
+serializada directo), más el costo de armar la fila de BigQuery y la memoria de un lote.
+
+Uso (desde backend/):
+    python benchmarks/bench_invoice_record.py
+    BENCH_BATCH=200000 python benchmarks/bench_invoice_record.py
+"""
+import json
+import logging
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+from typing import Dict, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+from pydantic import create_model  # noqa: E402
+from invoice_parser import parse_and_map_invoice  # noqa: E402
+import fast_json  # noqa: E402
+from invoice_record import InvoiceRecord  # noqa: E402
+
+ITERATIONS = int(os.getenv('BENCH_ITERATIONS', '20000'))
+BATCH = int(os.getenv('BENCH_BATCH', '50000'))
+
+SAMPLE_TEXT = (
+    "015 SAN MARTIN\nCaja 3\nFecha 06/11/24 Hora 16:05:47\nNro T. 00142012\n"
+    "CAE 74454216986289\nSUBTOTAL SIN DESCUENTOS $ 2.690,00\nTOTAL $ 2.690,00\nArt: x AC-04"
+)
+
+# Mismos campos y tipos que MappedInvoiceData / ValidatedInvoiceData de app.py
+_TYPES = {"id_check": (str, ...), "monto_op_gravada": (float, 0.0), "importe_total": (float, 0.0),
+          "recargo_consumo": (float, 0.0), "monto_tarifario": (float, 0.0),
+          "mes": (Optional[int], None), "anio": (Optional[int], None),
+          "confidence": (Optional[Dict[str, float]], None), "incomplete": (bool, False)}
+MappedModel = create_model('MappedModel', **{
+    name: _TYPES.get(name, (Optional[str], None)) for name in InvoiceRecord.FIELDS
+})
+ValidatedModel = create_model('ValidatedModel', **{
+    name: _TYPES.get(name, (Optional[str], None)) for name in InvoiceRecord.FIELDS
+    if name not in ('raw_extracted_text', 'confidence', 'incomplete')
+})
+
+
+def measure(fn, iterations):
+    """Ejecutar fn N veces y retornar latencias en microsegundos"""
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1e6)
+    return samples
+
+
+def report(name, samples):
+    ordered = sorted(samples)
+    p50 = ordered[len(ordered) // 2]
+    p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+    print(f"{name:<40} n={len(samples):>6}  media={statistics.mean(samples):>9.2f}us  "
+          f"p50={p50:>9.2f}us  p99={p99:>9.2f}us  ({1e6 / statistics.mean(samples):>9.0f}/s)")
+
+
+def batch_memory(build):
+    """Memoria (MiB) retenida por un lote de BATCH facturas construido con build(i)"""
+    tracemalloc.start()
+    items = [build(i) for i in range(BATCH)]
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del items
+    return current / (1024 * 1024)
+
+
+def main():
+    logging.disable(logging.INFO)
+    record = parse_and_map_invoice(SAMPLE_TEXT)
+    record.raw_extracted_text = SAMPLE_TEXT
+    parsed_dict = record.to_dict()
+    print(f"backend JSON: {fast_json.backend}\n")
+
+    # Respuesta de /api/process-invoice
+    def previous_response():
+        data = dict(parsed_dict)
+        model = MappedModel(**data)
+        return json.dumps(jsonable_encoder(model), ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    report("respuesta: dict -> Pydantic -> JSON", measure(previous_response, ITERATIONS))
+    report("respuesta: InvoiceRecord.to_json", measure(record.to_json, ITERATIONS))
+
+    # Fila de BigQuery en /api/save-invoice (el request sigue validándose con Pydantic)
+    validated = ValidatedModel(**{k: v for k, v in parsed_dict.items() if k != 'raw_extracted_text'})
+
+    def previous_row():
+        row = {name: getattr(validated, name) for name in InvoiceRecord.BQ_FIELDS}
+        for name in ("monto_op_gravada", "importe_total", "recargo_consumo", "monto_tarifario"):
+            row[name] = float(row[name])
+        row.update({"fecha_carga": "2024-11-06T10:00:00Z", "usuario_carga": "a@b.com"})
+        return row
+
+    report("fila BigQuery: dict literal", measure(previous_row, ITERATIONS))
+    report("fila BigQuery: InvoiceRecord.bq_row", measure(
+        lambda: InvoiceRecord.bq_row(validated, "2024-11-06T10:00:00Z", "a@b.com"), ITERATIONS))
+
+    # Parser completo (texto -> registro)
+    report("parse_and_map_invoice", measure(lambda: parse_and_map_invoice(SAMPLE_TEXT), ITERATIONS // 4))
+
+    print(f"\nMemoria de un lote de {BATCH} facturas:")
+    print(f"  dict                 {batch_memory(lambda i: dict(parsed_dict, id_check=str(i))):>8.1f} MiB")
+    print(f"  MappedInvoiceData    {batch_memory(lambda i: MappedModel(**dict(parsed_dict, id_check=str(i)))):>8.1f} MiB")
+    print(f"  InvoiceRecord        {batch_memory(lambda i: InvoiceRecord(**dict(parsed_dict, id_check=str(i)))):>8.1f} MiB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+Benchmark de la capa JSON: json estándar contra orjson / msgspec (los que estén instalados)
+con payloads del tamaño real de la API: respuesta de n8n (texto crudo y array clave/valor),
+respuesta de /api/process-invoice, páginas de /api/invoices y el archivo de usuarios.
+
+Uso (desde backend/):
+    python benchmarks/bench_json.py
+    BENCH_ITERATIONS=20000 python benchmarks/bench_json.py
+"""
+import logging
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fast_json  # noqa: E402
+from invoice_parser import parse_and_map_invoice  # noqa: E402
+from invoice_record import InvoiceRecord  # noqa: E402
+
+ITERATIONS = int(os.getenv('BENCH_ITERATIONS', '5000'))
+
+SAMPLE_TEXT = (
+    "015 SAN MARTIN\nCaja 3\nFecha 06/11/24 Hora 16:05:47\nNro T. 00142012\n"
+    "CAE 74454216986289\nSUBTOTAL SIN DESCUENTOS $ 2.690,00\nTOTAL $ 2.690,00\nArt: x AC-04"
+)
+
+
+def measure(fn, iterations):
+    """Ejecutar fn N veces y retornar latencias en microsegundos"""
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1e6)
+    return samples
+
+
+def report(name, samples):
+    ordered = sorted(samples)
+    p50 = ordered[len(ordered) // 2]
+    p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+    print(f"{name:<44} n={len(samples):>6}  media={statistics.mean(samples):>9.2f}us  "
+          f"p50={p50:>9.2f}us  p99={p99:>9.2f}us  ({1e6 / statistics.mean(samples):>9.0f}/s)")
+
+
+def payloads():
+    """Payloads representativos (nombre, objeto)"""
+    record = parse_and_map_invoice(SAMPLE_TEXT)
+    record.raw_extracted_text = SAMPLE_TEXT
+    row = InvoiceRecord.bq_row(record, "2024-11-06T10:00:00Z", "cajero@empresa.com")
+    structured = [{"clave": f"Campo número {i}", "valor": f"Valor con acentos ñ {i * 37}"} for i in range(40)]
+    return [
+        ("n8n texto crudo", {"extracted_text": SAMPLE_TEXT * 3}),
+        ("n8n clave/valor (40 items)", [{"data": structured}]),
+        ("process-invoice (1 registro)", record.to_dict()),
+        ("api/invoices (50 filas)", {"items": [dict(row, id_check=str(i)) for i in range(50)], "next_cursor": "x"}),
+        ("api/invoices (500 filas)", {"items": [dict(row, id_check=str(i)) for i in range(500)], "next_cursor": None}),
+        ("authorized_users.json (300 usuarios)", {
+            "authorized_emails": [f"usuario{i}@empresa.com" for i in range(300)],
+            "superadmin_emails": ["admin@empresa.com"],
+            "session_versions": {f"usuario{i}@empresa.com": i for i in range(0, 300, 7)},
+        }),
+    ]
+
+
+def main():
+    logging.disable(logging.INFO)
+    available = [name for name, ok in fast_json._available_backends().items() if ok]
+    print(f"backends disponibles: {', '.join(available)}\n")
+
+    for name, obj in payloads():
+        fast_json.set_backend(fast_json.BACKEND_STDLIB)
+        encoded = fast_json.dumps(obj)
+        print(f"{name} ({len(encoded) / 1024:.1f} KiB)")
+        for backend in available:
+            fast_json.set_backend(backend)
+            report(f"  {backend} dumps", measure(lambda: fast_json.dumps(obj), ITERATIONS))
+            report(f"  {backend} loads (bytes)", measure(lambda: fast_json.loads(encoded), ITERATIONS))
+        print()
+
+    record = parse_and_map_invoice(SAMPLE_TEXT)
+    print("InvoiceRecord (decodificación tipada)")
+    for backend in available:
+        fast_json.set_backend(backend)
+        encoded = record.to_json()
+        report(f"  {backend} to_json", measure(record.to_json, ITERATIONS))
+        report(f"  {backend} from_json", measure(lambda: InvoiceRecord.from_json(encoded), ITERATIONS))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""
+Benchmark del OCR local (Tesseract) contra respuestas grabadas de n8n.
+Usa grabaciones hechas con OCR_RECORD_ENABLED=true y OCR_RECORD_STORE_IMAGES=true: corre
+Tesseract sobre cada imagen guardada, parsea el texto y compara campo por campo con la salida
+que produjo n8n. Reporta throughput, latencias y exactitud por campo.
+
+Uso (desde backend/):
+    python benchmarks/bench_ocr_engines.py data/recordings
+    BENCH_WORKERS=4 BENCH_LIMIT=200 python benchmarks/bench_ocr_engines.py data/recordings
+"""
+import glob
+import logging
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from n8n_formats import detect_and_parse, StructuredDataError  # noqa: E402
+from ocr_engines import TesseractEngine, tesseract_available  # noqa: E402
+from ocr_recorder import iter_recordings, compare_outputs  # noqa: E402
+
+WORKERS = int(os.getenv('BENCH_WORKERS', str(os.cpu_count() or 2)))
+LIMIT = int(os.getenv('BENCH_LIMIT', '0'))
+LANG = os.getenv('BENCH_LANG', 'spa')
+
+# Campos que importan para validar y guardar la factura
+KEY_FIELDS = ('codigo_tienda', 'fecha', 'hora', 'importe_total', 'id_boleta', 'ticket_electronico')
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] if ordered else 0.0
+
+
+def load_cases(paths):
+    """(grabación, bytes de la imagen) para las grabaciones con salida de n8n e imagen guardada"""
+    cases = []
+    for entry in iter_recordings(paths):
+        if not entry.get("parsed") or not entry.get("image_sha256"):
+            continue
+        for directory in paths:
+            matches = glob.glob(os.path.join(directory, 'images', f"{entry['image_sha256']}.*"))
+            if matches:
+                with open(matches[0], 'rb') as f:
+                    cases.append((entry, f.read()))
+                break
+        if LIMIT and len(cases) >= LIMIT:
+            break
+    return cases
+
+
+def main():
+    logging.disable(logging.INFO)
+    paths = sys.argv[1:] or [os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'recordings')]
+    if not tesseract_available():
+        print("Tesseract no disponible: instalar pytesseract, Pillow y el binario tesseract")
+        sys.exit(1)
+    cases = load_cases(paths)
+    if not cases:
+        print("No hay grabaciones con imagen (grabar con OCR_RECORD_STORE_IMAGES=true)")
+        sys.exit(1)
+
+    engine = TesseractEngine(workers=WORKERS, lang=LANG)
+    # Calentar el pool (arranque de procesos e import de Tesseract fuera de la medición)
+    engine.extract("warmup", cases[0][1], cases[0][0].get("content_type") or "image/jpeg")
+
+    latencies = []
+    field_hits = {field: 0 for field in KEY_FIELDS}
+    exact = 0
+    failed = 0
+
+    def run(case):
+        entry, content = case
+        started = time.perf_counter()
+        response, _ = engine.extract(entry.get("filename") or "", content, entry.get("content_type") or "image/jpeg")
+        elapsed = time.perf_counter() - started
+        try:
+            mapped, _ = detect_and_parse(response)
+        except StructuredDataError:
+            mapped = None
+        return entry, mapped, elapsed
+
+    # Un hilo por worker mantiene ocupados todos los procesos del pool de Tesseract
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+        for future in as_completed([pool.submit(run, case) for case in cases]):
+            try:
+                entry, mapped, elapsed = future.result()
+            except Exception:
+                failed += 1
+                continue
+            latencies.append(elapsed)
+            differences = compare_outputs(entry["parsed"], mapped.to_dict() if mapped else None)
+            if not differences:
+                exact += 1
+            for field in KEY_FIELDS:
+                if mapped is not None and field not in differences:
+                    field_hits[field] += 1
+    total_seconds = time.perf_counter() - start_time
+    engine.close()
+
+    ordered = sorted(latencies)
+    n8n_ms = sorted(entry.get("n8n_ms") or 0 for entry, _ in cases)
+    print(f"Imágenes: {len(cases)}  workers: {WORKERS}  fallidas: {failed}")
+    print(f"Tesseract: {len(latencies) / total_seconds:.2f} imágenes/s  "
+          f"p50={percentile(ordered, 0.5) * 1000:.0f}ms  p99={percentile(ordered, 0.99) * 1000:.0f}ms  "
+          f"media={statistics.mean(ordered) * 1000 if ordered else 0:.0f}ms")
+    print(f"n8n (grabado): p50={percentile(n8n_ms, 0.5):.0f}ms  p99={percentile(n8n_ms, 0.99):.0f}ms")
+    print(f"\nSalida idéntica a n8n: {exact}/{len(cases)} ({exact / len(cases):.0%})")
+    for field in KEY_FIELDS:
+        print(f"  {field:<20} {field_hits[field] / len(cases):>6.0%}")
+
+
+if __name__ == '__main__':
+    main()
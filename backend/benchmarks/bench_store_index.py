@@ -0,0 +1,100 @@
+"""
+Benchmark del maestro de tiendas: resolución por código exacto y por nombre con ruido de OCR
+(índice de trigramas contra comparar con todas las tiendas), con maestros sintéticos de
+distintos tamaños o con un archivo real si se indica uno.
+
+Uso (desde backend/):
+    python benchmarks/bench_store_index.py
+    python benchmarks/bench_store_index.py data/tiendas.csv
+"""
+import logging
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from store_index import StoreIndex, load_store_file, normalize_name, trigrams  # noqa: E402
+
+ITERATIONS = int(os.getenv('BENCH_ITERATIONS', '5000'))
+
+SYLLABLES = ['SAN', 'MAR', 'TIN', 'BEL', 'GRA', 'NO', 'PA', 'LER', 'MO', 'RO', 'SA', 'RIO', 'COR', 'DO', 'BA',
+             'MEN', 'ZA', 'VI', 'LLA', 'PAR', 'QUE', 'LO', 'MAS', 'RI', 'VA', 'DA', 'VIA', 'TE', 'CEN', 'TRO']
+COMMON_WORDS = ['CENTRO', 'NORTE', 'SUR', 'PLAZA', 'AVENIDA', 'SHOPPING', 'ESTACION', 'PUERTO']
+# Sustituciones típicas del OCR
+NOISE = {'I': 'l', 'O': '0', 'S': '5', 'B': '8', 'E': 'F', 'N': 'M'}
+
+
+def measure(fn, iterations):
+    """Ejecutar fn N veces y retornar latencias en microsegundos"""
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1e6)
+    return samples
+
+
+def report(name, samples):
+    ordered = sorted(samples)
+    p50 = ordered[len(ordered) // 2]
+    p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+    print(f"{name:<40} n={len(samples):>6}  media={statistics.mean(samples):>9.2f}us  "
+          f"p50={p50:>9.2f}us  p99={p99:>9.2f}us  ({1e6 / statistics.mean(samples):>9.0f}/s)")
+
+
+def synthetic_stores(count):
+    """Nombres de 2-3 palabras: inventadas con sílabas (barrios, calles) y algunas comunes"""
+    stores, names = [], set()
+    while len(stores) < count:
+        words = [''.join(random.choices(SYLLABLES, k=random.randint(2, 4))) for _ in range(random.randint(1, 2))]
+        if random.random() < 0.5:
+            words.append(random.choice(COMMON_WORDS))
+        name = ' '.join(words)
+        if name not in names:
+            names.add(name)
+            stores.append((str(len(stores) + 1).zfill(3), name))
+    return stores
+
+
+def noisy(name):
+    chars = list(name)
+    for i in random.sample(range(len(chars)), k=min(2, len(chars))):
+        chars[i] = NOISE.get(chars[i], chars[i])
+    return ''.join(chars)
+
+
+def linear_best(stores_grams, name):
+    query = trigrams(normalize_name(name))
+    return max(range(len(stores_grams)), key=lambda i: len(query & stores_grams[i]) / len(query | stores_grams[i]))
+
+
+def run(stores, label):
+    index = StoreIndex(lambda: stores)
+    index.refresh()
+    queries = [(code, noisy(name)) for code, name in random.choices(stores, k=500)]
+    hits = sum(1 for code, name in queries if (match := index.resolve(None, name)) and match.codigo_tienda == code)
+    print(f"{label}: {len(index)} tiendas, nombre con ruido resuelto bien en {hits / len(queries):.0%}")
+    report("  código exacto", measure(lambda: index.resolve(random.choice(stores)[0], None), ITERATIONS))
+    report("  código + nombre", measure(lambda: index.resolve(*random.choice(queries)), ITERATIONS))
+    report("  nombre (trigramas)", measure(lambda: index.resolve(None, random.choice(queries)[1]), ITERATIONS))
+    stores_grams = [trigrams(normalize_name(name)) for _, name in stores]
+    report("  nombre (recorrido lineal)", measure(
+        lambda: linear_best(stores_grams, random.choice(queries)[1]), max(20, ITERATIONS // 50)))
+    print()
+
+
+def main():
+    logging.disable(logging.INFO)
+    random.seed(42)
+    if len(sys.argv) > 1:
+        run(load_store_file(sys.argv[1]), sys.argv[1])
+        return
+    for size in (100, 1000, 5000):
+        run(synthetic_stores(size), "sintético")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,342 @@
+"""
+Destinos (sinks) para las filas de facturas guardadas en BigQuery.
+- StreamingInsertSink: insert_rows_json (streaming insert clásico)
+- StorageWriteSink: Storage Write API con un stream persistente, batching y offsets
+- MemorySink: fake local para pruebas y benchmarks
+Todos implementan InvoiceSink.insert_rows y retornan errores con el formato de insert_rows_json.
+"""
+import logging
+import queue
+import threading
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import Future
+from datetime import date, datetime, timezone
+from typing import Dict, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Esquema de la fila construida en save_invoice (nombre, tipo BigQuery)
+INVOICE_ROW_SCHEMA: Sequence[Tuple[str, str]] = (
+    ("id_caja", "STRING"),
+    ("canal", "STRING"),
+    ("codigo_tienda", "STRING"),
+    ("tienda_nombre", "STRING"),
+    ("fecha", "DATE"),
+    ("hora", "TIME"),
+    ("ticket_electronico", "STRING"),
+    ("id_boleta", "STRING"),
+    ("id_check", "STRING"),
+    ("monto_op_gravada", "FLOAT"),
+    ("importe_total", "FLOAT"),
+    ("recargo_consumo", "FLOAT"),
+    ("monto_tarifario", "FLOAT"),
+    ("mes", "INTEGER"),
+    ("anio", "INTEGER"),
+    ("momento", "DATETIME"),
+    ("a_c", "STRING"),
+    ("fecha_carga", "TIMESTAMP"),
+    ("usuario_carga", "STRING"),
+)
+
+_EPOCH = date(1970, 1, 1)
+
+
+class InvoiceSink(ABC):
+    """Interfaz de destino para filas de facturas"""
+
+    name = "base"
+
+    @abstractmethod
+    def insert_rows(self, rows: List[Dict]) -> List[Dict]:
+        """Insertar filas. Retorna lista de errores (vacía si todo se insertó)."""
+
+    def close(self):
+        """Liberar recursos (streams, hilos)"""
+
+    def pending(self) -> int:
+        """Filas retenidas en memoria (en cola o, en el fake, guardadas)"""
+        return 0
+
+
+class StreamingInsertSink(InvoiceSink):
+    """Streaming insert clásico con insert_rows_json (comportamiento original)"""
+
+    name = "streaming"
+
+    def __init__(self, client, table_id: str):
+        self.client = client
+        self.table_id = table_id
+
+    def insert_rows(self, rows: List[Dict]) -> List[Dict]:
+        return self.client.insert_rows_json(self.table_id, rows)
+
+
+class MemorySink(InvoiceSink):
+    """Fake en memoria para pruebas: guarda las filas y simula latencia opcional"""
+
+    name = "memory"
+
+    def __init__(self, latency_seconds: float = 0.0):
+        self.latency_seconds = latency_seconds
+        self.rows: List[Dict] = []
+        self._lock = threading.Lock()
+
+    def insert_rows(self, rows: List[Dict]) -> List[Dict]:
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+        with self._lock:
+            self.rows.extend(rows)
+        return []
+
+    def pending(self) -> int:
+        return len(self.rows)
+
+
+def build_row_message_class(schema: Sequence[Tuple[str, str]] = INVOICE_ROW_SCHEMA):
+    """Construir dinámicamente la clase protobuf (proto2) que representa una fila"""
+    from google.protobuf import descriptor_pb2, descriptor_pool, message_factory
+
+    proto_types = {
+        "STRING": descriptor_pb2.FieldDescriptorProto.TYPE_STRING,
+        "DATE": descriptor_pb2.FieldDescriptorProto.TYPE_INT32,  # días desde epoch
+        "TIME": descriptor_pb2.FieldDescriptorProto.TYPE_STRING,  # HH:MM:SS
+        "DATETIME": descriptor_pb2.FieldDescriptorProto.TYPE_STRING,  # YYYY-MM-DDTHH:MM:SS
+        "TIMESTAMP": descriptor_pb2.FieldDescriptorProto.TYPE_INT64,  # microsegundos desde epoch
+        "FLOAT": descriptor_pb2.FieldDescriptorProto.TYPE_DOUBLE,
+        "INTEGER": descriptor_pb2.FieldDescriptorProto.TYPE_INT64,
+    }
+    file_proto = descriptor_pb2.FileDescriptorProto(
+        name="ngr_invoice_row.proto", package="ngr", syntax="proto2"
+    )
+    message_proto = file_proto.message_type.add(name="InvoiceRow")
+    for number, (name, field_type) in enumerate(schema, start=1):
+        message_proto.field.add(
+            name=name,
+            number=number,
+            type=proto_types[field_type],
+            label=descriptor_pb2.FieldDescriptorProto.LABEL_OPTIONAL,
+        )
+    pool = descriptor_pool.DescriptorPool()
+    pool.Add(file_proto)
+    return message_factory.GetMessageClass(pool.FindMessageTypeByName("ngr.InvoiceRow"))
+
+
+def encode_row(message_class, row: Dict, schema: Sequence[Tuple[str, str]] = INVOICE_ROW_SCHEMA) -> bytes:
+    """Serializar una fila (dict con el formato de insert_rows_json) a protobuf"""
+    message = message_class()
+    for name, field_type in schema:
+        value = row.get(name)
+        if value is None:
+            continue  # Campo no seteado = NULL en BigQuery
+        if field_type == "DATE":
+            value = (date.fromisoformat(value) - _EPOCH).days
+        elif field_type == "TIMESTAMP":
+            parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+            if parsed.tzinfo is None:
+                parsed = parsed.replace(tzinfo=timezone.utc)
+            value = int(parsed.timestamp() * 1_000_000)
+        setattr(message, name, value)
+    return message.SerializeToString()
+
+
+class StorageWriteSink(InvoiceSink):
+    """
+    Storage Write API con un stream COMMITTED de larga duración.
+    Un hilo agrupa las filas de varios requests en un solo append con offset explícito
+    (exactly-once: un reintento con el mismo offset no duplica filas) y reconecta el
+    stream ante errores.
+    """
+
+    name = "storage_write"
+
+    def __init__(self, project_id: str, dataset_id: str, table_id: str,
+                 batch_size: int = 50, linger_seconds: float = 0.05, max_attempts: int = 3,
+                 client=None):
+        if client is None:
+            # Import diferido: google-cloud-bigquery-storage es una dependencia opcional
+            from google.cloud import bigquery_storage_v1
+            client = bigquery_storage_v1.BigQueryWriteClient()
+
+        self.client = client
+        self.parent = self.client.table_path(project_id, dataset_id, table_id)
+        self.batch_size = batch_size
+        self.linger_seconds = linger_seconds
+        self.max_attempts = max_attempts
+        self.message_class = build_row_message_class()
+        self._queue: "queue.Queue[Tuple[Dict, Future]]" = queue.Queue()
+        self._stream = None
+        self._stream_name: Optional[str] = None
+        self._offset = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._writer_loop, name="bq-storage-write", daemon=True)
+        self._thread.start()
+
+    def insert_rows(self, rows: List[Dict]) -> List[Dict]:
+        futures = []
+        for row in rows:
+            future: Future = Future()
+            self._queue.put((row, future))
+            futures.append(future)
+        errors = []
+        for index, future in enumerate(futures):
+            try:
+                future.result()
+            except Exception as e:
+                errors.append({"index": index, "errors": [{"reason": "storageWrite", "message": str(e)}]})
+        return errors
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def close(self):
+        self._stop.set()
+        self._thread.join(timeout=5)
+        self._close_stream()
+
+    def _open_stream(self):
+        """
+        Conectar la sesión bidireccional de appends. Reutiliza el write stream existente
+        (manteniendo el offset) y solo crea uno nuevo si no hay stream o el anterior se invalidó.
+        """
+        from google.cloud.bigquery_storage_v1 import types
+        from google.protobuf import descriptor_pb2
+
+        if self._stream_name is None:
+            write_stream = types.WriteStream()
+            write_stream.type_ = types.WriteStream.Type.COMMITTED
+            write_stream = self.client.create_write_stream(parent=self.parent, write_stream=write_stream)
+            self._stream_name = write_stream.name
+            self._offset = 0
+            logger.info(f"✅ Stream de Storage Write creado: {write_stream.name}")
+
+        proto_descriptor = descriptor_pb2.DescriptorProto()
+        self.message_class.DESCRIPTOR.CopyToProto(proto_descriptor)
+        proto_data = types.AppendRowsRequest.ProtoData()
+        proto_data.writer_schema = types.ProtoSchema(proto_descriptor=proto_descriptor)
+        request_template = types.AppendRowsRequest(write_stream=self._stream_name, proto_rows=proto_data)
+
+        self._stream = self._connect(request_template)
+
+    def _connect(self, request_template):
+        """Abrir la conexión bidireccional de appends (las pruebas la reemplazan por un fake)"""
+        from google.cloud.bigquery_storage_v1 import writer
+
+        return writer.AppendRowsStream(self.client, request_template)
+
+    def _close_stream(self):
+        if self._stream is not None:
+            try:
+                self._stream.close()
+            except Exception as e:
+                logger.warning(f"⚠️ Error al cerrar stream de Storage Write: {e}")
+        self._stream = None
+
+    def _next_batch(self) -> List[Tuple[Dict, Future]]:
+        try:
+            batch = [self._queue.get(timeout=0.5)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.linger_seconds
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _append(self, serialized_rows: List[bytes], retrying: bool):
+        """
+        Enviar un batch en el offset actual. Con retrying=True un intento anterior de este
+        mismo batch pudo llegar al stream, así que AlreadyExists significa que ya está escrito.
+        """
+        from google.api_core import exceptions as api_exceptions
+        from google.cloud.bigquery_storage_v1 import types
+
+        request = types.AppendRowsRequest()
+        request.offset = self._offset
+        proto_data = types.AppendRowsRequest.ProtoData()
+        proto_data.rows = types.ProtoRows(serialized_rows=serialized_rows)
+        request.proto_rows = proto_data
+        try:
+            self._stream.send(request).result()
+        except api_exceptions.AlreadyExists:
+            if not retrying:
+                # Nadie de este batch escribió ese offset: el offset local quedó desfasado
+                raise
+            # El offset ya fue escrito (reintento de un append que sí llegó): no duplicar
+            logger.info(f"Offset {self._offset} ya escrito en {self._stream_name}, se omite")
+        self._offset += len(serialized_rows)
+
+    def _writer_loop(self):
+        from google.api_core import exceptions as api_exceptions
+
+        while not self._stop.is_set():
+            batch = self._next_batch()
+            if not batch:
+                continue
+            # Una fila que no se puede codificar falla sola: el resto del batch se escribe igual
+            encoded = []
+            serialized_rows = []
+            for row, future in batch:
+                try:
+                    serialized_rows.append(encode_row(self.message_class, row))
+                except Exception as e:
+                    future.set_exception(e)
+                    continue
+                encoded.append((row, future))
+            batch = encoded
+            if not batch:
+                continue
+
+            last_error = None
+            # True si un intento anterior de este batch pudo escribirse en el stream actual
+            maybe_written = False
+            for attempt in range(1, self.max_attempts + 1):
+                sent = False
+                try:
+                    if self._stream is None:
+                        self._open_stream()
+                    sent = True
+                    self._append(serialized_rows, retrying=maybe_written)
+                    last_error = None
+                    break
+                except Exception as e:
+                    last_error = e
+                    logger.warning(f"⚠️ Error en append a Storage Write (intento {attempt}): {e}. Reconectando...")
+                    # La conexión con error queda inutilizable: reconectar al mismo stream y
+                    # reintentar el mismo offset (si ya se había escrito, AlreadyExists lo evita)
+                    self._close_stream()
+                    if isinstance(e, (api_exceptions.NotFound, api_exceptions.FailedPrecondition,
+                                      api_exceptions.AlreadyExists)):
+                        # Stream finalizado, inexistente o con offset desfasado: crear uno nuevo
+                        self._stream_name = None
+                        maybe_written = False
+                    elif sent:
+                        maybe_written = True
+                    if attempt < self.max_attempts:
+                        time.sleep(min(2 ** attempt * 0.1, 2))
+            if last_error is not None and maybe_written:
+                # No se sabe si el último append llegó: si llegó, ese offset ya está ocupado y el
+                # próximo batch recibiría un AlreadyExists ajeno. Se abre un stream nuevo.
+                logger.warning(f"⚠️ Append sin confirmar en {self._stream_name} tras {self.max_attempts} "
+                               f"intentos: el próximo batch usará un stream nuevo")
+                self._stream_name = None
+            for _, future in batch:
+                if last_error is None:
+                    future.set_result(None)
+                else:
+                    future.set_exception(last_error)
+
+
+def create_sink(kind: str, client, project_id: str, dataset_id: str, table_id: str,
+                batch_size: int = 50, linger_seconds: float = 0.05) -> InvoiceSink:
+    """Crear el sink configurado ('streaming', 'storage_write' o 'memory')"""
+    if kind == StorageWriteSink.name:
+        return StorageWriteSink(project_id, dataset_id, table_id, batch_size, linger_seconds)
+    if kind == MemorySink.name:
+        return MemorySink()
+    return StreamingInsertSink(client, f"{project_id}.{dataset_id}.{table_id}")
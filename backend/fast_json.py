@@ -0,0 +1,181 @@
+"""
+Capa de serialización JSON intercambiable.
+Usa orjson o msgspec cuando están instalados (codifican/decodifican directo desde bytes, varias
+veces más rápido que la librería estándar) y cae a json estándar si no hay ninguno. El backend
+se elige una vez al arrancar; todas las funciones mantienen la misma salida en cualquiera de ellos.
+"""
+import dataclasses
+import json
+import logging
+from datetime import date, datetime, time as dt_time
+from decimal import Decimal
+from typing import Dict, Type, TypeVar, Union
+
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:  # orjson es opcional
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:  # msgspec es opcional
+    msgspec = None
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+BACKEND_ORJSON = "orjson"
+BACKEND_MSGSPEC = "msgspec"
+BACKEND_STDLIB = "json"
+
+
+def _available_backends() -> Dict[str, bool]:
+    return {BACKEND_ORJSON: orjson is not None, BACKEND_MSGSPEC: msgspec is not None, BACKEND_STDLIB: True}
+
+
+def _default(obj):
+    """Tipos que ningún backend serializa de forma nativa igual (Decimal, registros con to_dict)"""
+    if isinstance(obj, Decimal):
+        return float(obj)
+    if isinstance(obj, (datetime, date, dt_time)):
+        return obj.isoformat()
+    if hasattr(obj, 'to_dict'):
+        return obj.to_dict()
+    if dataclasses.is_dataclass(obj):
+        return dataclasses.asdict(obj)
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError(f"Objeto de tipo {type(obj).__name__} no serializable a JSON")
+
+
+# --- json estándar ---
+
+def _stdlib_dumps(obj, indent: bool = False) -> bytes:
+    if indent:
+        return json.dumps(obj, ensure_ascii=False, indent=2, default=_default).encode('utf-8')
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':'), default=_default).encode('utf-8')
+
+
+def _stdlib_loads(data: Union[bytes, str]):
+    return json.loads(data)
+
+
+# --- orjson ---
+
+def _orjson_dumps(obj, indent: bool = False) -> bytes:
+    option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0)
+    try:
+        return orjson.dumps(obj, default=_default, option=option)
+    except TypeError:
+        # Enteros de más de 64 bits u otros casos que orjson rechaza
+        return _stdlib_dumps(obj, indent)
+
+
+def _orjson_loads(data: Union[bytes, str]):
+    return orjson.loads(data)
+
+
+# --- msgspec ---
+
+_msgspec_encoder = None
+_msgspec_decoder = None
+
+
+def _msgspec_dumps(obj, indent: bool = False) -> bytes:
+    try:
+        encoded = _msgspec_encoder.encode(obj)
+    except (TypeError, OverflowError, msgspec.EncodeError):
+        return _stdlib_dumps(obj, indent)
+    return msgspec.json.format(encoded, indent=2) if indent else encoded
+
+
+def _msgspec_loads(data: Union[bytes, str]):
+    try:
+        return _msgspec_decoder.decode(data)
+    except msgspec.DecodeError as e:
+        # Misma excepción que json/orjson para que los llamadores no dependan del backend
+        raise ValueError(str(e)) from e
+
+
+_dumps = _stdlib_dumps
+_loads = _stdlib_loads
+_typed_decoders: Dict[type, object] = {}
+backend = BACKEND_STDLIB
+
+
+def set_backend(name: str = "auto") -> str:
+    """
+    Elegir el backend: "auto" (orjson > msgspec > json), "orjson", "msgspec" o "json".
+    Si el pedido no está instalado se usa el mejor disponible. Retorna el backend activo.
+    """
+    global _dumps, _loads, backend, _msgspec_encoder, _msgspec_decoder
+    available = _available_backends()
+    name = (name or "auto").strip().lower()
+    if name not in available or not available[name]:
+        if name not in ("auto", ""):
+            logger.warning(f"⚠️ Backend JSON '{name}' no disponible, se usa el mejor instalado")
+        name = next(candidate for candidate, ok in available.items() if ok)
+
+    if name == BACKEND_ORJSON:
+        _dumps, _loads = _orjson_dumps, _orjson_loads
+    elif name == BACKEND_MSGSPEC:
+        _msgspec_encoder = msgspec.json.Encoder(enc_hook=_default)
+        _msgspec_decoder = msgspec.json.Decoder()
+        _dumps, _loads = _msgspec_dumps, _msgspec_loads
+    else:
+        _dumps, _loads = _stdlib_dumps, _stdlib_loads
+    _typed_decoders.clear()
+    backend = name
+    return backend
+
+
+def dumps(obj, indent: bool = False) -> bytes:
+    """Serializar a JSON UTF-8 (compacto, o con sangría de 2 espacios si indent=True)"""
+    return _dumps(obj, indent)
+
+
+def dumps_str(obj, indent: bool = False) -> str:
+    return _dumps(obj, indent).decode('utf-8')
+
+
+def loads(data: Union[bytes, bytearray, memoryview, str]):
+    """Decodificar JSON desde bytes o str. Errores de formato: ValueError en todos los backends."""
+    if isinstance(data, (bytearray, memoryview)):
+        data = bytes(data)
+    return _loads(data)
+
+
+def loads_as(data: Union[bytes, str], cls: Type[T]) -> T:
+    """
+    Decodificar un objeto JSON directo a una dataclass (ej. InvoiceRecord).
+    Con msgspec se decodifica y valida tipos en un solo paso sin dict intermedio;
+    con los demás backends se filtran las claves desconocidas y se construye la instancia.
+    """
+    if backend == BACKEND_MSGSPEC:
+        decoder = _typed_decoders.get(cls)
+        if decoder is None:
+            decoder = _typed_decoders[cls] = msgspec.json.Decoder(cls)
+        try:
+            return decoder.decode(data)
+        except msgspec.DecodeError as e:
+            raise ValueError(str(e)) from e
+    obj = loads(data)
+    if not isinstance(obj, dict):
+        raise ValueError(f"Se esperaba un objeto JSON para {cls.__name__}")
+    names = _typed_decoders.get(cls)
+    if names is None:
+        names = _typed_decoders[cls] = frozenset(f.name for f in dataclasses.fields(cls))
+    return cls(**{key: value for key, value in obj.items() if key in names})
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse que serializa con el backend activo (default_response_class de la app)"""
+
+    def render(self, content) -> bytes:
+        return _dumps(content, False)
+
+
+set_backend("auto")
@@ -0,0 +1,139 @@
+"""
+Verificación local de ID tokens de Google (JWT firmados con RS256).
+Los certificados públicos de Google se cachean por 'kid' y se refrescan en segundo plano
+según el Cache-Control de la respuesta, así la validación de un token no requiere red.
+"""
+import base64
+import json
+import logging
+import re
+import threading
+import time
+from typing import Dict, Optional
+
+from google.auth import crypt
+
+logger = logging.getLogger(__name__)
+
+GOOGLE_CERTS_URL = 'https://www.googleapis.com/oauth2/v1/certs'
+GOOGLE_ISSUERS = ('accounts.google.com', 'https://accounts.google.com')
+
+
+class InvalidIdToken(ValueError):
+    """El ID token no es válido (firma, emisor, audiencia, expiración o email)"""
+
+
+class UnknownKeyId(InvalidIdToken):
+    """El 'kid' del token no está en la caché de certificados (posible rotación)"""
+
+
+def looks_like_jwt(token: str) -> bool:
+    """Los ID tokens son JWT (tres segmentos base64url); los access tokens de Google no"""
+    return token.count('.') == 2 and token.startswith('eyJ')
+
+
+def _b64url_decode(segment: str) -> bytes:
+    return base64.urlsafe_b64decode(segment + '=' * (-len(segment) % 4))
+
+
+class GoogleCertCache:
+    """Caché de certificados de Google indexada por 'kid' con refresco en segundo plano"""
+
+    def __init__(self, session, min_refresh_interval: float = 60.0, default_max_age: float = 3600.0):
+        self.session = session
+        self.min_refresh_interval = min_refresh_interval
+        self.default_max_age = default_max_age
+        self._verifiers: Dict[str, crypt.Verifier] = {}
+        self._expires_at = 0.0
+        self._last_fetch = 0.0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._verifiers)
+
+    def has_key(self, kid: Optional[str]) -> bool:
+        return kid in self._verifiers
+
+    def refresh(self, force: bool = False) -> bool:
+        """
+        Descargar los certificados vigentes. Sin force, no se descarga más de una vez
+        por min_refresh_interval (evita que tokens con 'kid' falso martillen a Google).
+        """
+        with self._lock:
+            if not force and time.time() - self._last_fetch < self.min_refresh_interval:
+                return False
+            self._last_fetch = time.time()
+        response = self.session.get(GOOGLE_CERTS_URL, timeout=(3, 5))
+        response.raise_for_status()
+        certs = response.json()
+        verifiers = {kid: crypt.RSAVerifier.from_string(pem) for kid, pem in certs.items()}
+        max_age = self.default_max_age
+        match = re.search(r'max-age=(\d+)', response.headers.get('Cache-Control', ''))
+        if match:
+            max_age = float(match.group(1))
+        with self._lock:
+            # Reemplazar el mapa completo: los kid retirados por Google dejan de aceptarse
+            self._verifiers = verifiers
+            self._expires_at = time.time() + max_age
+        logger.info(f"🔑 Certificados de Google actualizados: {sorted(verifiers)} (max-age {max_age:.0f}s)")
+        return True
+
+    def start(self):
+        """Iniciar el hilo que refresca los certificados antes de que expiren"""
+        self._thread = threading.Thread(target=self._refresh_loop, name="google-certs", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _refresh_loop(self):
+        delay = 0.0
+        while not self._stop.wait(delay):
+            try:
+                self.refresh(force=True)
+                # Refrescar al 80% del max-age para no quedar nunca con la caché vencida
+                delay = max(self.min_refresh_interval, (self._expires_at - time.time()) * 0.8)
+            except Exception as e:
+                logger.warning(f"⚠️ Error al refrescar certificados de Google: {e}")
+                delay = self.min_refresh_interval
+
+    def verify(self, token: str, audience: str, clock_skew: int = 30) -> Dict:
+        """
+        Verificar firma, emisor, audiencia, expiración y email_verified de un ID token.
+        Operación solo de CPU: no hace llamadas de red.
+
+        Raises:
+            UnknownKeyId: si el 'kid' no está en caché (conviene refrescar y reintentar)
+            InvalidIdToken: si el token no es válido
+        """
+        try:
+            header_b64, payload_b64, signature_b64 = token.split('.')
+            header = json.loads(_b64url_decode(header_b64))
+            payload = json.loads(_b64url_decode(payload_b64))
+            signature = _b64url_decode(signature_b64)
+            signed_section = f"{header_b64}.{payload_b64}".encode('ascii')
+        except (ValueError, TypeError) as e:
+            raise InvalidIdToken(f"Token mal formado: {e}")
+
+        if header.get('alg') != 'RS256':
+            raise InvalidIdToken(f"Algoritmo no soportado: {header.get('alg')}")
+        verifier = self._verifiers.get(header.get('kid'))
+        if verifier is None:
+            raise UnknownKeyId(f"Certificado no encontrado para kid {header.get('kid')}")
+        if not verifier.verify(signed_section, signature):
+            raise InvalidIdToken("Firma inválida")
+
+        now = time.time()
+        if payload.get('iss') not in GOOGLE_ISSUERS:
+            raise InvalidIdToken(f"Emisor inválido: {payload.get('iss')}")
+        if payload.get('aud') != audience:
+            raise InvalidIdToken("Audiencia inválida")
+        if not isinstance(payload.get('exp'), (int, float)) or payload['exp'] + clock_skew < now:
+            raise InvalidIdToken("Token expirado")
+        if isinstance(payload.get('iat'), (int, float)) and payload['iat'] - clock_skew > now:
+            raise InvalidIdToken("Token emitido en el futuro")
+        if payload.get('email_verified') not in (True, 'true'):
+            raise InvalidIdToken("Email no verificado por Google")
+        return payload
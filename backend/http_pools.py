@@ -0,0 +1,239 @@
+"""
+Pools de conexiones HTTP instrumentados para las sesiones de requests (n8n y Google).
+- El tamaño del pool se deriva de la concurrencia real (hilos que pueden llamar a la vez), así
+  una ráfaga reutiliza conexiones en vez de abrir extras que después se descartan.
+- Cada pool cuenta conexiones creadas durante un request, descartadas (pool lleno), adquiridas
+  y el tiempo de espera por una conexión libre; snapshot() agrega en uso / ociosas por host.
+- refresh() abre conexiones hasta un mínimo de ociosas (TCP + TLS, sin enviar requests) y
+  reconecta las ociosas caídas o viejas; PoolKeeper lo ejecuta al arrancar y periódicamente,
+  para que el primer request después de un rato sin tráfico no pague el handshake.
+"""
+import logging
+import queue
+import threading
+import time
+import weakref
+from typing import Dict, List, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def pool_size_for(concurrency: int, hedging: bool = False) -> int:
+    """Conexiones por host para concurrency llamadas simultáneas (el hedging duplica requests)"""
+    return max(1, concurrency * (2 if hedging else 1))
+
+
+class PoolStats:
+    """Contadores compartidos por los pools (uno por host) de una sesión"""
+
+    def __init__(self, name: str, acquire_timeout: Optional[float] = None):
+        self.name = name
+        self.acquire_timeout = acquire_timeout
+        self.created = 0
+        self.discarded = 0
+        self.acquired = 0
+        self.refreshed = 0
+        self.in_use = 0
+        self.pools = weakref.WeakSet()
+        self._lock = threading.Lock()
+
+    def add(self, field: str, value: int = 1):
+        with self._lock:
+            setattr(self, field, getattr(self, field) + value)
+
+    def snapshot(self) -> Dict:
+        hosts = []
+        for pool in list(self.pools):
+            idle = pool.idle_count()
+            hosts.append({"host": pool.host, "port": pool.port, "maxsize": pool.pool.maxsize if pool.pool else 0,
+                          "idle": idle})
+        with self._lock:
+            return {
+                "in_use": self.in_use,
+                "idle": sum(host["idle"] for host in hosts),
+                "created": self.created,
+                "discarded": self.discarded,
+                "acquired": self.acquired,
+                "reused": self.acquired - self.created,
+                "refreshed": self.refreshed,
+                "hosts": hosts,
+            }
+
+
+class _InstrumentedPoolMixin:
+    """Cuenta eventos del pool de urllib3 y agrega el refresco de conexiones ociosas"""
+
+    stats: PoolStats
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats.pools.add(self)
+
+    def _new_conn(self):
+        # Conexión abierta en el camino de un request (el handshake lo paga ese request)
+        self.stats.add('created')
+        return super()._new_conn()
+
+    def _get_conn(self, timeout=None):
+        start = time.perf_counter()
+        conn = super()._get_conn(timeout if timeout is not None else self.stats.acquire_timeout)
+        metrics.observe(f'http_pool_{self.stats.name}_wait_seconds', time.perf_counter() - start)
+        self.stats.add('acquired')
+        self.stats.add('in_use')
+        return conn
+
+    def _put_conn(self, conn):
+        self.stats.add('in_use', -1)
+        if conn is not None:
+            conn.last_used = time.monotonic()
+        if self.pool is not None and self.pool.full():
+            self.stats.add('discarded')
+        super()._put_conn(conn)
+
+    def idle_count(self) -> int:
+        """Conexiones abiertas esperando en el pool (los None son lugares libres sin conexión)"""
+        if self.pool is None:
+            return 0
+        return sum(1 for conn in list(self.pool.queue) if conn is not None and conn.sock is not None)
+
+    def _take_all(self) -> List:
+        items = []
+        while True:
+            try:
+                items.append(self.pool.get(block=False))
+            except queue.Empty:
+                return items
+
+    def _give_back(self, items: List):
+        # LIFO: primero los lugares vacíos y después las conexiones, así get() entrega conexiones
+        for item in sorted(items, key=lambda conn: conn is not None):
+            try:
+                self.pool.put(item, block=False)
+            except queue.Full:
+                if item is not None:
+                    item.close()
+
+    def refresh(self, min_idle: int = 0, max_idle_seconds: float = 50.0, connect_timeout: float = 5.0) -> int:
+        """
+        Reconectar las conexiones ociosas caídas o sin uso hace más de max_idle_seconds y abrir
+        conexiones nuevas hasta tener min_idle. Retorna cuántas conexiones se (re)abrieron.
+        """
+        if self.pool is None:
+            return 0
+        now = time.monotonic()
+        items = self._take_all()
+        ready, stale, free = [], [], 0
+        for conn in items:
+            if conn is None:
+                free += 1
+            elif not conn.is_connected or now - getattr(conn, 'last_used', now) > max_idle_seconds:
+                # is_connected es False si el servidor ya cerró la conexión ociosa
+                stale.append(conn)
+            else:
+                ready.append(conn)
+        # Se reabren solo las necesarias para llegar a min_idle; las demás se cierran y su lugar
+        # queda libre (después de una ráfaga el pool vuelve a su tamaño de reposo)
+        reopen = stale[:max(0, min_idle - len(ready))]
+        for conn in stale[len(reopen):]:
+            conn.close()
+        free += len(stale) - len(reopen)
+        missing = min(free, max(0, min_idle - len(ready) - len(reopen)))
+        # Los lugares que se van a llenar se retienen; el resto vuelve al pool de inmediato
+        self._give_back(ready + [None] * (free - missing))
+        opened = 0
+        for conn in reopen + [super(_InstrumentedPoolMixin, self)._new_conn() for _ in range(missing)]:
+            try:
+                conn.close()
+                conn.timeout = connect_timeout  # Cada request vuelve a fijar su propio timeout
+                conn.connect()
+                conn.last_used = time.monotonic()
+                opened += 1
+            except Exception as e:
+                logger.debug(f"No se pudo abrir conexión a {self.host}: {e}")
+                conn.close()
+            self._give_back([conn])
+        self.stats.add('refreshed', opened)
+        return opened
+
+
+class InstrumentedHTTPConnectionPool(_InstrumentedPoolMixin, HTTPConnectionPool):
+    pass
+
+
+class InstrumentedHTTPSConnectionPool(_InstrumentedPoolMixin, HTTPSConnectionPool):
+    pass
+
+
+class InstrumentedAdapter(HTTPAdapter):
+    """HTTPAdapter cuyos pools registran métricas en stats"""
+
+    def __init__(self, stats: PoolStats, **kwargs):
+        self.stats = stats
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": type("HTTPConnectionPool", (InstrumentedHTTPConnectionPool,), {"stats": self.stats}),
+            "https": type("HTTPSConnectionPool", (InstrumentedHTTPSConnectionPool,), {"stats": self.stats}),
+        }
+
+
+class PoolKeeper:
+    """Precalienta los pools de las URLs indicadas y los refresca periódicamente en un hilo"""
+
+    def __init__(self, refresh_interval: float = 30.0, max_idle_seconds: float = 50.0,
+                 connect_timeout: float = 5.0):
+        self.refresh_interval = refresh_interval
+        self.max_idle_seconds = max_idle_seconds
+        self.connect_timeout = connect_timeout
+        self._targets = []  # (session, url, min_idle)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add(self, session: requests.Session, url: str, min_idle: int):
+        if isinstance(session.get_adapter(url), InstrumentedAdapter) and min_idle > 0:
+            self._targets.append((session, url, min_idle))
+
+    @staticmethod
+    def pool_for(session: requests.Session, url: str):
+        """
+        Pool de urllib3 que la sesión usa para url. La clave del pool incluye el contexto TLS,
+        que requests arma combinando la sesión con el entorno (ej. REQUESTS_CA_BUNDLE).
+        """
+        settings = session.merge_environment_settings(url, {}, None, None, None)
+        request = requests.Request("GET", url).prepare()
+        return session.get_adapter(url).get_connection_with_tls_context(
+            request, settings["verify"], settings["proxies"], settings["cert"]
+        )
+
+    def refresh_all(self) -> int:
+        opened = 0
+        for session, url, min_idle in self._targets:
+            try:
+                opened += self.pool_for(session, url).refresh(min_idle, self.max_idle_seconds, self.connect_timeout)
+            except Exception as e:
+                logger.warning(f"⚠️ Error al refrescar conexiones a {url}: {e}")
+        return opened
+
+    def start(self):
+        if not self._targets:
+            return
+        self._thread = threading.Thread(target=self._loop, name="http-pool-keeper", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self):
+        start_time = time.time()
+        opened = self.refresh_all()
+        logger.info(f"✅ Pools HTTP precalentados: {opened} conexiones en {time.time() - start_time:.2f}s")
+        while not self._stop.wait(self.refresh_interval):
+            self.refresh_all()
@@ -0,0 +1,132 @@
+"""
+Detección de fotos casi duplicadas de tickets con hash perceptual (dHash de 64 bits).
+Dos fotos del mismo ticket desde ángulos o con luz apenas distintos tienen hashes a pocos
+bits de distancia (Hamming). Las imágenes recientes se guardan en una tabla multi-índice:
+el hash se divide en max_distance + 1 segmentos y, por el principio del palomar, dos hashes
+a distancia <= max_distance coinciden exactamente en al menos un segmento. Una búsqueda solo
+compara contra los candidatos de esos buckets en vez de recorrer todas las imágenes.
+"""
+import io
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow es opcional: sin él no se calcula el hash y no se detectan duplicados
+    Image = None
+
+HASH_BITS = 64
+
+
+def dedup_available() -> bool:
+    return Image is not None
+
+
+def dhash(content: bytes, hash_size: int = 8) -> Optional[int]:
+    """
+    Difference hash: imagen en grises reducida a (hash_size+1) x hash_size, un bit por cada
+    par de píxeles vecinos (1 si el de la izquierda es más brillante). None si no se puede calcular.
+    """
+    if Image is None:
+        return None
+    try:
+        image = Image.open(io.BytesIO(content))
+        # En JPEG, draft decodifica directamente a baja resolución (mucho más rápido que decodificar todo)
+        image.draft('L', (hash_size * 8, hash_size * 8))
+        pixels = list(image.convert('L').resize((hash_size + 1, hash_size), Image.BILINEAR).getdata())
+    except Exception:
+        return None
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+class NearDuplicateIndex:
+    """
+    Imágenes procesadas recientemente indexadas por dHash. Las entradas expiran por
+    antigüedad (ttl_seconds) y por cantidad (max_entries, se descartan las más viejas).
+    Cada entrada tiene un scope (ej. el email de quien subió la foto) y una búsqueda solo
+    ve las entradas de su mismo scope.
+    """
+
+    def __init__(self, max_distance: int = 6, max_entries: int = 5000, ttl_seconds: float = 6 * 3600):
+        self.max_distance = max_distance
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        # Segmentos de bits: max_distance + 1 rangos que cubren los 64 bits
+        segments = max_distance + 1
+        bounds = [round(i * HASH_BITS / segments) for i in range(segments + 1)]
+        self._segments = [(start, (1 << (end - start)) - 1) for start, end in zip(bounds, bounds[1:])]
+        self._tables: List[Dict[int, set]] = [{} for _ in self._segments]
+        self._entries: "OrderedDict[int, Tuple[int, float, Dict, Optional[str]]]" = OrderedDict()  # id -> (hash, ts, datos, scope)
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _keys(self, value: int):
+        return [(value >> start) & mask for start, mask in self._segments]
+
+    def _remove(self, entry_id: int):
+        value, _, _, _ = self._entries.pop(entry_id)
+        for table, key in zip(self._tables, self._keys(value)):
+            bucket = table.get(key)
+            if bucket is not None:
+                bucket.discard(entry_id)
+                if not bucket:
+                    del table[key]
+
+    def _expire(self, now: float):
+        while self._entries:
+            entry_id, (_, ts, _, _) = next(iter(self._entries.items()))
+            if len(self._entries) <= self.max_entries and now - ts <= self.ttl_seconds:
+                break
+            self._remove(entry_id)
+
+    def add(self, value: int, data: Dict, scope: Optional[str] = None):
+        """Registrar una imagen procesada con sus datos (ej. id_check y resultado del OCR)"""
+        now = time.time()
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (value, now, data, scope)
+            for table, key in zip(self._tables, self._keys(value)):
+                table.setdefault(key, set()).add(entry_id)
+            self._expire(now)
+
+    def find(self, value: int, max_distance: Optional[int] = None,
+             scope: Optional[str] = None) -> Optional[Tuple[int, float, Dict]]:
+        """
+        Imagen más parecida (y más reciente a igual distancia) del mismo scope dentro de max_distance.
+        Retorna (distancia, antigüedad en segundos, datos) o None.
+        """
+        limit = self.max_distance if max_distance is None else min(max_distance, self.max_distance)
+        now = time.time()
+        best = None
+        with self._lock:
+            self._expire(now)
+            candidates = set()
+            for table, key in zip(self._tables, self._keys(value)):
+                bucket = table.get(key)
+                if bucket:
+                    candidates.update(bucket)
+            for entry_id in candidates:
+                other, ts, data, entry_scope = self._entries[entry_id]
+                if entry_scope != scope:
+                    continue
+                distance = hamming(value, other)
+                if distance <= limit and (best is None or (distance, -ts) < (best[0], -best[1])):
+                    best = (distance, ts, data)
+        if best is None:
+            return None
+        return best[0], now - best[1], best[2]
@@ -0,0 +1,330 @@
+"""
+Archivo local columnar (Parquet) de las facturas guardadas, particionado por anio/mes.
+Cada fila se agrega primero a un archivo de staging JSONL (append barato y durable); un hilo
+en segundo plano lo convierte a Parquet y compacta las particiones con muchos archivos.
+Permite responder consultas operativas sin BigQuery y reponer filas perdidas (backfill).
+
+Uso como herramienta (desde backend/):
+    python invoice_archive.py query --anio 2024 --mes 11 --codigo-tienda 015
+    python invoice_archive.py backfill --desde 2024-11-01 --hasta 2024-11-30 [--dry-run]
+"""
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from datetime import date, datetime, timezone
+from typing import Dict, Iterable, List, Optional
+
+from bigquery_sinks import INVOICE_ROW_SCHEMA
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow es opcional: sin él el archivo local queda deshabilitado
+    pa = None
+
+logger = logging.getLogger(__name__)
+
+STAGING_DIR = '_staging'
+
+
+def arrow_schema():
+    """Esquema Arrow equivalente a la fila de BigQuery construida en save_invoice"""
+    types = {
+        "STRING": pa.string(),
+        "DATE": pa.date32(),
+        "TIME": pa.string(),
+        "DATETIME": pa.string(),
+        "TIMESTAMP": pa.timestamp('us', tz='UTC'),
+        "FLOAT": pa.float64(),
+        "INTEGER": pa.int64(),
+    }
+    return pa.schema([(name, types[field_type]) for name, field_type in INVOICE_ROW_SCHEMA])
+
+
+def _partition_of(row: Dict):
+    """Partición (anio, mes) de una fila: campos anio/mes, o la fecha, o la fecha de carga"""
+    if row.get('anio') and row.get('mes'):
+        return int(row['anio']), int(row['mes'])
+    for key in ('fecha', 'fecha_carga'):
+        value = row.get(key)
+        if value:
+            parsed = date.fromisoformat(str(value)[:10])
+            return parsed.year, parsed.month
+    return 0, 0
+
+
+def _to_arrow_value(value, field_type: str):
+    if value is None:
+        return None
+    if field_type == "DATE":
+        return date.fromisoformat(value)
+    if field_type == "TIMESTAMP":
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+    return value
+
+
+def _to_row_value(value, field_type: str):
+    """Convertir un valor leído de Parquet al formato de la fila de insert_rows_json"""
+    if value is None:
+        return None
+    if field_type == "DATE":
+        return value.isoformat()
+    if field_type == "TIMESTAMP":
+        return value.astimezone(timezone.utc).replace(tzinfo=None).isoformat() + 'Z'
+    return value
+
+
+def rows_to_table(rows: List[Dict]):
+    columns = {
+        name: [_to_arrow_value(row.get(name), field_type) for row in rows]
+        for name, field_type in INVOICE_ROW_SCHEMA
+    }
+    return pa.Table.from_pydict(columns, schema=arrow_schema())
+
+
+def table_to_rows(table) -> List[Dict]:
+    types = dict(INVOICE_ROW_SCHEMA)
+    return [
+        {name: _to_row_value(value, types[name]) for name, value in record.items() if name in types}
+        for record in table.to_pylist()
+    ]
+
+
+def _dedupe_latest(table):
+    """Quedarse con la última versión de cada id_check (un reintento de guardado no duplica)"""
+    if table.num_rows == 0:
+        return table
+    seen = set()
+    keep = []
+    ids = table.column('id_check').to_pylist()
+    for index in range(len(ids) - 1, -1, -1):
+        if ids[index] not in seen:
+            seen.add(ids[index])
+            keep.append(index)
+    keep.reverse()
+    return table.take(pa.array(keep, type=pa.int64()))
+
+
+class InvoiceArchive:
+    """Archivo Parquet particionado anio=/mes= con staging JSONL y compactación en segundo plano"""
+
+    def __init__(self, directory: str, flush_interval: float = 60.0, compact_min_files: int = 8):
+        if pa is None:
+            raise RuntimeError("pyarrow no está instalado")
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.compact_min_files = compact_min_files
+        self.staging_dir = os.path.join(directory, STAGING_DIR)
+        os.makedirs(self.staging_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _partition_dir(self, anio: int, mes: int) -> str:
+        return os.path.join(self.directory, f"anio={anio}", f"mes={mes}")
+
+    def _staging_path(self, anio: int, mes: int) -> str:
+        return os.path.join(self.staging_dir, f"anio={anio}_mes={mes}.jsonl")
+
+    def append(self, row: Dict):
+        """Agregar una fila al staging de su partición (append + fsync, sin reescribir Parquet)"""
+        anio, mes = _partition_of(row)
+        line = json.dumps(row, ensure_ascii=False) + '\n'
+        with self._lock:
+            with open(self._staging_path(anio, mes), 'a', encoding='utf-8') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def start(self):
+        """Iniciar el hilo que vuelca el staging a Parquet y compacta particiones"""
+        self._thread = threading.Thread(target=self._maintenance_loop, name="invoice-archive", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=10)
+        self.flush()
+
+    def _maintenance_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+                self.compact()
+            except Exception as e:
+                logger.warning(f"⚠️ Error en mantenimiento del archivo de facturas: {e}")
+
+    def flush(self):
+        """Convertir cada archivo de staging en un archivo Parquet de su partición"""
+        with self._lock:
+            # Renombrar bajo lock: los appends siguientes van a un staging nuevo
+            for name in os.listdir(self.staging_dir):
+                if name.endswith('.jsonl'):
+                    path = os.path.join(self.staging_dir, name)
+                    os.replace(path, f"{path}.{uuid.uuid4().hex[:8]}.flushing")
+        # Incluye archivos .flushing que quedaron de un proceso interrumpido
+        for name in sorted(os.listdir(self.staging_dir)):
+            if not name.endswith('.flushing'):
+                continue
+            pending = os.path.join(self.staging_dir, name)
+            with open(pending, 'r', encoding='utf-8') as f:
+                rows = [json.loads(line) for line in f if line.strip()]
+            if rows:
+                anio, mes = _partition_of(rows[0])
+                partition_dir = self._partition_dir(anio, mes)
+                os.makedirs(partition_dir, exist_ok=True)
+                name = f"part-{int(time.time())}-{uuid.uuid4().hex[:8]}.parquet"
+                # Escribir con prefijo '.' (ignorado por los lectores) y renombrar al terminar
+                tmp = os.path.join(partition_dir, '.' + name)
+                pq.write_table(rows_to_table(rows), tmp, compression='zstd')
+                os.replace(tmp, os.path.join(partition_dir, name))
+            os.remove(pending)
+
+    def compact(self):
+        """Unir las particiones con muchos archivos pequeños en un solo archivo deduplicado"""
+        for partition_dir in self._partition_dirs():
+            parts = sorted(p for p in os.listdir(partition_dir) if p.endswith('.parquet'))
+            if len(parts) < self.compact_min_files:
+                continue
+            paths = [os.path.join(partition_dir, p) for p in parts]
+            table = _dedupe_latest(pa.concat_tables([pq.read_table(p, schema=arrow_schema()) for p in paths]))
+            name = f"compacted-{int(time.time())}-{uuid.uuid4().hex[:8]}.parquet"
+            tmp = os.path.join(partition_dir, '.' + name)
+            pq.write_table(table, tmp, compression='zstd')
+            os.replace(tmp, os.path.join(partition_dir, name))
+            for path in paths:
+                os.remove(path)
+            logger.info(f"🗜️ Compactada partición {partition_dir}: {len(parts)} archivos -> 1 ({table.num_rows} filas)")
+
+    def _partition_dirs(self) -> Iterable[str]:
+        for anio_dir in os.listdir(self.directory):
+            if not anio_dir.startswith('anio='):
+                continue
+            for mes_dir in os.listdir(os.path.join(self.directory, anio_dir)):
+                path = os.path.join(self.directory, anio_dir, mes_dir)
+                if mes_dir.startswith('mes=') and os.path.isdir(path):
+                    yield path
+
+    def scan(self, anio: Optional[int] = None, mes: Optional[int] = None,
+             codigo_tienda: Optional[str] = None, desde: Optional[str] = None,
+             hasta: Optional[str] = None, include_staging: bool = True):
+        """Leer filas archivadas como tabla Arrow aplicando filtros (con poda de particiones)"""
+        tables = []
+        if any(self._partition_dirs()):
+            # Las claves de partición también están como columnas: mismo tipo (int64) en ambos
+            partitioning = ds.partitioning(pa.schema([('anio', pa.int64()), ('mes', pa.int64())]), flavor='hive')
+            dataset = ds.dataset(self.directory, format='parquet', partitioning=partitioning,
+                                 exclude_invalid_files=True, ignore_prefixes=[STAGING_DIR, '.'])
+            expression = None
+            for condition in (
+                (ds.field('anio') == anio) if anio is not None else None,
+                (ds.field('mes') == mes) if mes is not None else None,
+            ):
+                if condition is not None:
+                    expression = condition if expression is None else expression & condition
+            tables.append(dataset.to_table(filter=expression, columns=[n for n, _ in INVOICE_ROW_SCHEMA]))
+        if include_staging:
+            with self._lock:
+                staged = []
+                for name in os.listdir(self.staging_dir):
+                    if name.endswith('.jsonl') or name.endswith('.flushing'):
+                        with open(os.path.join(self.staging_dir, name), 'r', encoding='utf-8') as f:
+                            staged.extend(json.loads(line) for line in f if line.strip())
+            staged = [r for r in staged if (anio is None or _partition_of(r)[0] == anio)
+                      and (mes is None or _partition_of(r)[1] == mes)]
+            if staged:
+                tables.append(rows_to_table(staged))
+        if not tables:
+            return arrow_schema().empty_table()
+        table = _dedupe_latest(pa.concat_tables([t.cast(arrow_schema()) for t in tables]))
+        mask = None
+        for condition in (
+            pc.equal(table['codigo_tienda'], codigo_tienda) if codigo_tienda else None,
+            pc.greater_equal(table['fecha'], pa.scalar(date.fromisoformat(desde))) if desde else None,
+            pc.less_equal(table['fecha'], pa.scalar(date.fromisoformat(hasta))) if hasta else None,
+        ):
+            if condition is not None:
+                mask = condition if mask is None else pc.and_(mask, condition)
+        return table.filter(mask) if mask is not None else table
+
+
+def backfill(archive: InvoiceArchive, client, table_id: str, desde: str, hasta: str,
+             dry_run: bool = False, chunk_size: int = 500) -> int:
+    """Insertar en BigQuery las filas archivadas cuyo id_check no está en la tabla"""
+    from google.cloud import bigquery
+
+    archived = table_to_rows(archive.scan(desde=desde, hasta=hasta))
+    job = client.query(
+        f"SELECT id_check FROM `{table_id}` WHERE fecha BETWEEN @desde AND @hasta",
+        job_config=bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ScalarQueryParameter('desde', 'DATE', desde),
+            bigquery.ScalarQueryParameter('hasta', 'DATE', hasta),
+        ]),
+    )
+    existing = {row.id_check for row in job.result()}
+    missing = [row for row in archived if row['id_check'] not in existing]
+    logger.info(f"Backfill {desde}..{hasta}: {len(archived)} archivadas, {len(missing)} faltan en BigQuery")
+    if dry_run:
+        return len(missing)
+    for start in range(0, len(missing), chunk_size):
+        chunk = missing[start:start + chunk_size]
+        errors = client.insert_rows_json(table_id, chunk, row_ids=[row['id_check'] for row in chunk])
+        if errors:
+            raise RuntimeError(f"Error al insertar backfill: {errors}")
+    return len(missing)
+
+
+def main():
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Consultas y backfill del archivo local de facturas")
+    parser.add_argument('--dir', default=os.getenv('INVOICE_ARCHIVE_DIR', os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'data', 'archive')))
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    query = sub.add_parser('query', help="Filtrar facturas archivadas e imprimir JSONL")
+    query.add_argument('--anio', type=int)
+    query.add_argument('--mes', type=int)
+    query.add_argument('--codigo-tienda')
+    query.add_argument('--desde')
+    query.add_argument('--hasta')
+
+    fill = sub.add_parser('backfill', help="Reponer en BigQuery filas que faltan")
+    fill.add_argument('--desde', required=True)
+    fill.add_argument('--hasta', required=True)
+    fill.add_argument('--dry-run', action='store_true')
+
+    sub.add_parser('compact', help="Volcar staging y compactar particiones ahora")
+
+    args = parser.parse_args()
+    archive = InvoiceArchive(args.dir)
+
+    if args.command == 'query':
+        table = archive.scan(args.anio, args.mes, args.codigo_tienda, args.desde, args.hasta)
+        for row in table_to_rows(table):
+            print(json.dumps(row, ensure_ascii=False))
+    elif args.command == 'backfill':
+        from google.cloud import bigquery
+
+        project = os.getenv('BIGQUERY_PROJECT_ID')
+        table_id = f"{project}.{os.getenv('BIGQUERY_DATASET_ID')}.{os.getenv('BIGQUERY_TABLE_ID')}"
+        count = backfill(archive, bigquery.Client(project=project), table_id, args.desde, args.hasta, args.dry_run)
+        print(f"{'Faltan' if args.dry_run else 'Insertadas'}: {count} filas")
+    elif args.command == 'compact':
+        archive.flush()
+        archive.compact_min_files = 2
+        archive.compact()
+
+
+if __name__ == '__main__':
+    main()
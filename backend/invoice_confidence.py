@@ -0,0 +1,136 @@
+"""
+Confianza por campo de una factura parseada (0.0 a 1.0).
+El puntaje base depende del patrón que encontró el valor (un 'Fecha 06/11/24' etiquetado vale
+más que la primera fecha suelta del texto) y se ajusta con controles cruzados: fecha dentro de
+un rango razonable, hora válida, importe_total coherente con monto_op_gravada, CAE de 14 dígitos.
+Con los umbrales por campo se decide si la factura puede guardarse sin revisión manual.
+"""
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional
+
+# Puntaje base por campo según el nivel del patrón que encontró el valor (índice = nivel)
+TEXT_TIER_SCORES = {
+    'id_caja': (0.9,),                          # 'Caja N'
+    'codigo_tienda': (0.8,),                    # código al inicio de las primeras líneas
+    'tienda_nombre': (0.8,),
+    'fecha': (0.95, 0.6),                       # 'Fecha dd/mm/aa', primera fecha del texto
+    'hora': (0.95, 0.7),                        # 'Hora hh:mm:ss', primera hora del texto
+    'ticket_electronico': (0.95,),              # 'CAE N'
+    'id_boleta': (0.95, 0.9, 0.75, 0.6),        # 'Nro T.', 'Nro Ticket', 'Ticket N°', 'Factura N°'
+    'monto_op_gravada': (0.95, 0.85, 0.7),      # 'SUBTOTAL SIN DESCUENTOS', 'SUBTOTAL', 'TOTAL'
+    'importe_total': (0.9, 0.6),                # 'TOTAL', copia de monto_op_gravada
+    'a_c': (0.9, 0.6),                          # línea 'Art:', código al final de una línea
+}
+
+# Datos estructurados de n8n: nivel 0 = valor en el formato esperado, 1 = convertido de otro formato
+STRUCTURED_TIER_SCORES = (0.9, 0.85)
+
+# Umbrales por defecto para guardar automáticamente (campos no listados no se exigen)
+DEFAULT_THRESHOLDS = {
+    'fecha': 0.85,
+    'hora': 0.7,
+    'canal': 0.8,
+    'codigo_tienda': 0.75,
+    'id_boleta': 0.7,
+    'monto_op_gravada': 0.7,
+    'importe_total': 0.85,
+}
+
+MAX_AGE_DAYS = 400           # Tickets más viejos son sospechosos (año mal leído)
+MIN_DISCOUNT_RATIO = 0.5     # importe_total por debajo de la mitad del subtotal: probablemente mal leído
+
+
+def tier_score(tier: Optional[int], scores) -> float:
+    """Puntaje del nivel de patrón (None = no se encontró el valor)"""
+    if tier is None:
+        return 0.0
+    return scores[min(tier, len(scores) - 1)]
+
+
+def score_fields(record, tiers: Dict[str, Optional[int]], structured: bool = False,
+                 today: Optional[date] = None) -> Dict[str, float]:
+    """
+    Confianza de cada campo del registro a partir del nivel de patrón de cada uno
+    ({campo: nivel o None}) y de los controles cruzados.
+    """
+    scores = {}
+    for field, tier in tiers.items():
+        table = STRUCTURED_TIER_SCORES if structured else TEXT_TIER_SCORES.get(field, (0.8,))
+        scores[field] = tier_score(tier, table) if record.get(field) not in (None, '') else 0.0
+    _check_fecha(record, scores, today or date.today())
+    _check_hora(record, scores)
+    _check_amounts(record, scores)
+    _check_ticket_electronico(record, scores)
+    return {field: round(value, 2) for field, value in scores.items()}
+
+
+def _scale(scores: Dict[str, float], field: str, factor: float):
+    if field in scores:
+        scores[field] *= factor
+
+
+def _check_fecha(record, scores: Dict[str, float], today: date):
+    if not record.fecha:
+        return
+    try:
+        fecha = datetime.strptime(record.fecha, '%Y-%m-%d').date()
+    except ValueError:
+        scores['fecha'] = 0.0
+        return
+    if fecha > today + timedelta(days=1):
+        _scale(scores, 'fecha', 0.2)  # Fecha futura: casi seguro un dígito mal leído
+    elif fecha < today - timedelta(days=MAX_AGE_DAYS):
+        _scale(scores, 'fecha', 0.5)
+
+
+def _check_hora(record, scores: Dict[str, float]):
+    if not record.hora:
+        return
+    try:
+        datetime.strptime(record.hora, '%H:%M:%S')
+    except ValueError:
+        scores['hora'] = 0.0
+
+
+def _check_amounts(record, scores: Dict[str, float]):
+    total = record.importe_total or 0.0
+    gravada = record.monto_op_gravada or 0.0
+    if total <= 0:
+        scores['importe_total'] = 0.0
+    if gravada <= 0:
+        scores['monto_op_gravada'] = 0.0
+    if total <= 0 or gravada <= 0:
+        return
+    # El total puede sumar el recargo por consumo, pero no superar subtotal + recargo
+    if total > gravada + (record.recargo_consumo or 0.0) + 0.01:
+        _scale(scores, 'importe_total', 0.5)
+        _scale(scores, 'monto_op_gravada', 0.5)
+    # Un subtotal sin descuentos mayor al total es normal, salvo que la diferencia sea desmedida
+    elif total < gravada * MIN_DISCOUNT_RATIO:
+        _scale(scores, 'importe_total', 0.7)
+        _scale(scores, 'monto_op_gravada', 0.7)
+
+
+def _check_ticket_electronico(record, scores: Dict[str, float]):
+    value = record.ticket_electronico
+    if value and not (value.isdigit() and len(value) == 14):
+        _scale(scores, 'ticket_electronico', 0.6)
+
+
+def parse_thresholds(spec: str) -> Dict[str, float]:
+    """'fecha:0.85,importe_total:0.9' -> {campo: umbral}; vacío = DEFAULT_THRESHOLDS"""
+    if not spec or not spec.strip():
+        return dict(DEFAULT_THRESHOLDS)
+    thresholds = {}
+    for item in spec.split(','):
+        field, _, value = item.strip().partition(':')
+        if not field or not value:
+            raise ValueError(f"Umbral inválido: '{item}' (formato campo:valor)")
+        thresholds[field.strip()] = float(value)
+    return thresholds
+
+
+def failing_fields(confidence: Optional[Dict[str, float]], thresholds: Dict[str, float]) -> List[str]:
+    """Campos cuya confianza no alcanza su umbral (sin confianza calculada fallan todos)"""
+    confidence = confidence or {}
+    return [field for field, minimum in thresholds.items() if confidence.get(field, 0.0) < minimum]
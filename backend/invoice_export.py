@@ -0,0 +1,311 @@
+"""
+Exportación de facturas guardadas (GET /api/export) en CSV o Parquet, en streaming.
+Las filas se leen como record batches de Arrow desde una fuente de lectura:
+- StorageReadSource: BigQuery Storage Read API, una sesión con varios streams en paralelo
+  (filtro y columnas se aplican del lado de BigQuery);
+- MemoryReadSource: fake local para desarrollo, pruebas y benchmarks.
+Cada stream se lee en su propio hilo hacia una cola acotada y el encoder escribe cada batch
+apenas llega, así la memoria depende del tamaño de batch y de la cola, no del resultado.
+Los batches de streams distintos se intercalan: el orden de las filas no está garantizado.
+"""
+import logging
+import queue
+import re
+import threading
+from abc import ABC, abstractmethod
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence
+
+from bigquery_sinks import INVOICE_ROW_SCHEMA
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pa_csv
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow es opcional: sin él la exportación queda deshabilitada
+    pa = None
+
+logger = logging.getLogger(__name__)
+
+FORMATS = {
+    "csv": ("text/csv; charset=utf-8", "csv"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+
+EXPORT_COLUMNS: Sequence[str] = tuple(name for name, _ in INVOICE_ROW_SCHEMA)
+
+_CODIGO_TIENDA_RE = re.compile(r'^[A-Za-z0-9_-]{1,32}$')
+
+
+class ExportError(ValueError):
+    """Parámetros de exportación inválidos"""
+
+
+class ExportFilters(NamedTuple):
+    anio: Optional[int] = None
+    mes: Optional[int] = None
+    codigo_tienda: Optional[str] = None
+
+    def validate(self) -> "ExportFilters":
+        if self.mes is not None and not 1 <= self.mes <= 12:
+            raise ExportError("'mes' debe estar entre 1 y 12")
+        if self.anio is not None and not 2000 <= self.anio <= 2100:
+            raise ExportError("'anio' fuera de rango")
+        # Se interpola en el row_restriction de BigQuery: solo se aceptan códigos simples
+        if self.codigo_tienda is not None and not _CODIGO_TIENDA_RE.match(self.codigo_tienda):
+            raise ExportError("'codigo_tienda' inválido")
+        return self
+
+    def row_restriction(self) -> str:
+        """Filtro en SQL estándar para la sesión de lectura (vacío = todas las filas)"""
+        conditions = []
+        if self.anio is not None:
+            conditions.append(f"anio = {int(self.anio)}")
+        if self.mes is not None:
+            conditions.append(f"mes = {int(self.mes)}")
+        if self.codigo_tienda is not None:
+            conditions.append(f'codigo_tienda = "{self.codigo_tienda}"')
+        return " AND ".join(conditions)
+
+
+class ExportSession(NamedTuple):
+    schema: "pa.Schema"
+    streams: List[Callable[[], Iterable["pa.RecordBatch"]]]
+
+
+class ReadSource(ABC):
+    """Fuente de record batches de Arrow para la exportación"""
+
+    name = "base"
+
+    @abstractmethod
+    def open(self, filters: ExportFilters, max_streams: int) -> ExportSession:
+        """Abrir una lectura: esquema y una función por stream que itera sus batches"""
+
+
+class StorageReadSource(ReadSource):
+    """BigQuery Storage Read API en formato Arrow"""
+
+    name = "storage_read"
+
+    def __init__(self, project_id: str, dataset_id: str, table_id: str):
+        # Import diferido: google-cloud-bigquery-storage es una dependencia opcional
+        from google.cloud import bigquery_storage_v1
+
+        self.types = bigquery_storage_v1.types
+        self.client = bigquery_storage_v1.BigQueryReadClient()
+        self.project_id = project_id
+        self.table_path = f"projects/{project_id}/datasets/{dataset_id}/tables/{table_id}"
+
+    def open(self, filters: ExportFilters, max_streams: int) -> ExportSession:
+        requested = self.types.ReadSession(
+            table=self.table_path,
+            data_format=self.types.DataFormat.ARROW,
+            read_options=self.types.ReadSession.TableReadOptions(
+                selected_fields=list(EXPORT_COLUMNS),
+                row_restriction=filters.row_restriction(),
+            ),
+        )
+        session = self.client.create_read_session(
+            parent=f"projects/{self.project_id}", read_session=requested, max_stream_count=max_streams
+        )
+        schema = pa.ipc.read_schema(pa.py_buffer(session.arrow_schema.serialized_schema))
+
+        def stream_reader(stream_name: str):
+            def read():
+                for page in self.client.read_rows(stream_name).rows(session).pages:
+                    yield page.to_arrow()
+            return read
+
+        # Sin filas que coincidan BigQuery no crea streams: el esquema alcanza para el encabezado
+        return ExportSession(schema, [stream_reader(stream.name) for stream in session.streams])
+
+
+class MemoryReadSource(ReadSource):
+    """Fake local: filtra las filas en memoria y las reparte en batches entre varios streams"""
+
+    name = "memory"
+
+    def __init__(self, load_rows: Callable[[], List[Dict]], batch_size: int = 1000):
+        self.load_rows = load_rows
+        self.batch_size = batch_size
+
+    def open(self, filters: ExportFilters, max_streams: int) -> ExportSession:
+        from invoice_archive import rows_to_table
+
+        table = rows_to_table(list(self.load_rows()))
+        mask = None
+        for condition in (
+            pc.equal(table['anio'], filters.anio) if filters.anio is not None else None,
+            pc.equal(table['mes'], filters.mes) if filters.mes is not None else None,
+            pc.equal(table['codigo_tienda'], filters.codigo_tienda) if filters.codigo_tienda is not None else None,
+        ):
+            if condition is not None:
+                mask = condition if mask is None else pc.and_(mask, condition)
+        if mask is not None:
+            table = table.filter(mask)
+        table = table.select(list(EXPORT_COLUMNS))
+        batches = table.to_batches(max_chunksize=self.batch_size)
+        count = min(max_streams, len(batches))
+        return ExportSession(table.schema, [(lambda i=i: batches[i::count]) for i in range(count)])
+
+
+def create_read_source(kind: str, project_id: Optional[str] = None, dataset_id: Optional[str] = None,
+                       table_id: Optional[str] = None,
+                       load_rows: Optional[Callable[[], List[Dict]]] = None) -> ReadSource:
+    """Crear la fuente configurada ('storage_read' o 'memory')"""
+    if pa is None:
+        raise RuntimeError("pyarrow no está instalado")
+    if kind == MemoryReadSource.name:
+        return MemoryReadSource(load_rows or (lambda: []))
+    return StorageReadSource(project_id, dataset_id, table_id)
+
+
+_DONE = object()
+
+
+def merge_streams(streams: List[Callable[[], Iterable["pa.RecordBatch"]]],
+                  prefetch: int = 8, stop: Optional[threading.Event] = None) -> Iterator["pa.RecordBatch"]:
+    """
+    Leer los streams en paralelo (un hilo por stream) y entregar los batches a medida que
+    llegan. La cola acotada frena a los lectores si el cliente consume más lento.
+    Con stop activado (ej. el cliente se desconectó) los lectores y el generador terminan.
+    """
+    batches: "queue.Queue" = queue.Queue(maxsize=max(1, prefetch))
+    stop = stop or threading.Event()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def read(stream):
+        iterator = iter(stream())
+        try:
+            for batch in iterator:
+                if not put(batch):
+                    return
+        except Exception as e:
+            put(e)
+        finally:
+            # Cerrar el iterador de la fuente libera su stream de lectura (gRPC) si se cortó antes
+            close = getattr(iterator, 'close', None)
+            if close is not None:
+                close()
+            put(_DONE)
+
+    threads = [threading.Thread(target=read, args=(stream,), name=f"export-stream-{i}", daemon=True)
+               for i, stream in enumerate(streams)]
+    for thread in threads:
+        thread.start()
+    try:
+        remaining = len(threads)
+        while remaining and not stop.is_set():
+            try:
+                item = batches.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if item is _DONE:
+                remaining -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield item
+    finally:
+        # Cliente desconectado o error: los lectores bloqueados en put() terminan solos
+        stop.set()
+
+
+class _ChunkSink:
+    """Archivo de escritura en memoria del que se retira lo escrito después de cada batch"""
+
+    closed = False
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+        self._position = 0
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self):
+        pass
+
+    def take(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def encode(batches: Iterable["pa.RecordBatch"], schema: "pa.Schema", fmt: str) -> Iterator[bytes]:
+    """Serializar los batches en CSV (con encabezado) o Parquet, un bloque por batch"""
+    sink = _ChunkSink()
+    if fmt == "parquet":
+        writer = pq.ParquetWriter(sink, schema, compression='snappy')
+    else:
+        writer = pa_csv.CSVWriter(sink, schema)
+    try:
+        for batch in batches:
+            writer.write_batch(batch)
+            chunk = sink.take()
+            if chunk:
+                yield chunk
+    finally:
+        writer.close()
+    chunk = sink.take()
+    if chunk:
+        yield chunk
+
+
+class ExportStream:
+    """
+    Bloques del archivo exportado. close() corta la lectura aunque el generador esté
+    esperando un batch en otro hilo (el de la respuesta en streaming).
+    """
+
+    def __init__(self, chunks: Iterator[bytes], stop: threading.Event):
+        self._chunks = chunks
+        self._stop = stop
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> bytes:
+        return next(self._chunks)
+
+    def close(self):
+        self._stop.set()
+        try:
+            self._chunks.close()
+        except ValueError:
+            pass  # Se está ejecutando en otro hilo: termina solo al ver stop
+
+
+def export_invoices(source: ReadSource, filters: ExportFilters, fmt: str, max_streams: int = 4,
+                    prefetch: int = 8, on_batch: Optional[Callable[[int], None]] = None) -> ExportStream:
+    """
+    Abrir la lectura (los errores de la fuente salen acá, antes de empezar a responder) y
+    retornar los bloques del archivo exportado.
+    """
+    if fmt not in FORMATS:
+        raise ExportError(f"'format' debe ser uno de: {', '.join(FORMATS)}")
+    session = source.open(filters.validate(), max_streams)
+    stop = threading.Event()
+
+    def counted(batches):
+        for batch in batches:
+            if on_batch is not None:
+                on_batch(batch.num_rows)
+            yield batch
+
+    return ExportStream(encode(counted(merge_streams(session.streams, prefetch, stop)), session.schema, fmt), stop)
@@ -0,0 +1,209 @@
+"""
+Índice en memoria de las facturas guardadas recientemente.
+Mapas hash por campo (tienda, usuario, boleta, ticket) más un índice ordenado por fecha
+permiten listar y buscar sin consultar BigQuery. Se precarga al iniciar y se actualiza en
+cada guardado. Es por proceso: con varios workers de uvicorn cada uno tiene su copia.
+"""
+import base64
+import bisect
+import heapq
+import json
+import logging
+import threading
+from datetime import date, datetime, time as dt_time, timedelta, timezone
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Campos con índice hash (búsqueda por igualdad)
+INDEXED_FIELDS = ('codigo_tienda', 'usuario_carga', 'id_boleta', 'ticket_electronico')
+
+
+class InvalidCursor(ValueError):
+    """Cursor de paginación mal formado"""
+
+
+def _sort_key(row: Dict) -> Tuple[str, str, str]:
+    # Orden de listado: fecha (o día de carga si falta), fecha de carga, id_check (desempate)
+    fecha_carga = row.get('fecha_carga') or ''
+    return (row.get('fecha') or fecha_carga[:10], fecha_carga, row['id_check'])
+
+
+def encode_cursor(key: Tuple[str, str, str]) -> str:
+    return base64.urlsafe_b64encode(json.dumps(list(key)).encode('utf-8')).rstrip(b'=').decode('ascii')
+
+
+def decode_cursor(cursor: str) -> Tuple[str, str, str]:
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        if not isinstance(key, list) or len(key) != 3 or not all(isinstance(k, str) for k in key):
+            raise ValueError("estructura inesperada")
+        return tuple(key)
+    except (ValueError, TypeError) as e:
+        raise InvalidCursor(f"Cursor inválido: {e}")
+
+
+def normalize_row(row: Dict) -> Dict:
+    """Convertir una fila leída de BigQuery (date, datetime, time) al formato de insert_rows_json"""
+    normalized = {}
+    for name, value in row.items():
+        if isinstance(value, datetime):
+            if value.tzinfo is not None:
+                value = value.astimezone(timezone.utc).replace(tzinfo=None).isoformat() + 'Z'
+            else:
+                value = value.isoformat()
+        elif isinstance(value, (date, dt_time)):
+            value = value.isoformat()
+        normalized[name] = value
+    return normalized
+
+
+class InvoiceIndex:
+    """Índice de facturas recientes: hash por campo + lista ordenada por fecha"""
+
+    def __init__(self, retention_days: int = 30, max_rows: int = 200_000):
+        self.retention_days = retention_days
+        self.max_rows = max_rows
+        self.warm = False
+        self._rows: Dict[str, Dict] = {}
+        self._by_field: Dict[str, Dict[str, Set[str]]] = {field: {} for field in INDEXED_FIELDS}
+        self._by_date: List[Tuple[str, str, str]] = []
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._rows)
+
+    def cutoff(self) -> str:
+        """Fecha mínima (YYYY-MM-DD) que se mantiene en el índice"""
+        return (date.today() - timedelta(days=self.retention_days)).isoformat()
+
+    def _remove(self, id_check: str):
+        row = self._rows.pop(id_check, None)
+        if row is None:
+            return
+        for field in INDEXED_FIELDS:
+            value = row.get(field)
+            if value is not None:
+                ids = self._by_field[field].get(value)
+                if ids is not None:
+                    ids.discard(id_check)
+                    if not ids:
+                        del self._by_field[field][value]
+        key = _sort_key(row)
+        position = bisect.bisect_left(self._by_date, key)
+        if position < len(self._by_date) and self._by_date[position] == key:
+            del self._by_date[position]
+
+    def _add(self, row: Dict, keep_sorted: bool = True):
+        id_check = row.get('id_check')
+        if not id_check:
+            return
+        self._remove(id_check)  # Un reguardado reemplaza la versión anterior
+        self._rows[id_check] = row
+        for field in INDEXED_FIELDS:
+            value = row.get(field)
+            if value is not None:
+                self._by_field[field].setdefault(value, set()).add(id_check)
+        if keep_sorted:
+            bisect.insort(self._by_date, _sort_key(row))
+
+    def _evict(self):
+        """Descartar filas fuera de la ventana de retención o por sobre el máximo (las más antiguas)"""
+        cutoff = self.cutoff()
+        while self._by_date and (len(self._by_date) > self.max_rows or self._by_date[0][0] < cutoff):
+            self._remove(self._by_date[0][2])
+
+    def add(self, row: Dict):
+        """Registrar una fila guardada (mismo formato que la fila insertada en BigQuery)"""
+        with self._lock:
+            self._add(dict(row))
+            self._evict()
+
+    def load(self, rows: Iterable[Dict]) -> int:
+        """Cargar muchas filas (precarga). Retorna la cantidad de filas indexadas."""
+        with self._lock:
+            # Carga masiva: indexar sin insort y ordenar el índice de fechas una sola vez
+            for row in rows:
+                row = normalize_row(dict(row))
+                id_check = row.get('id_check')
+                if id_check in self._rows:
+                    self._remove(id_check)
+                self._add(row, keep_sorted=False)
+            self._by_date = sorted(_sort_key(row) for row in self._rows.values())
+            self._evict()
+            self.warm = True
+            return len(self._rows)
+
+    def warm_from_bigquery(self, client, table_id: str) -> int:
+        """Precargar con las filas de BigQuery dentro de la ventana de retención"""
+        from google.cloud import bigquery
+
+        job = client.query(
+            f"SELECT * FROM `{table_id}` WHERE fecha >= @desde",
+            job_config=bigquery.QueryJobConfig(query_parameters=[
+                bigquery.ScalarQueryParameter('desde', 'DATE', self.cutoff()),
+            ]),
+        )
+        return self.load(dict(row.items()) for row in job.result(page_size=10_000))
+
+    def query(self, filters: Optional[Dict[str, str]] = None, desde: Optional[str] = None,
+              hasta: Optional[str] = None, limit: int = 50,
+              cursor: Optional[str] = None) -> Tuple[List[Dict], Optional[str]]:
+        """
+        Buscar facturas, de la más reciente a la más antigua.
+
+        Args:
+            filters: igualdad sobre campos de INDEXED_FIELDS
+            desde, hasta: rango de fecha (YYYY-MM-DD, inclusivo)
+            cursor: valor next_cursor de la página anterior
+
+        Returns:
+            (filas de la página, cursor de la página siguiente o None)
+        """
+        filters = {k: v for k, v in (filters or {}).items() if v is not None}
+        after = decode_cursor(cursor) if cursor else None
+        # Límite superior exclusivo del recorrido: el cursor o el fin del día 'hasta'
+        upper = after
+        if hasta is not None:
+            day_end = (hasta, '\uffff', '')
+            upper = min(upper, day_end) if upper else day_end
+
+        with self._lock:
+            smallest = min((len(self._by_field[f].get(v, ())) for f, v in filters.items()), default=0)
+            # Con filtros poco selectivos conviene recorrer el índice de fechas y verificar cada
+            # fila (~limit * N / |conjunto| pasos) en vez de ordenar todo el conjunto candidato
+            if filters and smallest * smallest <= len(self._rows) * (limit + 1):
+                # Intersectar empezando por el conjunto más chico
+                sets = sorted((self._by_field[f].get(v, set()) for f, v in filters.items()), key=len)
+                candidates = set(sets[0]).intersection(*sets[1:])
+                page_keys = heapq.nlargest(
+                    limit + 1,
+                    (key for key in (_sort_key(self._rows[i]) for i in candidates)
+                     if (upper is None or key < upper) and (desde is None or key[0] >= desde)),
+                )
+            else:
+                end = bisect.bisect_left(self._by_date, upper) if upper else len(self._by_date)
+                page_keys = []
+                for position in range(end - 1, -1, -1):
+                    key = self._by_date[position]
+                    if desde is not None and key[0] < desde:
+                        break
+                    row = self._rows[key[2]]
+                    if any(row.get(f) != v for f, v in filters.items()):
+                        continue
+                    page_keys.append(key)
+                    if len(page_keys) > limit:
+                        break
+            items = [dict(self._rows[key[2]]) for key in page_keys[:limit]]
+
+        next_cursor = encode_cursor(page_keys[limit - 1]) if len(page_keys) > limit else None
+        return items, next_cursor
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "rows": len(self._rows),
+                "warm": self.warm,
+                "retention_days": self.retention_days,
+                "oldest_fecha": self._by_date[0][0] if self._by_date else None,
+            }
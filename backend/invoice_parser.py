@@ -2,10 +2,32 @@
 Módulo para parsear y mapear texto extraído de facturas al esquema de BigQuery.
 Implementa la lógica de extracción y derivación según las especificaciones.
 """
+import logging
 import re
+import time
 import uuid
 from datetime import datetime
-from typing import Dict, Optional
+from typing import Optional, Tuple
+
+import metrics
+from invoice_confidence import score_fields
+from invoice_record import InvoiceRecord
+
+logger = logging.getLogger(__name__)
+
+# Límites del parseo de texto (configurables con set_limits)
+MAX_TEXT_CHARS = 20000        # Un ticket tiene unos pocos miles de caracteres
+MAX_LINE_CHARS = 300
+PARSE_BUDGET_SECONDS = None   # Tiempo máximo por factura (None = sin límite)
+
+
+def set_limits(max_text_chars: int = MAX_TEXT_CHARS, max_line_chars: int = MAX_LINE_CHARS,
+               budget_seconds: Optional[float] = PARSE_BUDGET_SECONDS):
+    """Configurar los límites del parseo de texto para todo el proceso"""
+    global MAX_TEXT_CHARS, MAX_LINE_CHARS, PARSE_BUDGET_SECONDS
+    MAX_TEXT_CHARS = max_text_chars
+    MAX_LINE_CHARS = max_line_chars
+    PARSE_BUDGET_SECONDS = budget_seconds or None
 
 
 def extract_id_caja(text: str) -> Optional[str]:
@@ -59,17 +81,24 @@ def extract_fecha(text: str) -> Optional[str]:
     Extrae el valor después de la palabra 'Fecha' y formatea a YYYY-MM-DD.
     Ejemplo: "Fecha 06/11/24" -> "2024-11-06"
     """
+    return _match_fecha(text)[0]
+
+
+def _match_fecha(text: str) -> Tuple[Optional[str], Optional[int]]:
+    """extract_fecha con el nivel del patrón: 0 = 'Fecha ...', 1 = primera fecha del texto"""
     # Buscar patrón "Fecha" seguido de fecha
     pattern = r'Fecha\s+(\d{1,2}[/-]\d{1,2}[/-]\d{2,4})'
     match = re.search(pattern, text, re.IGNORECASE)
+    tier = 0
     if not match:
         # Buscar patrón alternativo sin palabra "Fecha"
         pattern_alt = r'\b(\d{1,2}[/-]\d{1,2}[/-]\d{2,4})\b'
         matches = re.findall(pattern_alt, text)
         if matches:
             match_str = matches[0]
+            tier = 1
         else:
-            return None
+            return None, None
     else:
         match_str = match.group(1)
     
@@ -89,10 +118,10 @@ def extract_fecha(text: str) -> Optional[str]:
                         year += 2000
                     
                     fecha_obj = datetime(year, month, day)
-                    return fecha_obj.strftime('%Y-%m-%d')
+                    return fecha_obj.strftime('%Y-%m-%d'), tier
                 except (ValueError, IndexError):
                     continue
-    return None
+    return None, None
 
 
 def extract_hora(text: str) -> Optional[str]:
@@ -100,18 +129,23 @@ def extract_hora(text: str) -> Optional[str]:
     Extrae el valor después de la palabra 'Hora'.
     Ejemplo: "Hora 16:05:47" -> "16:05:47"
     """
+    return _match_hora(text)[0]
+
+
+def _match_hora(text: str) -> Tuple[Optional[str], Optional[int]]:
+    """extract_hora con el nivel del patrón: 0 = 'Hora ...', 1 = primera hora del texto"""
     pattern = r'Hora\s+(\d{1,2}:\d{2}:\d{2})'
     match = re.search(pattern, text, re.IGNORECASE)
     if match:
-        return match.group(1)
+        return match.group(1), 0
     
     # Buscar patrón de hora sin palabra "Hora"
     pattern_alt = r'\b(\d{1,2}:\d{2}:\d{2})\b'
     match_alt = re.search(pattern_alt, text)
     if match_alt:
-        return match_alt.group(1)
+        return match_alt.group(1), 1
     
-    return None
+    return None, None
 
 
 def extract_ticket_electronico(text: str) -> Optional[str]:
@@ -131,6 +165,11 @@ def extract_id_boleta(text: str) -> Optional[str]:
     Extrae el número después de 'Nro T.'.
     Ejemplo: "Nro T. 00142012" -> "00142012"
     """
+    return _match_id_boleta(text)[0]
+
+
+def _match_id_boleta(text: str) -> Tuple[Optional[str], Optional[int]]:
+    """extract_id_boleta con el índice del patrón que coincidió"""
     patterns = [
         r'Nro\s+T\.?\s+(\d+)',
         r'Nro\s+Ticket\s+(\d+)',
@@ -138,12 +177,12 @@ def extract_id_boleta(text: str) -> Optional[str]:
         r'Factura\s+N°?\s*(\d+)',
     ]
     
-    for pattern in patterns:
+    for tier, pattern in enumerate(patterns):
         match = re.search(pattern, text, re.IGNORECASE)
         if match:
-            return match.group(1)
+            return match.group(1), tier
     
-    return None
+    return None, None
 
 
 def _parse_amount_string(amount_str: str) -> Optional[float]:
@@ -177,21 +216,26 @@ def extract_monto_op_gravada(text: str) -> Optional[float]:
     Extrae el valor numérico de la línea 'SUBTOTAL SIN DESCUENTOS' o 'TOTAL'.
     Ejemplo: "SUBTOTAL SIN DESCUENTOS $ 2690,00" -> 2690.00
     """
+    return _match_monto_op_gravada(text)[0]
+
+
+def _match_monto_op_gravada(text: str) -> Tuple[Optional[float], Optional[int]]:
+    """extract_monto_op_gravada con el índice del patrón que coincidió"""
     patterns = [
         r'SUBTOTAL\s+SIN\s+DESCUENTOS\s*\$?\s*(\d{1,3}(?:[.,]\d{3})*[.,]\d{2})',
         r'SUBTOTAL\s*\$?\s*(\d{1,3}(?:[.,]\d{3})*[.,]\d{2})',
         r'TOTAL\s*\$?\s*(\d{1,3}(?:[.,]\d{3})*[.,]\d{2})',
     ]
     
-    for pattern in patterns:
+    for tier, pattern in enumerate(patterns):
         match = re.search(pattern, text, re.IGNORECASE)
         if match:
             monto_str = match.group(1)
             parsed = _parse_amount_string(monto_str)
             if parsed is not None:
-                return parsed
+                return parsed, tier
     
-    return None
+    return None, None
 
 
 def extract_importe_total(text: str) -> Optional[float]:
@@ -199,16 +243,22 @@ def extract_importe_total(text: str) -> Optional[float]:
     Extrae el valor numérico principal de la línea 'TOTAL'.
     Ejemplo: "TOTAL $ 2690.00" -> 2690.00
     """
+    return _match_importe_total(text)[0]
+
+
+def _match_importe_total(text: str) -> Tuple[Optional[float], Optional[int]]:
+    """extract_importe_total con el nivel: 0 = línea 'TOTAL', 1 = copia de monto_op_gravada"""
     pattern = r'TOTAL\s*\$?\s*(\d{1,3}(?:[.,]\d{3})*[.,]\d{2})'
     match = re.search(pattern, text, re.IGNORECASE)
     if match:
         monto_str = match.group(1)
         parsed = _parse_amount_string(monto_str)
         if parsed is not None:
-            return parsed
+            return parsed, 0
     
     # Si no se encuentra, usar el mismo que monto_op_gravada
-    return extract_monto_op_gravada(text)
+    monto_op_gravada, _ = _match_monto_op_gravada(text)
+    return monto_op_gravada, 1 if monto_op_gravada is not None else None
 
 
 def extract_a_c(text: str) -> Optional[str]:
@@ -216,10 +266,15 @@ def extract_a_c(text: str) -> Optional[str]:
     Extrae el código al final de la línea que contiene 'Art:'.
     Ejemplo: "... AC-04" -> "AC-04"
     """
+    return _match_a_c(text)[0]
+
+
+def _match_a_c(text: str) -> Tuple[Optional[str], Optional[int]]:
+    """extract_a_c con el nivel: 0 = línea 'Art:', 1 = código al final de una línea"""
     pattern = r'Art:?\s*.*?([A-Z]{1,3}-\d{1,3})'
     match = re.search(pattern, text, re.IGNORECASE)
     if match:
-        return match.group(1)
+        return match.group(1), 0
     
     # Buscar patrón alternativo al final de líneas
     pattern_alt = r'([A-Z]{1,3}-\d{1,3})\s*$'
@@ -227,12 +282,12 @@ def extract_a_c(text: str) -> Optional[str]:
     for line in lines:
         match_alt = re.search(pattern_alt, line)
         if match_alt:
-            return match_alt.group(1)
+            return match_alt.group(1), 1
     
-    return None
+    return None, None
 
 
-def parse_structured_data(structured_data: list) -> Dict:
+def parse_structured_data(structured_data: list) -> InvoiceRecord:
     """
     Parsea datos estructurados en formato array de objetos con 'clave' y 'valor'.
     
@@ -240,7 +295,7 @@ def parse_structured_data(structured_data: list) -> Dict:
         structured_data: Lista de objetos con formato [{"clave": "...", "valor": "..."}, ...]
         
     Returns:
-        Diccionario con todos los campos mapeados según el esquema de BigQuery
+        InvoiceRecord con todos los campos mapeados según el esquema de BigQuery
     """
     # Convertir array a diccionario para fácil acceso
     data_dict = {}
@@ -261,15 +316,19 @@ def parse_structured_data(structured_data: list) -> Dict:
     # Extraer fecha y hora para campos derivados
     fecha_str = None
     hora_str = None
+    # Nivel de cada valor para la confianza: 0 = formato esperado, 1 = convertido
+    tiers = {}
     
     # Mapear campos del formato estructurado al esquema de BigQuery
     if 'fecha' in data_dict:
         fecha_str = str(data_dict['fecha']).strip()
+        tiers['fecha'] = 0
         # Asegurar formato YYYY-MM-DD
         try:
             # Si viene en formato YYYY-MM-DD, validar
             datetime.strptime(fecha_str, '%Y-%m-%d')
         except ValueError:
+            tiers['fecha'] = 1
             # Intentar otros formatos
             try:
                 fecha_obj = datetime.strptime(fecha_str, '%d/%m/%Y')
@@ -283,11 +342,13 @@ def parse_structured_data(structured_data: list) -> Dict:
     
     if 'hora' in data_dict:
         hora_str = str(data_dict['hora']).strip()
+        tiers['hora'] = 0
         # Asegurar formato HH:MM:SS
         if ':' in hora_str:
             parts = hora_str.split(':')
             if len(parts) == 2:
                 hora_str = f"{parts[0]}:{parts[1]}:00"
+                tiers['hora'] = 1
             elif len(parts) == 3:
                 hora_str = hora_str
             else:
@@ -332,6 +393,7 @@ def parse_structured_data(structured_data: list) -> Dict:
     if 'importe_total' in data_dict:
         try:
             importe_total = float(data_dict['importe_total'])
+            tiers['importe_total'] = 0 if isinstance(data_dict['importe_total'], (int, float)) else 1
         except (ValueError, TypeError):
             importe_total = 0.0
     
@@ -362,48 +424,119 @@ def parse_structured_data(structured_data: list) -> Dict:
         except (ValueError, TypeError):
             monto_tarifario = 0.0
     
-    mapped_data = {
-        "id_caja": id_caja,
-        "canal": canal,
-        "codigo_tienda": codigo_tienda,
-        "tienda_nombre": tienda_nombre,
-        "fecha": fecha_str,
-        "hora": hora_str,
-        "ticket_electronico": ticket_electronico,
-        "id_boleta": id_boleta,
-        "id_check": id_check,
-        "monto_op_gravada": importe_total,  # Por defecto igual al importe_total
-        "importe_total": importe_total,
-        "recargo_consumo": recargo_consumo,  # Extraído del data_dict o 0.0 por defecto
-        "monto_tarifario": monto_tarifario,  # Extraído del data_dict o 0.0 por defecto
-        "mes": mes,
-        "anio": anio,
-        "momento": momento,
-        "a_c": data_dict.get('a_c') or None
-    }
+    mapped_data = InvoiceRecord(
+        id_caja=id_caja,
+        canal=canal,
+        codigo_tienda=codigo_tienda,
+        tienda_nombre=tienda_nombre,
+        fecha=fecha_str,
+        hora=hora_str,
+        ticket_electronico=ticket_electronico,
+        id_boleta=id_boleta,
+        id_check=id_check,
+        monto_op_gravada=importe_total,  # Por defecto igual al importe_total
+        importe_total=importe_total,
+        recargo_consumo=recargo_consumo,  # Extraído del data_dict o 0.0 por defecto
+        monto_tarifario=monto_tarifario,  # Extraído del data_dict o 0.0 por defecto
+        mes=mes,
+        anio=anio,
+        momento=momento,
+        a_c=data_dict.get('a_c') or None
+    )
+    
+    # Los campos de texto valen lo mismo si llegaron; monto_op_gravada es copia de importe_total
+    for field in ('id_caja', 'canal', 'codigo_tienda', 'tienda_nombre', 'ticket_electronico', 'id_boleta', 'a_c'):
+        tiers[field] = 0
+    tiers.setdefault('fecha', None)
+    tiers.setdefault('hora', None)
+    tiers.setdefault('importe_total', None)
+    tiers['monto_op_gravada'] = tiers['importe_total']
+    mapped_data.confidence = score_fields(mapped_data, tiers, structured=True)
     
     return mapped_data
 
 
-def parse_and_map_invoice(raw_text: str) -> Dict:
+def _single(extract):
+    """Adaptar un extractor de un solo patrón a la forma (valor, nivel)"""
+    def match(text: str):
+        value = extract(text)
+        return value, 0 if value else None
+    return match
+
+
+# Campos del texto en orden de importancia: si se agota el tiempo quedan sin extraer los últimos
+_TEXT_FIELDS = (
+    ('fecha', _match_fecha),
+    ('hora', _match_hora),
+    ('importe_total', _match_importe_total),
+    ('monto_op_gravada', _match_monto_op_gravada),
+    ('codigo_tienda', _single(extract_codigo_tienda)),
+    ('tienda_nombre', _single(extract_tienda_nombre)),
+    ('id_boleta', _match_id_boleta),
+    ('ticket_electronico', _single(extract_ticket_electronico)),
+    ('id_caja', _single(extract_id_caja)),
+    ('a_c', _match_a_c),
+)
+
+
+def limit_text(text: str) -> str:
+    """
+    Acotar el texto antes de aplicar los patrones: líneas de más de MAX_LINE_CHARS se cortan
+    (un ticket no tiene líneas tan largas; basura del OCR sí) y el total a MAX_TEXT_CHARS.
+    Así el costo de cada patrón queda acotado aunque el OCR devuelva un texto enorme.
+    """
+    truncated = len(text) > MAX_TEXT_CHARS
+    text = text[:MAX_TEXT_CHARS]
+    lines = text.split('\n')
+    if any(len(line) > MAX_LINE_CHARS for line in lines):
+        truncated = True
+        text = '\n'.join(line[:MAX_LINE_CHARS] for line in lines)
+    if truncated:
+        metrics.inc('parse_text_truncated_total')
+    return text
+
+
+def parse_and_map_invoice(raw_text: str) -> InvoiceRecord:
     """
     Función principal que parsea el texto y mapea todos los campos al esquema de BigQuery.
+    Si el parseo supera PARSE_BUDGET_SECONDS se corta entre campos y se retorna lo extraído
+    hasta ahí con incomplete=True (los campos faltantes quedan con confianza 0).
     
     Args:
         raw_text: Texto crudo extraído por OCR
         
     Returns:
-        Diccionario con todos los campos mapeados según el esquema de BigQuery
+        InvoiceRecord con todos los campos mapeados según el esquema de BigQuery
     """
     if not raw_text:
         raw_text = ""
     
-    # Normalizar el texto
-    normalized_text = raw_text.replace('\\n', '\n')
-    
-    # Extraer fecha y hora para campos derivados
-    fecha_str = extract_fecha(normalized_text)
-    hora_str = extract_hora(normalized_text)
+    # Normalizar y acotar el texto
+    normalized_text = limit_text(raw_text.replace('\\n', '\n'))
+    
+    # Extraer campo por campo (con el nivel de patrón para la confianza) controlando el tiempo
+    deadline = time.perf_counter() + PARSE_BUDGET_SECONDS if PARSE_BUDGET_SECONDS else None
+    values = {}
+    tiers = {'canal': None}
+    incomplete = False
+    for field, match in _TEXT_FIELDS:
+        # El primer campo (fecha) se extrae siempre; el resto mientras quede tiempo
+        if values and deadline is not None and time.perf_counter() > deadline:
+            incomplete = True
+            break
+        values[field], tiers[field] = match(normalized_text)
+    if incomplete:
+        metrics.inc('parse_budget_exceeded_total')
+        missing = [field for field, _ in _TEXT_FIELDS if field not in values]
+        logger.warning(
+            f"⚠️ Parseo cortado por tiempo ({PARSE_BUDGET_SECONDS}s, {len(normalized_text)} caracteres); "
+            f"sin extraer: {', '.join(missing)}"
+        )
+        for field in missing:
+            tiers[field] = None
+    
+    fecha_str = values.get('fecha')
+    hora_str = values.get('hora')
     
     # Calcular campos derivados
     mes = None
@@ -428,29 +561,32 @@ def parse_and_map_invoice(raw_text: str) -> Dict:
     # Generar id_check (UUID v4)
     id_check = str(uuid.uuid4())
     
-    # Extraer montos
-    monto_op_gravada = extract_monto_op_gravada(normalized_text)
-    importe_total = extract_importe_total(normalized_text)
+    monto_op_gravada = values.get('monto_op_gravada')
+    importe_total = values.get('importe_total')
     
     # Construir objeto mapeado
-    mapped_data = {
-        "id_caja": extract_id_caja(normalized_text),
-        "canal": None,  # Se llenará en el frontend
-        "codigo_tienda": extract_codigo_tienda(normalized_text),
-        "tienda_nombre": extract_tienda_nombre(normalized_text),
-        "fecha": fecha_str,
-        "hora": hora_str,
-        "ticket_electronico": extract_ticket_electronico(normalized_text),
-        "id_boleta": extract_id_boleta(normalized_text),
-        "id_check": id_check,
-        "monto_op_gravada": monto_op_gravada if monto_op_gravada is not None else 0.0,
-        "importe_total": importe_total if importe_total is not None else 0.0,
-        "recargo_consumo": 0.0,  # Valor por defecto
-        "monto_tarifario": 0.0,  # Valor por defecto
-        "mes": mes,
-        "anio": anio,
-        "momento": momento,
-        "a_c": extract_a_c(normalized_text)
-    }
+    mapped_data = InvoiceRecord(
+        id_caja=values.get('id_caja'),
+        canal=None,  # Se llenará en el frontend
+        codigo_tienda=values.get('codigo_tienda'),
+        tienda_nombre=values.get('tienda_nombre'),
+        fecha=fecha_str,
+        hora=hora_str,
+        ticket_electronico=values.get('ticket_electronico'),
+        id_boleta=values.get('id_boleta'),
+        id_check=id_check,
+        monto_op_gravada=monto_op_gravada if monto_op_gravada is not None else 0.0,
+        importe_total=importe_total if importe_total is not None else 0.0,
+        recargo_consumo=0.0,  # Valor por defecto
+        monto_tarifario=0.0,  # Valor por defecto
+        mes=mes,
+        anio=anio,
+        momento=momento,
+        a_c=values.get('a_c'),
+        incomplete=incomplete
+    )
+    
+    # Confianza por campo: los de un solo patrón valen su puntaje base si se encontraron
+    mapped_data.confidence = score_fields(mapped_data, tiers)
     
     return mapped_data
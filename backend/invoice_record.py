@@ -0,0 +1,102 @@
+"""
+Registro interno compacto de una factura (dataclass con __slots__).
+Los parsers lo construyen directamente y se serializa a JSON (respuesta de la API) o a fila
+de BigQuery sin pasar por dicts intermedios ni modelos Pydantic. Conserva la interfaz de
+mapping (r['campo'], r.get(), r.items()) para el código que trataba el resultado como dict.
+"""
+from dataclasses import dataclass, fields
+from typing import ClassVar, Dict, Optional, Tuple, Union
+
+import fast_json
+from bigquery_sinks import INVOICE_ROW_SCHEMA
+
+# Campos numéricos que se envían como FLOAT a BigQuery
+_FLOAT_FIELDS = frozenset(name for name, field_type in INVOICE_ROW_SCHEMA if field_type == "FLOAT")
+
+
+@dataclass(slots=True)
+class InvoiceRecord:
+    """Factura extraída por OCR (mismos campos que MappedInvoiceData, en el mismo orden)"""
+
+    id_caja: Optional[str] = None
+    canal: Optional[str] = None
+    codigo_tienda: Optional[str] = None
+    tienda_nombre: Optional[str] = None
+    fecha: Optional[str] = None
+    hora: Optional[str] = None
+    ticket_electronico: Optional[str] = None
+    id_boleta: Optional[str] = None
+    id_check: str = ""
+    monto_op_gravada: float = 0.0
+    importe_total: float = 0.0
+    recargo_consumo: float = 0.0
+    monto_tarifario: float = 0.0
+    mes: Optional[int] = None
+    anio: Optional[int] = None
+    momento: Optional[str] = None
+    a_c: Optional[str] = None
+    raw_extracted_text: Optional[str] = None
+    confidence: Optional[Dict[str, float]] = None  # Confianza por campo (invoice_confidence)
+    incomplete: bool = False  # El parseo se cortó por tiempo y faltan campos
+
+    # Orden de campos precalculado (evita dataclasses.fields() en cada serialización)
+    FIELDS: ClassVar[Tuple[str, ...]] = ()
+    BQ_FIELDS: ClassVar[Tuple[str, ...]] = tuple(
+        name for name, _ in INVOICE_ROW_SCHEMA if name not in ('fecha_carga', 'usuario_carga')
+    )
+
+    # Interfaz de mapping: compatibilidad con el código que usaba el dict del parser
+    def __getitem__(self, key: str):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key: str, value):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key) -> bool:
+        return key in self.FIELDS
+
+    def get(self, key: str, default=None):
+        return getattr(self, key) if key in self.FIELDS else default
+
+    def keys(self):
+        return self.FIELDS
+
+    def items(self):
+        return ((name, getattr(self, name)) for name in self.FIELDS)
+
+    def to_dict(self) -> Dict:
+        return {name: getattr(self, name) for name in self.FIELDS}
+
+    def to_json(self) -> bytes:
+        """JSON de la respuesta de la API (orjson/msgspec serializan dataclasses con slots directamente)"""
+        return fast_json.dumps(self)
+
+    @classmethod
+    def from_json(cls, data: Union[bytes, str]) -> "InvoiceRecord":
+        """Decodificar un registro serializado con to_json (ej. resultado de un job)"""
+        return fast_json.loads_as(data, cls)
+
+    def to_bq_row(self, fecha_carga: str, usuario_carga: str) -> Dict:
+        """Fila para BigQuery en el orden de INVOICE_ROW_SCHEMA (montos como float)"""
+        return self.bq_row(self, fecha_carga, usuario_carga)
+
+    @classmethod
+    def bq_row(cls, source, fecha_carga: str, usuario_carga: str, **overrides) -> Dict:
+        """
+        Fila para BigQuery leyendo los atributos de source (un InvoiceRecord o un modelo
+        Pydantic como ValidatedInvoiceData) sin construir objetos intermedios.
+        """
+        row = {}
+        for name in cls.BQ_FIELDS:
+            value = overrides[name] if name in overrides else getattr(source, name)
+            row[name] = float(value) if name in _FLOAT_FIELDS and value is not None else value
+        row["fecha_carga"] = fecha_carga
+        row["usuario_carga"] = usuario_carga
+        return row
+
+
+InvoiceRecord.FIELDS = tuple(f.name for f in fields(InvoiceRecord))
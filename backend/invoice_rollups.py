@@ -0,0 +1,257 @@
+"""
+Agregados incrementales de facturas por (codigo_tienda, fecha, tipo_momento).
+Cada guardado suma su aporte a los totales del grupo; las lecturas recorren solo los grupos,
+sin consultar BigQuery. Los agregados se persisten en un JSON local para que reiniciar
+el servidor no requiera recalcularlos; el aporte de cada factura va aparte, en SQLite, para que
+el JSON (y su carga) crezca con los grupos y no con las facturas guardadas.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Montos sumados por grupo (campos de la fila de BigQuery)
+ROLLUP_AMOUNTS = ('importe_total', 'recargo_consumo', 'monto_tarifario')
+
+MOMENTO_APERTURA = "apertura"
+MOMENTO_MEDIO_DIA = "medio_dia"
+MOMENTO_CIERRE = "cierre"
+MOMENTO_SIN_HORA = "sin_hora"
+
+
+def classify_momento(momento: Optional[str]) -> str:
+    """Clasificar el momento (YYYY-MM-DDTHH:MM:SS) en apertura (<12h), cierre (>=16h) o medio día"""
+    try:
+        hora_int = datetime.fromisoformat(momento).hour
+    except (TypeError, ValueError):
+        return MOMENTO_SIN_HORA
+    if hora_int < 12:
+        return MOMENTO_APERTURA
+    if hora_int >= 16:
+        return MOMENTO_CIERRE
+    return MOMENTO_MEDIO_DIA
+
+
+def _empty_group() -> Dict:
+    group = {"tickets": 0}
+    group.update({field: 0.0 for field in ROLLUP_AMOUNTS})
+    return group
+
+
+class InvoiceRollups:
+    """
+    Totales por (codigo_tienda, fecha, tipo_momento) mantenidos en cada guardado.
+    Se recuerda el aporte de cada id_check para que volver a guardar una factura reemplace su
+    aporte en vez de contarla dos veces, también para facturas viejas. En memoria solo quedan
+    los aportes aún no persistidos; el resto se consulta por id_check en SQLite.
+    El JSON y SQLite llevan el mismo número de generación: si al cargar no coinciden (el
+    proceso murió entre ambas escrituras) se descartan y se reconstruye desde el archivo local.
+    """
+
+    def __init__(self, path: str, flush_interval: float = 30.0, contributions_path: Optional[str] = None):
+        self.path = path
+        self.contributions_path = contributions_path or os.path.splitext(path)[0] + '-contributions.sqlite3'
+        self.flush_interval = flush_interval
+        self._groups: Dict[Tuple[str, str, str], Dict] = {}
+        self._pending: Dict[str, list] = {}  # id_check -> [clave del grupo, montos] sin persistir
+        self._reset_contributions = False  # rebuild(): ignorar y vaciar los aportes persistidos
+        self._generation = 0
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._groups)
+
+    def _apply(self, key: Tuple[str, str, str], amounts: List[float], sign: int):
+        group = self._groups.setdefault(key, _empty_group())
+        group["tickets"] += sign
+        for field, amount in zip(ROLLUP_AMOUNTS, amounts):
+            group[field] += sign * amount
+        if group["tickets"] <= 0:
+            del self._groups[key]
+
+    def _db(self) -> sqlite3.Connection:
+        """Conexión (perezosa) a la base de aportes; usar con _db_lock tomado"""
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.contributions_path) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.contributions_path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS contributions ("
+                "id_check TEXT PRIMARY KEY, codigo_tienda TEXT, fecha TEXT, tipo_momento TEXT, amounts TEXT)"
+            )
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def _previous(self, id_check: str) -> Optional[list]:
+        """Aporte anterior de una factura: primero los no persistidos, luego SQLite"""
+        previous = self._pending.get(id_check)
+        if previous is not None or self._reset_contributions:
+            return previous
+        with self._db_lock:
+            found = self._db().execute(
+                "SELECT codigo_tienda, fecha, tipo_momento, amounts FROM contributions WHERE id_check = ?",
+                (id_check,),
+            ).fetchone()
+        if found is None:
+            return None
+        return [list(found[:3]), json.loads(found[3])]
+
+    def _record(self, row: Dict, tipo_momento: str):
+        key = (row.get('codigo_tienda') or '', row.get('fecha') or '', tipo_momento)
+        amounts = [float(row.get(field) or 0.0) for field in ROLLUP_AMOUNTS]
+        id_check = row.get('id_check')
+        previous = self._previous(id_check) if id_check else None
+        if previous is not None:
+            self._apply(tuple(previous[0]), previous[1], -1)
+        self._apply(key, amounts, 1)
+        if id_check:
+            self._pending[id_check] = [list(key), amounts]
+
+    def record(self, row: Dict, tipo_momento: Optional[str] = None):
+        """Sumar una fila guardada a su grupo (tipo_momento se calcula si no se indica)"""
+        with self._lock:
+            self._record(row, tipo_momento or classify_momento(row.get('momento')))
+            self._dirty = True
+
+    def rebuild(self, rows: Iterable[Dict]) -> int:
+        """Recalcular todos los agregados desde cero (ej. desde el archivo local)"""
+        with self._lock:
+            self._groups = {}
+            self._pending = {}
+            self._reset_contributions = True
+            for row in rows:
+                self._record(row, classify_momento(row.get('momento')))
+            self._dirty = True
+            return len(self._groups)
+
+    def query(self, desde: Optional[str] = None, hasta: Optional[str] = None,
+              codigo_tienda: Optional[str] = None) -> List[Dict]:
+        """
+        Totales por tienda y día con el desglose por tipo de momento, ordenados por fecha
+        descendente y tienda. Costo proporcional a la cantidad de grupos.
+        """
+        days: Dict[Tuple[str, str], Dict] = {}
+        with self._lock:
+            for (tienda, fecha, tipo_momento), group in self._groups.items():
+                if codigo_tienda is not None and tienda != codigo_tienda:
+                    continue
+                if (desde is not None and fecha < desde) or (hasta is not None and fecha > hasta):
+                    continue
+                day = days.get((tienda, fecha))
+                if day is None:
+                    day = days[(tienda, fecha)] = {"codigo_tienda": tienda, "fecha": fecha,
+                                                   **_empty_group(), "momentos": {}}
+                day["momentos"][tipo_momento] = {field: round(value, 2) if isinstance(value, float) else value
+                                                 for field, value in group.items()}
+                day["tickets"] += group["tickets"]
+                for field in ROLLUP_AMOUNTS:
+                    day[field] += group[field]
+        result = sorted(days.values(), key=lambda d: (d["fecha"], d["codigo_tienda"]), reverse=True)
+        for day in result:
+            for field in ROLLUP_AMOUNTS:
+                day[field] = round(day[field], 2)
+        return result
+
+    def load(self) -> bool:
+        """
+        Cargar los agregados persistidos. Retorna False si no hay archivo o si no coincide con
+        los aportes en SQLite (en ese caso hay que reconstruir con rebuild()).
+        """
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        with self._db_lock:
+            found = self._db().execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()
+        generation = data.get("generation")
+        if generation is None or found is None or int(found[0]) != generation:
+            logger.warning(f"⚠️ Agregados de facturas desincronizados con sus aportes "
+                           f"(JSON {generation}, SQLite {found[0] if found else None}): se descartan")
+            return False
+        with self._lock:
+            self._groups = {tuple(group["key"]): group["totals"] for group in data.get("groups", [])}
+            self._generation = generation
+            self._dirty = False
+        logger.info(f"✅ Agregados de facturas cargados: {len(self._groups)} grupos")
+        return True
+
+    def save(self):
+        """
+        Persistir los agregados si cambiaron: primero los aportes nuevos en SQLite y luego el JSON
+        (escritura atómica con archivo temporal), ambos con la misma generación.
+        """
+        with self._lock:
+            if not self._dirty:
+                return
+            self._generation += 1
+            generation = self._generation
+            pending = dict(self._pending)
+            reset = self._reset_contributions
+            data = {
+                "generation": generation,
+                "groups": [{"key": list(key), "totals": dict(totals)} for key, totals in self._groups.items()],
+            }
+            self._dirty = False
+        try:
+            with self._db_lock:
+                conn = self._db()
+                with conn:
+                    if reset:
+                        conn.execute("DELETE FROM contributions")
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO contributions (id_check, codigo_tienda, fecha, tipo_momento, amounts) "
+                        "VALUES (?, ?, ?, ?, ?)",
+                        [(id_check, *key, json.dumps(amounts)) for id_check, (key, amounts) in pending.items()],
+                    )
+                    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('generation', ?)",
+                                 (str(generation),))
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+            os.replace(tmp_path, self.path)
+        except Exception:
+            self._dirty = True  # Reintentar en el próximo ciclo
+            raise
+        with self._lock:
+            if reset:
+                self._reset_contributions = False
+            # Soltar los aportes ya persistidos (salvo los reemplazados durante la escritura)
+            for id_check, contribution in pending.items():
+                if self._pending.get(id_check) is contribution:
+                    del self._pending[id_check]
+
+    def start(self):
+        """Iniciar el hilo que persiste los agregados periódicamente"""
+        self._thread = threading.Thread(target=self._flush_loop, name="invoice-rollups", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+        self.save()
+        with self._db_lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.save()
+            except Exception as e:
+                logger.warning(f"⚠️ Error al persistir agregados de facturas: {e}")
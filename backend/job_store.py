@@ -0,0 +1,289 @@
+"""
+Jobs asíncronos de procesamiento de facturas.
+Persiste el estado de cada job en SQLite (sobrevive reinicios del worker), guarda la imagen
+en disco y ejecuta el OCR/parsing en un pool de hilos en segundo plano.
+"""
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+import fast_json
+
+logger = logging.getLogger(__name__)
+
+# Estados posibles de un job
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+TERMINAL_STATES = (JOB_DONE, JOB_FAILED)
+
+
+class JobError(Exception):
+    """Error de un job con código HTTP asociado (se guarda en el estado del job)"""
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+class JobStore:
+    """Almacén persistente de jobs en SQLite con imágenes en un directorio spool"""
+
+    def __init__(self, directory: str, ttl_seconds: int):
+        self.directory = directory
+        self.ttl_seconds = ttl_seconds
+        self.spool_dir = os.path.join(directory, 'spool')
+        os.makedirs(self.spool_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            os.path.join(directory, 'jobs.sqlite3'),
+            check_same_thread=False,
+            isolation_level=None,  # autocommit: cada sentencia es atómica
+        )
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                email TEXT NOT NULL,
+                filename TEXT,
+                content_type TEXT,
+                callback_url TEXT,
+                options TEXT,
+                result TEXT,
+                error_status INTEGER,
+                error_detail TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                expires_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_expires ON jobs(expires_at)")
+        # Bases creadas antes de la columna options (opciones de procesamiento del job)
+        columns = {row['name'] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+        if 'options' not in columns:
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN options TEXT")
+
+    def _image_path(self, job_id: str) -> str:
+        return os.path.join(self.spool_dir, f"{job_id}.bin")
+
+    def create(self, email: str, filename: str, content_type: str, content: bytes,
+               callback_url: Optional[str] = None, options: Optional[Dict] = None) -> str:
+        """
+        Registrar un job nuevo en estado 'queued' y guardar la imagen en disco.
+        options se pasa como argumentos con nombre al handler del JobRunner.
+        """
+        job_id = str(uuid.uuid4())
+        now = time.time()
+        # Escribir primero la imagen: un job en la tabla siempre tiene su imagen disponible
+        tmp_path = self._image_path(job_id) + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, self._image_path(job_id))
+        self._insert(job_id, email, filename, content_type, callback_url, options, now)
+        return job_id
+
+    def create_from_file(self, email: str, filename: str, content_type: str, path: str,
+                         callback_url: Optional[str] = None, options: Optional[Dict] = None) -> str:
+        """Registrar un job moviendo una imagen ya escrita en disco (ej. una subida por partes)"""
+        job_id = str(uuid.uuid4())
+        now = time.time()
+        shutil.move(path, self._image_path(job_id))
+        self._insert(job_id, email, filename, content_type, callback_url, options, now)
+        return job_id
+
+    def _insert(self, job_id: str, email: str, filename: str, content_type: str,
+                callback_url: Optional[str], options: Optional[Dict], now: float):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO jobs (id, status, email, filename, content_type, callback_url, options, "
+                "created_at, updated_at, expires_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, JOB_QUEUED, email, filename, content_type, callback_url,
+                 fast_json.dumps_str(options) if options else None,
+                 now, now, now + self.ttl_seconds),
+            )
+
+    def read_image(self, job_id: str) -> bytes:
+        with open(self._image_path(job_id), 'rb') as f:
+            return f.read()
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        """Obtener el estado público de un job (None si no existe o expiró)"""
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None or row['expires_at'] < time.time():
+            return None
+        job = {
+            "job_id": row['id'],
+            "status": row['status'],
+            "email": row['email'],
+            "filename": row['filename'],
+            "created_at": row['created_at'],
+            "updated_at": row['updated_at'],
+            "expires_at": row['expires_at'],
+            "result": fast_json.loads(row['result']) if row['result'] else None,
+            "error": None,
+        }
+        if row['status'] == JOB_FAILED:
+            job["error"] = {"status_code": row['error_status'], "detail": row['error_detail']}
+        return job
+
+    def get_internal(self, job_id: str) -> Optional[sqlite3.Row]:
+        with self._lock:
+            return self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+
+    def mark_running(self, job_id: str):
+        self._update(job_id, status=JOB_RUNNING)
+
+    def mark_done(self, job_id: str, result: Dict):
+        self._update(job_id, status=JOB_DONE, result=fast_json.dumps_str(result))
+        self._remove_image(job_id)
+
+    def mark_failed(self, job_id: str, status_code: int, detail: str):
+        self._update(job_id, status=JOB_FAILED, error_status=status_code, error_detail=detail)
+        self._remove_image(job_id)
+
+    def _update(self, job_id: str, **fields):
+        fields['updated_at'] = time.time()
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self._lock:
+            self._conn.execute(
+                f"UPDATE jobs SET {assignments} WHERE id = ?",
+                (*fields.values(), job_id),
+            )
+
+    def _remove_image(self, job_id: str):
+        try:
+            os.remove(self._image_path(job_id))
+        except FileNotFoundError:
+            pass
+
+    def pending_ids(self) -> List[str]:
+        """Jobs sin terminar (p. ej. interrumpidos por un reinicio) que deben re-encolarse"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id FROM jobs WHERE status IN (?, ?) AND expires_at >= ? ORDER BY created_at",
+                (JOB_QUEUED, JOB_RUNNING, time.time()),
+            ).fetchall()
+        return [row['id'] for row in rows]
+
+    def count_by_status(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status").fetchall()
+        return {row['status']: row['n'] for row in rows}
+
+    def purge_expired(self) -> int:
+        """Eliminar jobs expirados y sus imágenes. Retorna la cantidad eliminada."""
+        now = time.time()
+        with self._lock:
+            rows = self._conn.execute("SELECT id FROM jobs WHERE expires_at < ?", (now,)).fetchall()
+            self._conn.execute("DELETE FROM jobs WHERE expires_at < ?", (now,))
+        for row in rows:
+            self._remove_image(row['id'])
+        return len(rows)
+
+
+class JobRunner:
+    """
+    Pool de hilos que ejecuta los jobs y recolecta los expirados periódicamente.
+    Un job que quedó 'running' por un reinicio se vuelve a ejecutar con resumed=True además de
+    sus options: el handler decide qué efectos no repetir (el intento anterior pudo completarlos).
+    """
+
+    def __init__(self, store: JobStore, handler: Callable[..., Dict],
+                 workers: int, gc_interval: int,
+                 on_finished: Optional[Callable[[str], None]] = None):
+        self.store = store
+        self.handler = handler
+        self.on_finished = on_finished
+        self.gc_interval = gc_interval
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="invoice-job")
+        self._queued = 0  # Enviados al pool que todavía no empezaron
+        self._queued_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._gc_thread = None
+
+    def start(self):
+        """Re-encolar jobs pendientes e iniciar el recolector de expirados"""
+        pending = self.store.pending_ids()
+        if pending:
+            logger.info(f"🔁 Re-encolando {len(pending)} jobs pendientes tras reinicio")
+        for job_id in pending:
+            self.submit(job_id)
+        self._gc_thread = threading.Thread(target=self._gc_loop, name="invoice-job-gc", daemon=True)
+        self._gc_thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def submit(self, job_id: str):
+        with self._queued_lock:
+            self._queued += 1
+        try:
+            self._executor.submit(self._run, job_id)
+        except RuntimeError:
+            # Pool detenido (apagado del servidor): el job sigue pendiente y se re-encola al reiniciar
+            with self._queued_lock:
+                self._queued -= 1
+            raise
+
+    def queue_size(self) -> int:
+        """Jobs en espera de un hilo libre"""
+        with self._queued_lock:
+            return self._queued
+
+    def _run(self, job_id: str):
+        with self._queued_lock:
+            self._queued -= 1
+        row = self.store.get_internal(job_id)
+        if row is None or row['status'] in TERMINAL_STATES:
+            return
+        resumed = row['status'] == JOB_RUNNING
+        if resumed:
+            logger.info(f"🔁 Job {job_id} interrumpido en ejecución: se reanuda")
+        self.store.mark_running(job_id)
+        start_time = time.time()
+        try:
+            content = self.store.read_image(job_id)
+            options = fast_json.loads(row['options']) if row['options'] else {}
+            if resumed:
+                options['resumed'] = True
+            result = self.handler(row['filename'], row['content_type'], content, **options)
+            self.store.mark_done(job_id, result)
+            logger.info(f"✅ Job {job_id} completado en {time.time() - start_time:.2f} segundos")
+        except JobError as e:
+            logger.error(f"❌ Job {job_id} falló ({e.status_code}): {e.detail}")
+            self.store.mark_failed(job_id, e.status_code, e.detail)
+        except FileNotFoundError:
+            logger.error(f"❌ Job {job_id} sin imagen en spool")
+            self.store.mark_failed(job_id, 500, "Imagen del job no encontrada")
+        except Exception as e:
+            logger.error(f"❌ Error inesperado en job {job_id}: {e}", exc_info=True)
+            self.store.mark_failed(job_id, 500, f"Error interno del servidor: {str(e)}")
+        if self.on_finished:
+            try:
+                self.on_finished(job_id)
+            except Exception as e:
+                logger.warning(f"⚠️ Error en callback de finalización del job {job_id}: {e}")
+
+    def _gc_loop(self):
+        while not self._stop.wait(self.gc_interval):
+            try:
+                removed = self.store.purge_expired()
+                if removed:
+                    logger.info(f"🧹 Eliminados {removed} jobs expirados")
+            except Exception as e:
+                logger.warning(f"⚠️ Error al eliminar jobs expirados: {e}")
@@ -0,0 +1,118 @@
+"""
+Watchdog del event loop: detecta llamadas bloqueantes dentro de handlers async.
+- Un latido en el loop duerme interval y mide cuánto tarde despertó (lag); el lag se publica
+  en metrics (event_loop_lag_seconds) en cada latido.
+- Un hilo aparte revisa que el latido avance: si el loop lleva más de threshold sin latir,
+  toma la pila del hilo del loop en ese momento (la corrutina que está bloqueando) y la
+  registra una sola vez por sitio de llamada (la primera línea del código del backend en la
+  pila), así un requests.get en un handler async aparece en el log sin inundarlo.
+"""
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from typing import Dict, List, Optional
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class LoopWatchdog:
+    """Latido en el event loop + hilo que captura la pila cuando el loop se bloquea"""
+
+    def __init__(self, interval: float = 0.1, threshold: float = 0.2,
+                 project_root: Optional[str] = None, max_sites: int = 100):
+        self.interval = interval
+        self.threshold = threshold
+        self.project_root = project_root or os.path.dirname(os.path.abspath(__file__))
+        self.max_sites = max_sites
+        self._sites: Dict[str, Dict] = {}
+        self._current_site: Optional[str] = None
+        self._last_beat = time.monotonic()
+        self._loop_thread_id: Optional[int] = None
+        self._task = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        """Iniciar el latido en loop (llamar desde el hilo del loop) y el hilo monitor"""
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._task = loop.create_task(self._heartbeat())
+        self._thread = threading.Thread(target=self._monitor_loop, name="loop-watchdog", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _heartbeat(self):
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - start - self.interval)
+            self._last_beat = now
+            metrics.observe('event_loop_lag_seconds', lag)
+            metrics.set_gauge('event_loop_lag_last_seconds', round(lag, 6))
+            if lag >= self.threshold:
+                metrics.inc('event_loop_blocked_total')
+                with self._lock:
+                    site = self._sites.get(self._current_site) if self._current_site else None
+                    if site is not None and lag > site["max_seconds"]:
+                        site["max_seconds"] = round(lag, 3)
+                    self._current_site = None
+
+    def _monitor_loop(self):
+        check_interval = min(self.interval, self.threshold) / 2
+        captured_beat = None
+        while not self._stop.wait(check_interval):
+            last_beat = self._last_beat
+            if time.monotonic() - last_beat - self.interval < self.threshold or captured_beat == last_beat:
+                continue
+            # Una captura por bloqueo: hasta el próximo latido no se vuelve a tomar la pila
+            captured_beat = last_beat
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is not None:
+                self._record(traceback.extract_stack(frame))
+
+    def _call_site(self, stack: traceback.StackSummary) -> str:
+        """Frame más profundo del código del backend (la llamada bloqueante la hizo ese código)"""
+        for frame in reversed(stack):
+            if frame.filename.startswith(self.project_root) and frame.filename != __file__:
+                return f"{os.path.relpath(frame.filename, self.project_root)}:{frame.lineno} ({frame.name})"
+        leaf = stack[-1]
+        return f"{leaf.filename}:{leaf.lineno} ({leaf.name})"
+
+    def _record(self, stack: traceback.StackSummary):
+        key = self._call_site(stack)
+        now = time.time()
+        with self._lock:
+            self._current_site = key
+            site = self._sites.get(key)
+            if site is not None:
+                site["count"] += 1
+                site["last_seen"] = now
+                return
+            if len(self._sites) >= self.max_sites:
+                return
+            self._sites[key] = {
+                "site": key,
+                "count": 1,
+                "first_seen": now,
+                "last_seen": now,
+                "max_seconds": self.threshold,
+                "stack": stack.format(),
+            }
+        logger.warning(f"⚠️ Event loop bloqueado más de {self.threshold:g}s en {key}:\n{''.join(stack.format())}")
+
+    def sites(self) -> List[Dict]:
+        """Sitios que bloquearon el loop (más frecuentes primero)"""
+        with self._lock:
+            return sorted((dict(site) for site in self._sites.values()), key=lambda site: -site["count"])
@@ -0,0 +1,164 @@
+"""
+Introspección de memoria del proceso para buscar fugas y dimensionar cachés.
+- RSS actual y pico leídos de /proc/self/status (Linux); fuera de Linux solo el pico de getrusage.
+- tracemalloc bajo demanda: se activa desde el endpoint de admin (tiene costo en cada
+  asignación, así que no se deja encendido), se toman snapshots con nombre y se comparan
+  para ver qué líneas de código crecieron entre dos momentos.
+"""
+import gc
+import linecache
+import sys
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict
+from typing import Dict, Optional
+
+# Asignaciones del propio tracemalloc y del import de módulos no son del backend
+_IGNORED_FILES = (tracemalloc.__file__, '<frozen importlib._bootstrap>', '<frozen importlib._bootstrap_external>', '<unknown>')
+
+GROUP_BY = ('lineno', 'filename', 'traceback')
+
+
+def process_memory() -> Dict[str, Optional[int]]:
+    """RSS actual y pico del proceso en bytes"""
+    rss = peak = None
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    rss = int(line.split()[1]) * 1024
+                elif line.startswith('VmHWM:'):
+                    peak = int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if peak is None:
+        try:
+            import resource
+            # ru_maxrss está en KB en Linux y en bytes en macOS
+            maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            peak = maxrss if sys.platform == 'darwin' else maxrss * 1024
+        except (ImportError, OSError):
+            pass
+    return {"rss_bytes": rss, "peak_rss_bytes": peak}
+
+
+def gc_stats() -> Dict:
+    return {
+        "objects": len(gc.get_objects()),
+        "counts": list(gc.get_count()),
+        "collections": [generation["collections"] for generation in gc.get_stats()],
+        "uncollectable": len(gc.garbage),
+    }
+
+
+def _stat_entry(stat, group_by: str) -> Dict:
+    frame = stat.traceback[0]
+    entry = {
+        "file": frame.filename,
+        "line": frame.lineno if group_by != 'filename' else None,
+        "size_bytes": stat.size,
+        "count": stat.count,
+    }
+    if group_by == 'lineno':
+        entry["code"] = linecache.getline(frame.filename, frame.lineno).strip()
+    elif group_by == 'traceback':
+        entry["traceback"] = [f"{f.filename}:{f.lineno}" for f in stat.traceback]
+    return entry
+
+
+def _diff_entry(stat, group_by: str) -> Dict:
+    entry = _stat_entry(stat, group_by)
+    entry["size_diff_bytes"] = stat.size_diff
+    entry["count_diff"] = stat.count_diff
+    return entry
+
+
+class MemoryTracker:
+    """Snapshots de tracemalloc con nombre (se conservan los últimos max_snapshots)"""
+
+    def __init__(self, frames: int = 1, max_snapshots: int = 5):
+        self.frames = frames
+        self.max_snapshots = max_snapshots
+        self._snapshots: "OrderedDict[str, tracemalloc.Snapshot]" = OrderedDict()
+        self._taken_at: Dict[str, float] = {}
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    def start(self, frames: Optional[int] = None) -> bool:
+        """Activar tracemalloc (False si ya estaba activo)"""
+        if tracemalloc.is_tracing():
+            return False
+        tracemalloc.start(frames or self.frames)
+        return True
+
+    def stop(self) -> bool:
+        """Desactivar tracemalloc y descartar los snapshots (False si no estaba activo)"""
+        if not tracemalloc.is_tracing():
+            return False
+        tracemalloc.stop()
+        with self._lock:
+            self._snapshots.clear()
+            self._taken_at.clear()
+        return True
+
+    def status(self) -> Dict:
+        tracing = tracemalloc.is_tracing()
+        current, peak = tracemalloc.get_traced_memory() if tracing else (0, 0)
+        with self._lock:
+            snapshots = [{"name": name, "taken_at": self._taken_at[name]} for name in self._snapshots]
+        return {
+            "tracing": tracing,
+            "frames": tracemalloc.get_traceback_limit() if tracing else None,
+            "traced_bytes": current,
+            "traced_peak_bytes": peak,
+            "overhead_bytes": tracemalloc.get_tracemalloc_memory() if tracing else 0,
+            "snapshots": snapshots,
+        }
+
+    def take_snapshot(self, name: Optional[str] = None) -> str:
+        """Tomar un snapshot (requiere tracemalloc activo). Retorna su nombre."""
+        if not tracemalloc.is_tracing():
+            raise RuntimeError("tracemalloc no está activo")
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, filename) for filename in _IGNORED_FILES]
+        )
+        with self._lock:
+            self._sequence += 1
+            name = name or f"s{self._sequence}"
+            self._snapshots.pop(name, None)
+            self._snapshots[name] = snapshot
+            self._taken_at[name] = time.time()
+            while len(self._snapshots) > self.max_snapshots:
+                oldest, _ = self._snapshots.popitem(last=False)
+                self._taken_at.pop(oldest, None)
+        return name
+
+    def _get(self, name: str) -> tracemalloc.Snapshot:
+        with self._lock:
+            snapshot = self._snapshots.get(name)
+        if snapshot is None:
+            raise KeyError(name)
+        return snapshot
+
+    def top(self, name: str, limit: int = 20, group_by: str = 'lineno') -> Dict:
+        """Sitios con más memoria asignada y viva en el snapshot"""
+        stats = self._get(name).statistics(group_by)
+        return {
+            "snapshot": name,
+            "group_by": group_by,
+            "total_bytes": sum(stat.size for stat in stats),
+            "top": [_stat_entry(stat, group_by) for stat in stats[:limit]],
+        }
+
+    def diff(self, base: str, target: str, limit: int = 20, group_by: str = 'lineno') -> Dict:
+        """Sitios que más crecieron (o decrecieron) de base a target"""
+        stats = self._get(target).compare_to(self._get(base), group_by)
+        return {
+            "base": base,
+            "target": target,
+            "group_by": group_by,
+            "size_diff_bytes": sum(stat.size_diff for stat in stats),
+            "top": [_diff_entry(stat, group_by) for stat in stats[:limit]],
+        }
+
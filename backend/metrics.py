@@ -0,0 +1,74 @@
+"""
+Métricas internas del proceso: contadores y resúmenes de duración (cantidad, suma, máximo).
+Registro global y thread-safe para que cualquier módulo registre eventos sin recibir el
+objeto por parámetro; GET /api/admin/metrics expone el snapshot (JSON o texto de Prometheus).
+"""
+import threading
+import time
+from typing import Dict, Optional
+
+_lock = threading.Lock()
+_counters: Dict[str, float] = {}
+_summaries: Dict[str, list] = {}  # nombre -> [cantidad, suma, máximo]
+_gauges: Dict[str, float] = {}
+_started_at = time.time()
+
+
+def inc(name: str, value: float = 1):
+    """Incrementar un contador"""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def observe(name: str, value: float):
+    """Registrar una observación (ej. duración en segundos) en un resumen"""
+    with _lock:
+        summary = _summaries.get(name)
+        if summary is None:
+            _summaries[name] = [1, value, value]
+        else:
+            summary[0] += 1
+            summary[1] += value
+            if value > summary[2]:
+                summary[2] = value
+
+
+def set_gauge(name: str, value: float):
+    """Fijar el valor actual de un indicador (ej. tamaño de un pool)"""
+    with _lock:
+        _gauges[name] = value
+
+
+def get(name: str) -> Optional[float]:
+    """Valor de un contador o indicador (None si nunca se registró)"""
+    with _lock:
+        return _counters.get(name, _gauges.get(name))
+
+
+def snapshot() -> Dict:
+    with _lock:
+        return {
+            "uptime_seconds": round(time.time() - _started_at, 1),
+            "counters": dict(sorted(_counters.items())),
+            "gauges": dict(sorted(_gauges.items())),
+            "summaries": {
+                name: {"count": count, "sum": round(total, 6), "max": round(maximum, 6),
+                       "avg": round(total / count, 6) if count else 0.0}
+                for name, (count, total, maximum) in sorted(_summaries.items())
+            },
+        }
+
+
+def to_prometheus(prefix: str = "invoice_api_") -> str:
+    """Snapshot en formato de texto de Prometheus"""
+    data = snapshot()
+    lines = [f"# TYPE {prefix}uptime_seconds gauge", f"{prefix}uptime_seconds {data['uptime_seconds']}"]
+    for name, value in data["counters"].items():
+        lines += [f"# TYPE {prefix}{name} counter", f"{prefix}{name} {value}"]
+    for name, value in data["gauges"].items():
+        lines += [f"# TYPE {prefix}{name} gauge", f"{prefix}{name} {value}"]
+    for name, summary in data["summaries"].items():
+        lines += [f"# TYPE {prefix}{name} summary",
+                  f"{prefix}{name}_count {summary['count']}",
+                  f"{prefix}{name}_sum {summary['sum']}"]
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,133 @@
+"""
+Detección del formato de respuesta del webhook de n8n y parsing a esquema de BigQuery.
+Módulo sin efectos secundarios: se puede usar desde la API, los jobs en segundo plano
+y herramientas offline.
+"""
+import logging
+from typing import Optional, Tuple
+
+import fast_json
+from invoice_parser import parse_and_map_invoice, parse_structured_data
+from invoice_record import InvoiceRecord
+
+logger = logging.getLogger(__name__)
+
+
+class StructuredDataError(Exception):
+    """Error al parsear una respuesta de n8n con formato estructurado (clave/valor)"""
+
+
+def _is_structured_item(item) -> bool:
+    """Verificar si un elemento tiene la forma {"clave": "...", "valor": "..."}"""
+    return isinstance(item, dict) and 'clave' in item and 'valor' in item
+
+
+def _parse_structured(structured_array: list) -> InvoiceRecord:
+    """Parsear un array estructurado envolviendo los errores en StructuredDataError"""
+    try:
+        mapped_data_dict = parse_structured_data(structured_array)
+        logger.info(f"Datos mapeados exitosamente. id_check: {mapped_data_dict.get('id_check')}")
+        return mapped_data_dict
+    except Exception as parse_error:
+        logger.error(f"Error al parsear datos estructurados: {parse_error}", exc_info=True)
+        raise StructuredDataError(str(parse_error)) from parse_error
+
+
+def detect_and_parse(response_data) -> Tuple[Optional[InvoiceRecord], Optional[str]]:
+    """
+    Detectar el formato de la respuesta de n8n y mapearla al esquema de BigQuery.
+
+    Args:
+        response_data: JSON ya decodificado devuelto por el webhook de n8n
+
+    Returns:
+        Tupla (datos mapeados, texto crudo para visualización). Ambos son None si el
+        formato no es reconocido.
+
+    Raises:
+        StructuredDataError: si el formato es estructurado pero no se pudo parsear
+    """
+    mapped_data_dict = None
+    raw_extracted_text = None
+
+    # Formato 1: Array que contiene objeto con "data" [{"data": [{"clave": "...", "valor": "..."}, ...]}]
+    if isinstance(response_data, list) and len(response_data) > 0:
+        logger.info("Verificando si es array estructurado...")
+        # Verificar si el primer elemento es un dict con key "data" que contiene el array estructurado
+        if isinstance(response_data[0], dict) and 'data' in response_data[0]:
+            data_array = response_data[0]['data']
+            if isinstance(data_array, list) and len(data_array) > 0 and _is_structured_item(data_array[0]):
+                logger.info(f"✅ Detectado formato estructurado (array con 'data' key) con {len(data_array)} items")
+                mapped_data_dict = _parse_structured(data_array)
+                # Guardar el formato estructurado como texto para visualización (JSON formateado)
+                raw_extracted_text = fast_json.dumps_str(data_array, indent=True)
+        # Formato 1a: Array estructurado directo [{"clave": "...", "valor": "..."}, ...]
+        elif _is_structured_item(response_data[0]):
+            logger.info(f"✅ Detectado formato estructurado (array directo) con {len(response_data)} items")
+            mapped_data_dict = _parse_structured(response_data)
+            raw_extracted_text = fast_json.dumps_str(response_data, indent=True)
+
+    # Formato 1b: Objeto individual con estructura {"clave": "...", "valor": "..."}
+    # O dict que contiene un array en alguna key
+    elif isinstance(response_data, dict):
+        # Verificar si contiene un array estructurado en alguna key
+        structured_array_found = None
+        for key, value in response_data.items():
+            if isinstance(value, list) and len(value) > 0 and _is_structured_item(value[0]):
+                logger.info(f"✅ Detectado formato estructurado (array dentro de dict, key: '{key}')")
+                structured_array_found = value
+                break
+
+        if structured_array_found:
+            mapped_data_dict = _parse_structured(structured_array_found)
+            raw_extracted_text = fast_json.dumps_str(structured_array_found, indent=True)
+        elif _is_structured_item(response_data):
+            logger.warning("⚠️ Detectado formato estructurado (objeto individual) - n8n debería devolver un array completo")
+            logger.warning("⚠️ Solo se procesará este objeto individual. Verifica la configuración de n8n.")
+            # Convertir a array para procesar
+            structured_array = [response_data]
+            mapped_data_dict = _parse_structured(structured_array)
+            raw_extracted_text = fast_json.dumps_str(structured_array, indent=True)
+
+    if mapped_data_dict is not None or not isinstance(response_data, dict):
+        return mapped_data_dict, raw_extracted_text
+
+    # Formatos de texto crudo: solo si el dict no contenía datos estructurados
+    # Formato 2: {"extracted_text": "..."} - Texto crudo
+    if 'extracted_text' in response_data:
+        extracted_text = response_data.get('extracted_text', '')
+        if extracted_text:
+            mapped_data_dict = parse_and_map_invoice(extracted_text)
+            raw_extracted_text = extracted_text
+
+    # Formato 3: Respuesta completa de Google Vision AI
+    elif 'responses' in response_data and len(response_data['responses']) > 0:
+        first_response = response_data['responses'][0]
+        if 'fullTextAnnotation' in first_response and 'text' in first_response['fullTextAnnotation']:
+            extracted_text = first_response['fullTextAnnotation']['text']
+            mapped_data_dict = parse_and_map_invoice(extracted_text)
+            raw_extracted_text = extracted_text
+
+    # Formato 4: {"fullTextAnnotation": {"text": "..."}}
+    elif 'fullTextAnnotation' in response_data and 'text' in response_data['fullTextAnnotation']:
+        extracted_text = response_data['fullTextAnnotation']['text']
+        mapped_data_dict = parse_and_map_invoice(extracted_text)
+        raw_extracted_text = extracted_text
+
+    # Formato 5: Texto directo en el campo "text"
+    elif 'text' in response_data:
+        extracted_text = response_data.get('text', '')
+        if extracted_text:
+            mapped_data_dict = parse_and_map_invoice(extracted_text)
+            raw_extracted_text = extracted_text
+
+    # Formato 6: Buscar cualquier campo que contenga texto
+    else:
+        for key in ['description', 'content', 'data']:
+            if key in response_data and isinstance(response_data[key], str):
+                extracted_text = response_data[key]
+                mapped_data_dict = parse_and_map_invoice(extracted_text)
+                raw_extracted_text = extracted_text
+                break
+
+    return mapped_data_dict, raw_extracted_text
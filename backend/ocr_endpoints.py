@@ -0,0 +1,227 @@
+"""
+Balanceo de carga y hedging de requests entre varios webhooks de n8n.
+Cada endpoint lleva estadísticas de salud (requests en curso, latencia EWMA, p95,
+fallos consecutivos) que se usan para elegir destino y decidir cuándo duplicar un request.
+"""
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Callable, Dict, List, Optional
+
+import requests
+from urllib3.exceptions import PoolError
+
+logger = logging.getLogger(__name__)
+
+STRATEGY_LEAST_OUTSTANDING = "least_outstanding"
+STRATEGY_EWMA = "ewma"
+
+
+class EndpointStats:
+    """Estado y métricas de salud de un endpoint de OCR"""
+
+    def __init__(self, url: str, window: int):
+        self.url = url
+        self.outstanding = 0
+        self.ewma_latency: Optional[float] = None
+        self.latencies = deque(maxlen=window)
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.hedges_won = 0
+        self.cooldown_until = 0.0
+
+    def p95(self) -> Optional[float]:
+        if len(self.latencies) < 5:
+            return None  # Muy pocas muestras para estimar la cola
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+    def is_healthy(self, now: float) -> bool:
+        return now >= self.cooldown_until
+
+
+class EndpointPool:
+    """Conjunto de endpoints de n8n con selección por menor carga o menor latencia EWMA"""
+
+    def __init__(self, urls: List[str], strategy: str = STRATEGY_LEAST_OUTSTANDING,
+                 ewma_alpha: float = 0.3, failure_threshold: int = 3,
+                 cooldown_seconds: float = 30.0, window: int = 200):
+        self.endpoints = [EndpointStats(url, window) for url in urls]
+        self.strategy = strategy
+        self.ewma_alpha = ewma_alpha
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self._lock = threading.Lock()
+
+    def __bool__(self):
+        return bool(self.endpoints)
+
+    def describe(self) -> str:
+        return ", ".join(endpoint.url for endpoint in self.endpoints)
+
+    def _score(self, endpoint: EndpointStats):
+        # Los endpoints sin muestras de latencia se prueban primero (score 0)
+        latency = endpoint.ewma_latency or 0.0
+        if self.strategy == STRATEGY_EWMA:
+            return (latency * (endpoint.outstanding + 1), endpoint.outstanding)
+        return (endpoint.outstanding, latency)
+
+    def choose(self, exclude=()) -> Optional[EndpointStats]:
+        """Elegir el mejor endpoint disponible, priorizando los sanos sobre los en cooldown"""
+        now = time.time()
+        with self._lock:
+            candidates = [e for e in self.endpoints if e not in exclude]
+            if not candidates:
+                return None
+            healthy = [e for e in candidates if e.is_healthy(now)]
+            chosen = min(healthy or candidates, key=self._score)
+            chosen.outstanding += 1
+            return chosen
+
+    def release(self, endpoint: EndpointStats, latency: float, success: Optional[bool]):
+        """Registrar el resultado de un request a un endpoint (None: no llegó a enviarse)"""
+        with self._lock:
+            endpoint.outstanding -= 1
+            if success is None:
+                return
+            if success:
+                endpoint.successes += 1
+                endpoint.consecutive_failures = 0
+                endpoint.latencies.append(latency)
+                if endpoint.ewma_latency is None:
+                    endpoint.ewma_latency = latency
+                else:
+                    endpoint.ewma_latency = (self.ewma_alpha * latency
+                                             + (1 - self.ewma_alpha) * endpoint.ewma_latency)
+            else:
+                endpoint.failures += 1
+                endpoint.consecutive_failures += 1
+                if endpoint.consecutive_failures >= self.failure_threshold:
+                    endpoint.cooldown_until = time.time() + self.cooldown_seconds
+                    logger.warning(f"⚠️ Endpoint de OCR en cooldown por {self.cooldown_seconds:.0f}s "
+                                   f"tras {endpoint.consecutive_failures} fallos: {endpoint.url}")
+
+    def record_hedge_won(self, endpoint: EndpointStats):
+        """Contar un hedge ganado por el endpoint que recibió el duplicado"""
+        with self._lock:
+            endpoint.hedges_won += 1
+
+    def snapshot(self) -> List[Dict]:
+        """Vista de salud por endpoint (para el endpoint de administración)"""
+        now = time.time()
+        with self._lock:
+            return [
+                {
+                    "url": e.url,
+                    "healthy": e.is_healthy(now),
+                    "outstanding": e.outstanding,
+                    "ewma_latency": e.ewma_latency,
+                    "p95_latency": e.p95(),
+                    "successes": e.successes,
+                    "failures": e.failures,
+                    "consecutive_failures": e.consecutive_failures,
+                    "hedges_won": e.hedges_won,
+                    "cooldown_remaining": max(0.0, e.cooldown_until - now),
+                }
+                for e in self.endpoints
+            ]
+
+
+class HedgedCaller:
+    """
+    Ejecuta un request contra el pool de endpoints. Con hedging habilitado, si el primer
+    endpoint no respondió dentro de su p95 se envía un duplicado a otro endpoint y se usa
+    la primera respuesta válida.
+    """
+
+    def __init__(self, pool: EndpointPool, hedging: bool, hedge_min_delay: float,
+                 hedge_default_delay: float, max_workers: int = 16):
+        self.pool = pool
+        self.hedging = hedging
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_default_delay = hedge_default_delay
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="n8n-hedge")
+
+    def _hedge_delay(self, endpoint: EndpointStats) -> float:
+        p95 = endpoint.p95()
+        return max(self.hedge_min_delay, p95 if p95 is not None else self.hedge_default_delay)
+
+    def _attempt(self, endpoint: EndpointStats, send: Callable[[str], requests.Response],
+                 cancelled: threading.Event) -> requests.Response:
+        start_time = time.time()
+        success = False
+        try:
+            response = send(endpoint.url)
+            success = response.status_code == 200
+            if cancelled.is_set():
+                # El otro request ya ganó: descartar esta respuesta y liberar la conexión
+                response.close()
+            return response
+        except PoolError:
+            # Pool de conexiones local saturado: el endpoint no recibió nada, no es un fallo suyo
+            success = None
+            raise
+        finally:
+            self.pool.release(endpoint, time.time() - start_time, success)
+
+    def call(self, send: Callable[[str], requests.Response]) -> requests.Response:
+        """
+        Enviar el request con balanceo (y hedging si está habilitado).
+        Retorna la primera respuesta 200; si ninguna lo es, la última respuesta recibida;
+        si todos los intentos lanzaron excepción, re-lanza la última.
+        """
+        primary = self.pool.choose()
+        if primary is None:
+            raise ValueError("No hay endpoints de OCR configurados")
+
+        if not self.hedging or len(self.pool.endpoints) < 2:
+            never_cancelled = threading.Event()
+            return self._attempt(primary, send, never_cancelled)
+
+        cancelled = threading.Event()
+        futures = {self._executor.submit(self._attempt, primary, send, cancelled): primary}
+        done, _ = wait(futures, timeout=self._hedge_delay(primary))
+        if not done or not self._is_good(next(iter(done))):
+            secondary = self.pool.choose(exclude={primary})
+            if secondary is not None:
+                logger.info(f"🔀 Hedging: duplicando request de {primary.url} hacia {secondary.url}")
+                futures[self._executor.submit(self._attempt, secondary, send, cancelled)] = secondary
+
+        last_response = None
+        last_error = None
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    response = future.result()
+                except Exception as e:
+                    last_error = e
+                    continue
+                if response.status_code == 200:
+                    # Cancelar el resto: los que no empezaron no se ejecutan y los que
+                    # están en vuelo descartan su respuesta al terminar
+                    cancelled.set()
+                    for other in pending:
+                        if other.cancel():
+                            # _attempt nunca correrá: devolver el cupo que tomó choose()
+                            self.pool.release(futures[other], 0.0, None)
+                    # Solo cuenta como hedge ganado si la respuesta vino del duplicado
+                    if futures[future] is not primary:
+                        self.pool.record_hedge_won(futures[future])
+                    return response
+                last_response = response
+
+        if last_response is not None:
+            return last_response
+        raise last_error
+
+    @staticmethod
+    def _is_good(future) -> bool:
+        try:
+            return future.result().status_code == 200
+        except Exception:
+            return False
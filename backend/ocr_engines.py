@@ -0,0 +1,235 @@
+"""
+Motores de OCR intercambiables. Todos retornan la respuesta en el formato del webhook de n8n
+para que detect_and_parse la procese igual sin importar quién hizo la extracción:
+- N8nEngine: el webhook de n8n (comportamiento original)
+- TesseractEngine: Tesseract local en un pool de procesos; retorna {"extracted_text": ...}
+  para parse_and_map_invoice (requiere pytesseract, Pillow y el binario tesseract)
+- FallbackEngine: usa el principal y pasa al secundario si el principal falla o está lento
+"""
+import io
+import logging
+import shutil
+import threading
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FuturesTimeout
+from typing import Callable, NamedTuple, Optional
+
+try:
+    import pytesseract
+    from PIL import Image, ImageOps
+except ImportError:  # OCR local opcional: sin estas dependencias solo queda n8n
+    pytesseract = None
+    Image = None
+    ImageOps = None
+
+logger = logging.getLogger(__name__)
+
+
+class OcrEngineError(Exception):
+    """Error de un motor de OCR con código HTTP asociado"""
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+class EngineSaturated(OcrEngineError):
+    """El motor no tomó el trabajo por falta de capacidad local (ej. pool de conexiones lleno): no es una caída"""
+
+    def __init__(self, detail: str):
+        super().__init__(503, detail)
+
+
+class OcrResult(NamedTuple):
+    response: object  # JSON con el formato de n8n
+    engine: str       # Motor que produjo la respuesta
+
+
+class OcrEngine(ABC):
+    """Interfaz de motor de OCR"""
+
+    name = "base"
+
+    @abstractmethod
+    def extract(self, filename: str, content: bytes, content_type: str) -> OcrResult:
+        """Extraer el contenido de la imagen en el formato de respuesta de n8n"""
+
+    def close(self):
+        """Liberar recursos (pools de procesos)"""
+
+
+class N8nEngine(OcrEngine):
+    """Webhook de n8n; call es la función bloqueante que hace el request (call_n8n_webhook)"""
+
+    name = "n8n"
+
+    def __init__(self, call: Callable[[str, bytes, str], object]):
+        self._call = call
+
+    def extract(self, filename: str, content: bytes, content_type: str) -> OcrResult:
+        return OcrResult(self._call(filename, content, content_type), self.name)
+
+
+def _tesseract_image_to_text(content: bytes, lang: str, config: str, timeout: float = 0) -> str:
+    """
+    OCR de una imagen (se ejecuta en un proceso del pool). Con timeout pytesseract mata el
+    proceso de tesseract al vencer, así el worker queda libre aunque nadie espere el resultado.
+    """
+    image = Image.open(io.BytesIO(content))
+    image = ImageOps.exif_transpose(image).convert('L')
+    # Los tickets fotografiados de lejos quedan chicos: Tesseract rinde mejor con ~300 dpi
+    if image.width < 1000:
+        scale = 1000 / image.width
+        image = image.resize((1000, int(image.height * scale)), Image.LANCZOS)
+    image = ImageOps.autocontrast(image)
+    try:
+        return pytesseract.image_to_string(image, lang=lang, config=config, timeout=timeout)
+    except RuntimeError as e:
+        if 'timeout' in str(e).lower():
+            raise TimeoutError(str(e)) from None
+        raise
+
+
+def tesseract_available() -> bool:
+    return pytesseract is not None and shutil.which(getattr(pytesseract.pytesseract, 'tesseract_cmd', 'tesseract')) is not None
+
+
+class TesseractEngine(OcrEngine):
+    """
+    Tesseract local. El OCR es CPU-bound: corre en procesos para no bloquear el GIL del servidor.
+    El pool de procesos se crea con el primer OCR local (registrar el motor no inicia procesos).
+    """
+
+    name = "tesseract"
+
+    def __init__(self, workers: int = 2, lang: str = "spa", config: str = "--psm 6", timeout: float = 60.0):
+        if not tesseract_available():
+            raise RuntimeError("Tesseract no disponible (instalar pytesseract, Pillow y el binario tesseract)")
+        self.workers = workers
+        self.lang = lang
+        self.config = config
+        self.timeout = timeout
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    def _pool(self) -> ProcessPoolExecutor:
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            return self._executor
+
+    def extract(self, filename: str, content: bytes, content_type: str) -> OcrResult:
+        start_time = time.time()
+        future = self._pool().submit(_tesseract_image_to_text, content, self.lang, self.config, self.timeout)
+        try:
+            text = future.result(timeout=self.timeout)
+        except FuturesTimeout:
+            # cancel() solo descarta la tarea si todavía no empezó: una en curso no se detiene
+            # desde acá, la corta el timeout de pytesseract dentro del worker
+            future.cancel()
+            raise OcrEngineError(504, f"Timeout del OCR local (más de {self.timeout} segundos)")
+        except Exception as e:
+            raise OcrEngineError(500, f"Error del OCR local: {e}")
+        logger.info(f"✅ OCR local terminado en {time.time() - start_time:.2f} segundos ({len(text)} caracteres)")
+        return OcrResult({"extracted_text": text}, self.name)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _is_unavailable(error: Exception) -> bool:
+    """Errores que justifican usar el motor alternativo (caída/timeout, no un 4xx de formato)"""
+    status_code = getattr(error, 'status_code', None)
+    return status_code is None or status_code >= 500
+
+
+class FallbackEngine(OcrEngine):
+    """
+    Motor principal con alternativa automática:
+    - si el principal falla (5xx, timeout, conexión) se usa el secundario y el principal
+      se saltea durante cooldown segundos (si solo estaba saturado se usa el secundario
+      sin cooldown);
+    - si el principal tarda más de slow_after segundos se lanza el secundario en paralelo
+      y se usa la primera respuesta exitosa.
+    """
+
+    name = "auto"
+
+    def __init__(self, primary: OcrEngine, fallback: OcrEngine, slow_after: float = 8.0, cooldown: float = 60.0):
+        self.primary = primary
+        self.fallback = fallback
+        self.slow_after = slow_after
+        self.cooldown = cooldown
+        self._primary_down_until = 0.0
+        self._executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="ocr-fallback")
+
+    def _mark_primary_down(self, error: Exception):
+        if isinstance(error, EngineSaturated):
+            logger.warning(f"⚠️ OCR {self.primary.name} saturado ({error}); usando {self.fallback.name}")
+            return
+        self._primary_down_until = time.monotonic() + self.cooldown
+        logger.warning(f"⚠️ OCR {self.primary.name} no disponible ({error}); usando {self.fallback.name} "
+                       f"durante {self.cooldown:.0f}s")
+
+    def extract(self, filename: str, content: bytes, content_type: str) -> OcrResult:
+        if time.monotonic() < self._primary_down_until:
+            return self.fallback.extract(filename, content, content_type)
+
+        primary_future = self._executor.submit(self.primary.extract, filename, content, content_type)
+        try:
+            return primary_future.result(timeout=self.slow_after)
+        except FuturesTimeout:
+            logger.warning(f"⚠️ OCR {self.primary.name} lento (>{self.slow_after}s); "
+                           f"lanzando {self.fallback.name} en paralelo")
+        except Exception as e:
+            if not _is_unavailable(e):
+                raise
+            self._mark_primary_down(e)
+            return self.fallback.extract(filename, content, content_type)
+
+        # Carrera entre ambos motores: gana la primera respuesta exitosa
+        fallback_future = self._executor.submit(self.fallback.extract, filename, content, content_type)
+        pending = {primary_future, fallback_future}
+        errors = {}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    return future.result()
+                except Exception as e:
+                    errors[future] = e
+                    if future is primary_future and _is_unavailable(e):
+                        self._mark_primary_down(e)
+        # Ambos fallaron: se reporta el error del principal
+        raise errors.get(primary_future) or errors[fallback_future]
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self.primary.close()
+        self.fallback.close()
+
+
+def create_engines(default: str, n8n_call: Optional[Callable], local_workers: int = 2, local_lang: str = "spa",
+                   local_timeout: float = 60.0, slow_after: float = 8.0, cooldown: float = 60.0) -> dict:
+    """
+    Crear los motores disponibles {nombre: motor}. 'n8n' requiere n8n_call; 'tesseract' las
+    dependencias opcionales; 'auto' ambos. El pool de procesos local se inicia recién con el
+    primer OCR local, así registrar Tesseract con OCR_ENGINE=n8n no arranca procesos.
+    """
+    engines = {}
+    if n8n_call is not None:
+        engines[N8nEngine.name] = N8nEngine(n8n_call)
+    if default in (TesseractEngine.name, FallbackEngine.name) or tesseract_available():
+        try:
+            engines[TesseractEngine.name] = TesseractEngine(local_workers, local_lang, timeout=local_timeout)
+        except RuntimeError as e:
+            logger.warning(f"⚠️ {e}")
+    if N8nEngine.name in engines and TesseractEngine.name in engines:
+        engines[FallbackEngine.name] = FallbackEngine(
+            engines[N8nEngine.name], engines[TesseractEngine.name], slow_after, cooldown
+        )
+    return engines
@@ -0,0 +1,271 @@
+"""
+Grabación y replay de respuestas de n8n.
+process_invoice puede grabar cada extracción (hash de la imagen, respuesta de n8n, salida
+parseada y tiempos) en archivos JSONL comprimidos. El replay vuelve a pasar esas respuestas
+por la detección de formato y el parser sin llamar a n8n: sirve para verificar que un cambio
+en el parser produce la misma salida y como suite de rendimiento con tráfico real.
+
+La salida grabada ya tiene la tienda normalizada contra el maestro (si el servidor tenía uno):
+el replay usa el mismo maestro (STORE_MASTER_PATH/STORE_MASTER_TABLE o --store-master).
+
+Uso como herramienta (desde backend/):
+    python ocr_recorder.py replay data/recordings --check
+    python ocr_recorder.py replay data/recordings --repeat 5 --min-rate 2000
+    python ocr_recorder.py replay data/recordings --diff-out diferencias.jsonl
+"""
+import argparse
+import glob
+import gzip
+import hashlib
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import zlib
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, List, Optional
+
+import fast_json
+
+logger = logging.getLogger(__name__)
+
+# Campos que cambian en cada parseo (o según la fecha o velocidad del replay) y no se comparan
+VOLATILE_FIELDS = ('id_check', 'raw_extracted_text', 'confidence', 'incomplete')
+
+
+def response_shape(response_data) -> str:
+    """Forma de la respuesta de n8n (para agrupar tiempos por tipo de tráfico)"""
+    if isinstance(response_data, list):
+        first = response_data[0] if response_data else None
+        if isinstance(first, dict) and 'clave' in first:
+            return 'lista_clave_valor'
+        return f"lista[{type(first).__name__}]"
+    if isinstance(response_data, dict):
+        return 'objeto:' + ','.join(sorted(response_data)[:3])
+    return type(response_data).__name__
+
+
+class OcrRecorder:
+    """Escribe grabaciones en JSONL comprimido con gzip, rotando por día y tamaño"""
+
+    def __init__(self, directory: str, sample_rate: float = 1.0, store_images: bool = False,
+                 max_file_bytes: int = 64 * 1024 * 1024):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.store_images = store_images
+        self.max_file_bytes = max_file_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._file = None
+        self._path = None
+        self._lock = threading.Lock()
+
+    def _open_file(self):
+        day = datetime.utcnow().strftime('%Y%m%d')
+        if self._file is not None:
+            if self._path.startswith(os.path.join(self.directory, f"recordings-{day}-")) \
+                    and os.path.getsize(self._path) < self.max_file_bytes:
+                return
+            self._file.close()
+        self._path = os.path.join(self.directory, f"recordings-{day}-{os.getpid()}-{int(time.time())}.jsonl.gz")
+        self._file = gzip.open(self._path, 'ab')
+
+    def record(self, filename: str, content_type: str, content: bytes, response_data,
+               parsed: Optional[Dict], error: Optional[str], n8n_seconds: float, parse_seconds: float):
+        """Grabar una extracción (según sample_rate). Los errores de escritura no se propagan."""
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return
+        try:
+            image_sha256 = hashlib.sha256(content).hexdigest()
+            entry = {
+                "ts": datetime.utcnow().isoformat() + 'Z',
+                "filename": filename,
+                "content_type": content_type,
+                "image_sha256": image_sha256,
+                "image_bytes": len(content),
+                "n8n_ms": round(n8n_seconds * 1000, 1),
+                "parse_ms": round(parse_seconds * 1000, 3),
+                "response": response_data,
+                "parsed": {k: v for k, v in parsed.items() if k not in VOLATILE_FIELDS} if parsed else None,
+                "error": error,
+            }
+            line = fast_json.dumps(entry) + b'\n'
+            with self._lock:
+                self._open_file()
+                self._file.write(line)
+                # Sync flush: lo escrito queda legible aunque el proceso termine sin cerrar
+                self._file.flush()
+            if self.store_images:
+                self._store_image(image_sha256, content_type, content)
+        except Exception as e:
+            logger.warning(f"⚠️ No se pudo grabar la respuesta de n8n: {e}")
+
+    def _store_image(self, image_sha256: str, content_type: str, content: bytes):
+        images_dir = os.path.join(self.directory, 'images')
+        os.makedirs(images_dir, exist_ok=True)
+        extension = (content_type or 'image/bin').split('/')[-1]
+        path = os.path.join(images_dir, f"{image_sha256}.{extension}")
+        if not os.path.exists(path):  # Misma imagen = mismo hash: se guarda una sola vez
+            with open(path, 'wb') as f:
+                f.write(content)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def recording_files(paths: Iterable[str]) -> List[str]:
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, 'recordings-*.jsonl.gz'))))
+        else:
+            files.append(path)
+    return files
+
+
+def iter_recordings(paths: Iterable[str]) -> Iterator[Dict]:
+    """Leer grabaciones. Tolera un final truncado (archivo todavía abierto o proceso caído)."""
+    for path in recording_files(paths):
+        try:
+            with gzip.open(path, 'rb') as f:
+                for line in f:
+                    if line.strip():
+                        yield fast_json.loads(line)
+        except (EOFError, zlib.error, gzip.BadGzipFile) as e:
+            logger.warning(f"⚠️ Grabación truncada, se usa lo leído hasta el error: {path} ({e})")
+
+
+def _same_value(recorded, replayed) -> bool:
+    if isinstance(recorded, (int, float)) and isinstance(replayed, (int, float)):
+        return abs(float(recorded) - float(replayed)) < 1e-9
+    return recorded == replayed
+
+
+def compare_outputs(recorded: Optional[Dict], replayed: Optional[Dict]) -> Dict:
+    """Campos que difieren entre la salida grabada y la del replay: {campo: [grabado, replay]}"""
+    if recorded is None or replayed is None:
+        return {} if recorded is replayed else {"_salida": [recorded is not None, replayed is not None]}
+    return {
+        field: [recorded.get(field), replayed.get(field)]
+        for field in recorded
+        if field not in VOLATILE_FIELDS and not _same_value(recorded.get(field), replayed.get(field))
+    }
+
+
+def _percentile(ordered: List[float], fraction: float) -> float:
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] if ordered else 0.0
+
+
+def replay(recordings: List[Dict], repeat: int = 1, diff_out=None, store_index=None) -> Dict:
+    """
+    Re-ejecutar detección de formato, parseo y normalización de tienda (si se pasa el maestro)
+    sobre las respuestas grabadas. La primera pasada compara salidas; las repeticiones solo
+    miden rendimiento.
+    """
+    from n8n_formats import detect_and_parse, StructuredDataError
+    from store_index import normalize_store
+
+    logging.getLogger('invoice_parser').setLevel(logging.WARNING)
+    logging.getLogger('n8n_formats').setLevel(logging.WARNING)
+    logging.getLogger('store_index').setLevel(logging.ERROR)
+
+    timings: Dict[str, List[float]] = {}
+    mismatches = 0
+    compared = 0
+    start_time = time.perf_counter()
+    for iteration in range(repeat):
+        for entry in recordings:
+            if entry.get("response") is None:
+                continue
+            started = time.perf_counter()
+            try:
+                mapped, _ = detect_and_parse(entry["response"])
+                if mapped is not None:
+                    normalize_store(mapped, store_index)
+            except StructuredDataError:
+                mapped = None
+            elapsed = time.perf_counter() - started
+            timings.setdefault(response_shape(entry["response"]), []).append(elapsed)
+            if iteration == 0:
+                compared += 1
+                differences = compare_outputs(entry.get("parsed"), mapped)
+                if differences:
+                    mismatches += 1
+                    if diff_out:
+                        diff_out.write(json.dumps({"image_sha256": entry.get("image_sha256"), "ts": entry.get("ts"),
+                                                   "differences": differences}, ensure_ascii=False, default=str) + '\n')
+    total_seconds = time.perf_counter() - start_time
+
+    all_timings = sorted(t for values in timings.values() for t in values)
+    return {
+        "recordings": len(recordings),
+        "compared": compared,
+        "mismatches": mismatches,
+        "parses": len(all_timings),
+        "parses_per_second": round(len(all_timings) / total_seconds) if total_seconds else None,
+        "p50_ms": round(_percentile(all_timings, 0.50) * 1000, 3),
+        "p99_ms": round(_percentile(all_timings, 0.99) * 1000, 3),
+        "shapes": {
+            shape: {"count": len(values), "p50_ms": round(_percentile(sorted(values), 0.50) * 1000, 3),
+                    "p99_ms": round(_percentile(sorted(values), 0.99) * 1000, 3)}
+            for shape, values in timings.items()
+        },
+        "recorded_n8n_p50_ms": _percentile(sorted(e.get("n8n_ms") or 0 for e in recordings), 0.50),
+    }
+
+
+def _load_store_index(path: Optional[str], table_id: Optional[str]):
+    """Maestro de tiendas para el replay (None si no se indicó: la tienda queda como se leyó)"""
+    from store_index import StoreIndex, load_store_master
+
+    stores = load_store_master(path, table_id)
+    if stores is None:
+        logger.info("Sin maestro de tiendas: codigo_tienda y tienda_nombre se comparan como los leyó el OCR")
+        return None
+    store_index = StoreIndex(lambda: stores, min_similarity=float(os.getenv('STORE_MATCH_MIN_SIMILARITY', '0.5')))
+    logger.info(f"✅ Maestro de tiendas cargado: {store_index.refresh()} tiendas")
+    return store_index
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Replay de respuestas grabadas de n8n")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    rep = sub.add_parser('replay', help="Re-parsear grabaciones sin llamar a n8n")
+    rep.add_argument('paths', nargs='+', help="Directorios o archivos recordings-*.jsonl.gz")
+    rep.add_argument('--repeat', type=int, default=1, help="Cantidad de pasadas (las extra solo miden rendimiento)")
+    rep.add_argument('--check', action='store_true', help="Salir con error si alguna salida difiere")
+    rep.add_argument('--min-rate', type=float, help="Salir con error si parses/s queda por debajo")
+    rep.add_argument('--diff-out', help="Archivo JSONL con las diferencias encontradas")
+    rep.add_argument('--store-master', default=os.getenv('STORE_MASTER_PATH'),
+                     help="Maestro de tiendas (CSV/JSON/JSONL); por defecto STORE_MASTER_PATH")
+    rep.add_argument('--store-master-table', default=os.getenv('STORE_MASTER_TABLE'),
+                     help="Tabla del maestro si no hay archivo; por defecto STORE_MASTER_TABLE")
+
+    args = parser.parse_args()
+    store_index = _load_store_index(args.store_master, args.store_master_table)
+    recordings = list(iter_recordings(args.paths))
+    diff_file = open(args.diff_out, 'w', encoding='utf-8') if args.diff_out else None
+    try:
+        summary = replay(recordings, repeat=max(1, args.repeat), diff_out=diff_file, store_index=store_index)
+    finally:
+        if diff_file:
+            diff_file.close()
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+
+    if args.check and summary["mismatches"]:
+        logger.error(f"❌ {summary['mismatches']} grabaciones producen una salida distinta")
+        sys.exit(1)
+    if args.min_rate and (summary["parses_per_second"] or 0) < args.min_rate:
+        logger.error(f"❌ Rendimiento {summary['parses_per_second']}/s por debajo de {args.min_rate}/s")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,354 @@
+"""
+Re-parseo masivo de facturas históricas con el parser actual.
+Lee un export (JSONL o Parquet) con id_check, raw_extracted_text y los campos guardados,
+re-ejecuta parse_and_map_invoice / parse_structured_data en un pool de procesos por chunks,
+calcula los campos derivados (mes, anio, momento, montos) con operaciones columnares de
+pyarrow y escribe un diff de los campos que cambiarían y, opcionalmente, un archivo listo
+para cargar en una tabla de staging y aplicar con MERGE.
+La tienda se normaliza contra el mismo maestro que usa el servidor (STORE_MASTER_PATH/
+STORE_MASTER_TABLE o --store-master). Sin maestro, codigo_tienda y tienda_nombre quedan fuera
+de la comparación por defecto: la tienda guardada ya puede estar normalizada y el MERGE la
+reemplazaría por el texto leído por el OCR.
+
+Uso (desde backend/):
+    python reparse_cli.py export.parquet --diff-out cambios.jsonl
+    python reparse_cli.py export.jsonl --diff-out cambios.jsonl --merge-out updates.parquet \\
+        --target-table proyecto.dataset.facturas
+"""
+import argparse
+import json
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import fast_json
+from invoice_parser import parse_and_map_invoice
+from n8n_formats import detect_and_parse
+from store_index import StoreIndex, load_store_master, normalize_store
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow es requerido por esta herramienta, no por el servidor
+    pa = None
+
+logger = logging.getLogger(__name__)
+
+TEXT_COLUMN = 'raw_extracted_text'
+
+# Campos que el parser obtiene del texto (canal, recargo y tarifario se completan en el frontend)
+PARSED_FIELDS = (
+    'id_caja', 'codigo_tienda', 'tienda_nombre', 'fecha', 'hora', 'ticket_electronico',
+    'id_boleta', 'monto_op_gravada', 'importe_total', 'mes', 'anio', 'momento', 'a_c',
+)
+STORE_FIELDS = ('codigo_tienda', 'tienda_nombre')
+AMOUNT_FIELDS = ('monto_op_gravada', 'importe_total', 'recargo_consumo', 'monto_tarifario')
+INTEGER_FIELDS = ('mes', 'anio')
+
+
+# Maestro de tiendas del proceso (lo arma _init_worker en cada worker del pool)
+_store_index: Optional[StoreIndex] = None
+
+
+def _parse_text(raw) -> Dict:
+    if raw is None:
+        return parse_and_map_invoice("")
+    if isinstance(raw, str) and raw.lstrip()[:1] in ('[', '{'):
+        try:
+            mapped, raw_text = detect_and_parse(fast_json.loads(raw))
+            if mapped is not None:
+                return mapped
+            return parse_and_map_invoice(raw_text or "")
+        except ValueError:
+            pass  # No es JSON: tratarlo como texto plano
+    return parse_and_map_invoice(str(raw))
+
+
+def parse_raw(raw, store_index: Optional[StoreIndex] = None) -> Dict:
+    """
+    Re-parsear un texto histórico. Si el texto guardado es la respuesta JSON de n8n
+    (array clave/valor u otro formato conocido) se usa el mismo detector que el servidor,
+    y la tienda se normaliza con el maestro como en el servidor.
+    """
+    mapped = _parse_text(raw)
+    normalize_store(mapped, store_index)
+    return mapped
+
+
+def _canonical(column, field: str):
+    """Llevar una columna (del export o re-parseada) a un tipo comparable"""
+    if field in AMOUNT_FIELDS:
+        return pc.round(column.cast(pa.float64()), 2)
+    if field in INTEGER_FIELDS:
+        return column.cast(pa.int64())
+    if pa.types.is_timestamp(column.type):
+        # momento exportado como DATETIME/TIMESTAMP: mismo formato que arma el parser
+        return pc.strftime(column, format='%Y-%m-%dT%H:%M:%S')
+    if pa.types.is_time(column.type):
+        return pc.utf8_slice_codeunits(column.cast(pa.string()), 0, 8)  # HH:MM:SS sin fracción
+    return column.cast(pa.string())
+
+
+def derive_fields(table):
+    """Calcular mes, anio y momento en forma columnar (misma regla que invoice_parser)"""
+    parsed_dates = pc.strptime(table['fecha'], format='%Y-%m-%d', unit='s', error_is_null=True)
+    valid = pc.is_valid(parsed_dates)
+    momento = pc.binary_join_element_wise(
+        table['fecha'], pc.coalesce(table['hora'], pa.scalar('00:00:00')), pa.scalar('T')
+    )
+    derived = {
+        'mes': pc.month(parsed_dates),
+        'anio': pc.year(parsed_dates),
+        'momento': pc.if_else(valid, momento, pa.scalar(None, pa.string())),
+    }
+    for name, column in derived.items():
+        table = table.set_column(table.schema.get_field_index(name), name, column.cast(table.schema.field(name).type))
+    return table
+
+
+def reparse_batch(batch, fields: Sequence[str]) -> Tuple[object, Dict[str, int]]:
+    """
+    Re-parsear un chunk (RecordBatch del export) y compararlo con los valores guardados.
+    Se ejecuta en un proceso del pool. Retorna (tabla con las filas que cambian, cambios por campo).
+    """
+    texts = batch.column(batch.schema.get_field_index(TEXT_COLUMN)).to_pylist()
+    parsed = [parse_raw(text, _store_index) for text in texts]
+
+    # Solo el texto requiere Python fila a fila; el resto se procesa por columnas
+    schema = pa.schema([
+        (name, pa.float64() if name in AMOUNT_FIELDS else pa.int64() if name in INTEGER_FIELDS else pa.string())
+        for name in PARSED_FIELDS
+    ])
+    new = pa.Table.from_pydict({name: [row.get(name) for row in parsed] for name in PARSED_FIELDS}, schema=schema)
+    new = derive_fields(new)
+
+    old = pa.Table.from_batches([batch])
+    changed_any = pa.array([False] * len(batch))
+    changes = {}
+    changed_columns = {}
+    for field in fields:
+        new_column = _canonical(new[field], field)
+        if field not in old.column_names:
+            # Sin valor guardado con qué comparar: la columna __changed igual se escribe (en
+            # false) para que la tabla de staging tenga todas las columnas que usa el MERGE
+            changed_columns[field] = (
+                pa.nulls(len(batch), new_column.type), new_column, pa.array([False] * len(batch))
+            )
+            continue
+        old_column = _canonical(old[field], field)
+        same = pc.or_kleene(
+            pc.fill_null(pc.equal(old_column, new_column), False),
+            pc.and_(pc.is_null(old_column), pc.is_null(new_column)),
+        )
+        changed = pc.invert(same)
+        count = pc.sum(changed).as_py() or 0
+        if count:
+            changes[field] = count
+            changed_any = pc.or_(changed_any, changed)
+        changed_columns[field] = (old_column, new_column, changed)
+
+    columns = {'id_check': old['id_check'].cast(pa.string())}
+    for field, (old_column, new_column, changed) in changed_columns.items():
+        columns[f'{field}__old'] = old_column
+        columns[field] = new_column
+        columns[f'{field}__changed'] = changed
+    result = pa.table(columns).filter(changed_any)
+    return result, changes
+
+
+def _init_worker(stores: Optional[List[Tuple[str, str]]] = None, min_similarity: float = 0.5):
+    global _store_index
+    # El parser estructurado loguea cada campo a nivel INFO: silenciarlo en los workers
+    logging.getLogger().setLevel(logging.WARNING)
+    # Tiendas fuera del maestro: se ven en el diff, no hace falta un warning por fila
+    logging.getLogger('store_index').setLevel(logging.ERROR)
+    if stores is not None:
+        _store_index = StoreIndex(lambda: stores, min_similarity=min_similarity)
+        _store_index.refresh()
+
+
+def _reparse_counted(batch, fields):
+    table, changes = reparse_batch(batch, fields)
+    return table, changes, len(batch)
+
+
+def _jsonl_batch(rows: List[Dict], schema):
+    # El export JSON de BigQuery trae números como texto: todo se lee como string y
+    # _canonical lo convierte al tipo de cada campo
+    return pa.RecordBatch.from_pylist([
+        {name: None if row.get(name) is None else str(row[name]) for name in schema.names} for row in rows
+    ], schema=schema)
+
+
+def read_batches(path: str, chunk_size: int) -> Iterator:
+    """
+    Leer el export en chunks (Parquet por row groups o JSONL por líneas). En JSONL el esquema
+    se fija con las claves de la primera fila, así todos los chunks tienen los mismos tipos
+    aunque una columna venga vacía en un chunk entero.
+    """
+    if path.endswith('.parquet'):
+        yield from pq.ParquetFile(path).iter_batches(batch_size=chunk_size)
+        return
+    with open(path, 'r', encoding='utf-8') as f:
+        schema = None
+        rows = []
+        for line in f:
+            if line.strip():
+                rows.append(json.loads(line))
+                if schema is None:
+                    schema = pa.schema([(name, pa.string()) for name in rows[0]])
+            if len(rows) >= chunk_size:
+                yield _jsonl_batch(rows, schema)
+                rows = []
+        if rows:
+            yield _jsonl_batch(rows, schema)
+
+
+def write_diff(table, fields: Sequence[str], f):
+    """Escribir una línea JSON por factura con los campos que cambian (valor anterior y nuevo)"""
+    for row in table.to_pylist():
+        changes = {
+            field: {"old": row[f'{field}__old'], "new": row[field]}
+            for field in fields if row.get(f'{field}__changed')
+        }
+        f.write(json.dumps({"id_check": row['id_check'], "changes": changes}, ensure_ascii=False) + '\n')
+
+
+def merge_sql(target_table: str, staging_table: str, fields: Sequence[str]) -> str:
+    """
+    Sentencia MERGE para aplicar los cambios cargados en la tabla de staging.
+    Solo se actualiza un campo si cambió (columna <campo>__changed).
+    """
+    # En staging las fechas y horas quedan como texto: convertirlas al tipo de la tabla
+    casts = {'fecha': 'DATE', 'hora': 'TIME', 'momento': 'DATETIME'}
+    values = {field: f"CAST(S.{field} AS {casts[field]})" if field in casts else f"S.{field}" for field in fields}
+    assignments = ",\n    ".join(
+        f"{field} = IF(S.{field}__changed, {values[field]}, T.{field})" for field in fields
+    )
+    return (
+        f"MERGE `{target_table}` T\n"
+        f"USING `{staging_table}` S\n"
+        f"ON T.id_check = S.id_check\n"
+        f"WHEN MATCHED THEN UPDATE SET\n    {assignments};\n"
+    )
+
+
+def run(path: str, fields: Sequence[str], diff_out: Optional[str], merge_out: Optional[str],
+        workers: int, chunk_size: int, stores: Optional[List[Tuple[str, str]]] = None,
+        min_similarity: float = 0.5) -> Dict:
+    """
+    Re-parsear todo el export con un pool de procesos y escribir los resultados.
+    stores es el maestro de tiendas ya leído (se envía una vez a cada worker).
+    """
+    start_time = time.time()
+    totals: Dict[str, int] = {}
+    processed = 0
+    changed_rows = 0
+    merge_tables: List = []
+    diff_file = open(diff_out, 'w', encoding='utf-8') if diff_out else None
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(stores, min_similarity)) as pool:
+            pending = set()
+            batches = read_batches(path, chunk_size)
+
+            def collect(done):
+                nonlocal processed, changed_rows
+                for future in done:
+                    table, changes, rows = future.result()
+                    processed += rows
+                    changed_rows += table.num_rows
+                    for field, count in changes.items():
+                        totals[field] = totals.get(field, 0) + count
+                    if diff_file and table.num_rows:
+                        write_diff(table, fields, diff_file)
+                    if merge_out and table.num_rows:
+                        merge_tables.append(table.drop([c for c in table.column_names if c.endswith('__old')]))
+
+            for batch in batches:
+                # Limitar chunks en vuelo para no cargar el export completo en memoria
+                if len(pending) >= workers * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+                pending.add(pool.submit(_reparse_counted, batch, tuple(fields)))
+            done, _ = wait(pending)
+            collect(done)
+    finally:
+        if diff_file:
+            diff_file.close()
+
+    if merge_out:
+        merged = pa.concat_tables(merge_tables) if merge_tables else None
+        if merged is not None:
+            if merge_out.endswith('.parquet'):
+                pq.write_table(merged, merge_out, compression='zstd')
+            else:
+                with open(merge_out, 'w', encoding='utf-8') as f:
+                    for row in merged.to_pylist():
+                        f.write(json.dumps(row, ensure_ascii=False) + '\n')
+
+    elapsed = time.time() - start_time
+    return {
+        "processed": processed,
+        "changed_rows": changed_rows,
+        "changes_by_field": totals,
+        "seconds": round(elapsed, 1),
+        "rows_per_second": round(processed / elapsed) if elapsed else None,
+    }
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Re-parseo masivo de facturas históricas")
+    parser.add_argument('input', help="Export JSONL o Parquet con id_check y raw_extracted_text")
+    parser.add_argument('--diff-out', help="Archivo JSONL con los cambios por factura")
+    parser.add_argument('--merge-out', help="Filas cambiadas para cargar en staging (.parquet o .jsonl)")
+    parser.add_argument('--target-table', default=None, help="Tabla destino del MERGE (proyecto.dataset.tabla)")
+    parser.add_argument('--staging-table', default=None, help="Tabla de staging (por defecto <destino>_reparse)")
+    parser.add_argument('--fields', default=None,
+                        help="Campos a comparar (por defecto todos; sin maestro, todos menos la tienda)")
+    parser.add_argument('--store-master', default=os.getenv('STORE_MASTER_PATH'),
+                        help="Maestro de tiendas (CSV/JSON/JSONL); por defecto STORE_MASTER_PATH")
+    parser.add_argument('--store-master-table', default=os.getenv('STORE_MASTER_TABLE'),
+                        help="Tabla del maestro si no hay archivo; por defecto STORE_MASTER_TABLE")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--chunk-size', type=int, default=5000)
+    args = parser.parse_args()
+
+    if pa is None:
+        parser.error("pyarrow no está instalado (pip install pyarrow)")
+    stores = load_store_master(args.store_master, args.store_master_table)
+    if args.fields:
+        fields = [field.strip() for field in args.fields.split(',') if field.strip()]
+    elif stores is None:
+        fields = [field for field in PARSED_FIELDS if field not in STORE_FIELDS]
+        logger.warning(f"⚠️ Sin maestro de tiendas: {', '.join(STORE_FIELDS)} no se comparan "
+                       f"(indicar --store-master o --fields para incluirlos)")
+    else:
+        fields = list(PARSED_FIELDS)
+    unknown = set(fields) - set(PARSED_FIELDS)
+    if unknown:
+        parser.error(f"Campos no soportados: {sorted(unknown)}")
+    if stores is not None:
+        logger.info(f"Maestro de tiendas: {len(stores)} filas")
+
+    summary = run(args.input, fields, args.diff_out, args.merge_out, args.workers, args.chunk_size,
+                  stores, float(os.getenv('STORE_MATCH_MIN_SIMILARITY', '0.5')))
+    logger.info(f"✅ Re-parseo terminado: {json.dumps(summary, ensure_ascii=False)}")
+
+    if args.merge_out:
+        target = args.target_table or (
+            f"{os.getenv('BIGQUERY_PROJECT_ID')}.{os.getenv('BIGQUERY_DATASET_ID')}.{os.getenv('BIGQUERY_TABLE_ID')}"
+        )
+        staging = args.staging_table or f"{target}_reparse"
+        sql_path = os.path.splitext(args.merge_out)[0] + '.sql'
+        with open(sql_path, 'w', encoding='utf-8') as f:
+            f.write(merge_sql(target, staging, fields))
+        logger.info(f"Cargar {args.merge_out} en `{staging}` y ejecutar {sql_path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+"""
+Compresión de respuestas (brotli/gzip) y respuestas condicionales con ETag.
+El middleware comprime solo cuerpos por encima de un tamaño mínimo y nunca los streams SSE;
+conditional_json permite a los endpoints de solo lectura responder 304 cuando el cliente ya
+tiene la misma versión (If-None-Match), sin reenviar el cuerpo.
+"""
+import hashlib
+import zlib
+from typing import Iterable, Optional
+
+from fastapi import Request
+from fastapi.responses import Response
+from starlette.datastructures import Headers, MutableHeaders
+
+import fast_json
+
+try:
+    import brotli
+except ImportError:  # brotli es opcional: sin él solo se ofrece gzip
+    brotli = None
+
+ENCODING_BROTLI = "br"
+ENCODING_GZIP = "gzip"
+
+# Tipos que no se comprimen: streams (el compresor retendría eventos) y formatos ya comprimidos
+DEFAULT_EXCLUDED_TYPES = ("text/event-stream", "image/", "video/", "audio/", "application/zip",
+                          "application/gzip", "application/octet-stream", "application/vnd.apache.parquet")
+
+
+def choose_encoding(accept_encoding: Optional[str], brotli_enabled: bool = True) -> Optional[str]:
+    """Elegir la codificación según Accept-Encoding (respeta q=0; a igual q prefiere brotli)"""
+    if not accept_encoding:
+        return None
+    weights = {}
+    for part in accept_encoding.split(','):
+        name, _, params = part.strip().partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        weights[name.strip().lower()] = quality
+    candidates = []
+    if brotli is not None and brotli_enabled:
+        candidates.append(ENCODING_BROTLI)
+    candidates.append(ENCODING_GZIP)
+    best = None
+    for encoding in candidates:
+        quality = weights.get(encoding, weights.get('*', 0.0))
+        if quality > 0 and (best is None or quality > best[1]):
+            best = (encoding, quality)
+    return best[0] if best else None
+
+
+class _Compressor:
+    """Compresor incremental con la misma interfaz para gzip y brotli"""
+
+    def __init__(self, encoding: str, gzip_level: int, brotli_quality: int):
+        self.encoding = encoding
+        if encoding == ENCODING_BROTLI:
+            self._brotli = brotli.Compressor(quality=brotli_quality)
+        else:
+            self._zlib = zlib.compressobj(gzip_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data: bytes, flush: bool = False) -> bytes:
+        """Comprimir un bloque; flush=True entrega lo pendiente para que el cliente no espere"""
+        if self.encoding == ENCODING_BROTLI:
+            out = self._brotli.process(data)
+            return out + self._brotli.flush() if flush else out
+        out = self._zlib.compress(data)
+        return out + self._zlib.flush(zlib.Z_SYNC_FLUSH) if flush else out
+
+    def finish(self) -> bytes:
+        if self.encoding == ENCODING_BROTLI:
+            return self._brotli.finish()
+        return self._zlib.flush(zlib.Z_FINISH)
+
+
+class CompressionMiddleware:
+    """
+    Middleware ASGI de compresión. Las respuestas completas se comprimen solo si superan
+    minimum_size y el resultado es más chico; las respuestas en partes se comprimen bloque a bloque.
+    """
+
+    def __init__(self, app, minimum_size: int = 1024, gzip_level: int = 6, brotli_quality: int = 4,
+                 brotli_enabled: bool = True, excluded_types: Iterable[str] = DEFAULT_EXCLUDED_TYPES):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.brotli_enabled = brotli_enabled
+        self.excluded_types = tuple(excluded_types)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = choose_encoding(Headers(scope=scope).get("accept-encoding"), self.brotli_enabled)
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message = None
+        compressor: Optional[_Compressor] = None
+        passthrough = False
+
+        async def send_wrapper(message):
+            nonlocal start_message, compressor, passthrough
+            if message["type"] == "http.response.start":
+                start_message = message  # Se envía junto con el primer bloque del cuerpo
+                return
+            if message["type"] != "http.response.body" or passthrough:
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if compressor is None:
+                headers = MutableHeaders(raw=start_message["headers"])
+                content_type = headers.get("content-type", "")
+                if ("content-encoding" in headers or start_message["status"] in (204, 304)
+                        or content_type.startswith(self.excluded_types)
+                        or (not more_body and len(body) < self.minimum_size)):
+                    passthrough = True
+                    await send(start_message)
+                    await send(message)
+                    return
+
+                compressor = _Compressor(encoding, self.gzip_level, self.brotli_quality)
+                if not more_body:
+                    compressed = compressor.compress(body) + compressor.finish()
+                    if len(compressed) >= len(body):
+                        passthrough = True
+                        await send(start_message)
+                        await send(message)
+                        return
+                    self._set_encoding_headers(headers, encoding, len(compressed))
+                    await send(start_message)
+                    await send({"type": "http.response.body", "body": compressed})
+                    return
+                self._set_encoding_headers(headers, encoding, None)
+                await send(start_message)
+
+            if more_body:
+                await send({"type": "http.response.body", "body": compressor.compress(body, flush=True),
+                            "more_body": True})
+            else:
+                await send({"type": "http.response.body", "body": compressor.compress(body) + compressor.finish()})
+
+        await self.app(scope, receive, send_wrapper)
+
+    @staticmethod
+    def _set_encoding_headers(headers: MutableHeaders, encoding: str, content_length: Optional[int]):
+        headers["Content-Encoding"] = encoding
+        headers.add_vary_header("Accept-Encoding")
+        if content_length is None:
+            del headers["Content-Length"]
+        else:
+            headers["Content-Length"] = str(content_length)
+        # El ETag identifica el cuerpo sin comprimir: la versión comprimida es equivalente, no idéntica
+        etag = headers.get("etag")
+        if etag and not etag.startswith("W/"):
+            headers["ETag"] = "W/" + etag
+
+
+def compute_etag(body: bytes) -> str:
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Comparación débil de If-None-Match (ignora el prefijo W/ que agrega la compresión)"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag[2:] if etag.startswith("W/") else etag
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if (candidate[2:] if candidate.startswith("W/") else candidate) == opaque:
+            return True
+    return False
+
+
+def conditional_json(request: Request, content, cache_control: str = "private, no-cache") -> Response:
+    """
+    Respuesta JSON con ETag. Si el cliente envía un If-None-Match que coincide responde
+    304 sin cuerpo. "no-cache" obliga a revalidar siempre, así los datos nunca quedan viejos.
+    """
+    body = fast_json.dumps(content)
+    etag = compute_etag(body)
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
@@ -0,0 +1,244 @@
+"""
+Profiler estadístico por muestreo para producción.
+Un hilo toma cada intervalo la pila de todos los hilos del proceso (sys._current_frames) y
+cuenta las pilas repetidas; el costo es proporcional a la frecuencia de muestreo, no a la
+cantidad de llamadas, así que se puede usar con tráfico real. El resultado se guarda como
+pilas colapsadas (flamegraph.pl, speedscope, inferno) y como JSON de speedscope.
+- Perfil del proceso: ProfilerManager.profile(segundos) desde un endpoint de admin.
+- Perfil por request: ProfilingMiddleware perfila una fracción de los requests que traen el
+  header con el token configurado; la respuesta indica el archivo en X-Profile-File.
+"""
+import asyncio
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from starlette.datastructures import Headers, MutableHeaders
+
+import fast_json
+
+# Hojas de pila de hilos esperando (pool sin trabajo, selector del event loop sin eventos)
+IDLE_LEAVES = frozenset([
+    ('threading.py', 'wait'),
+    ('queue.py', 'get'),
+    ('selectors.py', 'select'),
+    ('thread.py', '_worker'),
+])
+
+
+def _frame_label(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class StackSampler:
+    """Muestreo de las pilas de todos los hilos (salvo el propio) cada interval segundos"""
+
+    def __init__(self, interval: float = 0.01, include_idle: bool = False):
+        self.interval = interval
+        self.include_idle = include_idle
+        self.counts: Counter = Counter()
+        self.samples = 0
+        self.started_at = 0.0
+        self.duration = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.started_at = time.time()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> "StackSampler":
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+        self.duration = time.time() - self.started_at
+        return self
+
+    def _run(self):
+        own_id = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            for thread in threading.enumerate():
+                names.setdefault(thread.ident, thread.name)
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                code = frame.f_code
+                if not self.include_idle and (os.path.basename(code.co_filename), code.co_name) in IDLE_LEAVES:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_label(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.counts[tuple(reversed(stack))] += 1
+            self.samples += 1
+
+    def to_collapsed(self) -> str:
+        """Formato de pilas colapsadas: 'hilo;raíz;...;hoja cantidad' por línea"""
+        return "".join(f"{';'.join(stack)} {count}\n" for stack, count in self.counts.most_common())
+
+    def to_speedscope(self, name: str) -> Dict:
+        """Perfil 'sampled' de speedscope (un perfil con todas las pilas, peso en segundos)"""
+        frames: List[Dict] = []
+        frame_index: Dict[str, int] = {}
+        samples, weights = [], []
+        for stack, count in self.counts.most_common():
+            indexes = []
+            for label in stack:
+                if label not in frame_index:
+                    frame_index[label] = len(frames)
+                    frames.append({"name": label})
+                indexes.append(frame_index[label])
+            samples.append(indexes)
+            weights.append(round(count * self.interval, 6))
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "shared": {"frames": frames},
+            "profiles": [{
+                "type": "sampled",
+                "name": name,
+                "unit": "seconds",
+                "startValue": 0,
+                "endValue": round(self.duration, 6),
+                "samples": samples,
+                "weights": weights,
+            }],
+            "name": name,
+            "exporter": "sampling_profiler",
+        }
+
+    def top(self, limit: int = 15) -> List[Tuple[str, int]]:
+        """Funciones con más muestras propias (hoja de la pila)"""
+        leaves: Counter = Counter()
+        for stack, count in self.counts.items():
+            leaves[stack[-1]] += count
+        return leaves.most_common(limit)
+
+
+class ProfilerManager:
+    """Ejecuta perfiles (uno a la vez) y guarda los resultados en directory"""
+
+    def __init__(self, directory: str, interval: float = 0.01, max_files: int = 50):
+        self.directory = directory
+        self.interval = interval
+        self.max_files = max_files
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def try_start(self, interval: Optional[float] = None) -> Optional[StackSampler]:
+        """Iniciar un muestreo si no hay otro en curso (None si está ocupado)"""
+        if not self._lock.acquire(blocking=False):
+            return None
+        sampler = StackSampler(interval or self.interval)
+        sampler.start()
+        return sampler
+
+    def finish(self, sampler: StackSampler, label: str, name: Optional[str] = None) -> Dict:
+        """Detener el muestreo, guardar ambos formatos y liberar el profiler"""
+        try:
+            sampler.stop()
+        finally:
+            self._lock.release()
+        name = name or self.new_name(label)
+        with open(os.path.join(self.directory, f"{name}.collapsed.txt"), 'w', encoding='utf-8') as f:
+            f.write(sampler.to_collapsed())
+        with open(os.path.join(self.directory, f"{name}.speedscope.json"), 'wb') as f:
+            f.write(fast_json.dumps(sampler.to_speedscope(f"{label} ({sampler.duration:.1f}s)")))
+        self._prune()
+        return {
+            "name": name,
+            "label": label,
+            "seconds": round(sampler.duration, 3),
+            "samples": sampler.samples,
+            "stacks": len(sampler.counts),
+            "files": [f"{name}.collapsed.txt", f"{name}.speedscope.json"],
+            "top": [{"frame": frame, "samples": count} for frame, count in sampler.top()],
+        }
+
+    def new_name(self, label: str) -> str:
+        safe = ''.join(c if c.isalnum() else '-' for c in label).strip('-')[:40]
+        return f"profile-{datetime.now().strftime('%Y%m%d-%H%M%S')}-{random.randint(0, 9999):04d}-{safe}"
+
+    async def profile(self, seconds: float, interval: Optional[float] = None, label: str = "process") -> Optional[Dict]:
+        """Perfilar todo el proceso durante seconds (None si ya hay un perfil en curso)"""
+        sampler = self.try_start(interval)
+        if sampler is None:
+            return None
+        try:
+            await asyncio.sleep(seconds)
+        except BaseException:
+            sampler.stop()
+            self._lock.release()
+            raise
+        return await asyncio.to_thread(self.finish, sampler, label)
+
+    def list_files(self) -> List[Dict]:
+        entries = []
+        for name in sorted(os.listdir(self.directory), reverse=True):
+            path = os.path.join(self.directory, name)
+            if os.path.isfile(path):
+                entries.append({"file": name, "size": os.path.getsize(path), "modified": os.path.getmtime(path)})
+        return entries
+
+    def path_for(self, filename: str) -> Optional[str]:
+        """Ruta de un archivo de perfil (None si no existe o el nombre sale del directorio)"""
+        if os.path.basename(filename) != filename or not filename.startswith('profile-'):
+            return None
+        path = os.path.join(self.directory, filename)
+        return path if os.path.isfile(path) else None
+
+    def _prune(self):
+        files = sorted(
+            (os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.startswith('profile-')),
+            key=os.path.getmtime,
+        )
+        for path in files[:max(0, len(files) - self.max_files * 2)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+class ProfilingMiddleware:
+    """
+    Perfila requests individuales: si el request trae header con el token y cae dentro de
+    sample_rate, se muestrea el proceso mientras dura y se guarda con el método y la ruta.
+    Las muestras incluyen los demás requests concurrentes (el muestreo es de todo el proceso).
+    """
+
+    def __init__(self, app, manager: ProfilerManager, token: str, header: str = "x-profile",
+                 sample_rate: float = 1.0):
+        self.app = app
+        self.manager = manager
+        self.token = token
+        self.header = header.lower()
+        self.sample_rate = sample_rate
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or Headers(scope=scope).get(self.header) != self.token \
+                or random.random() >= self.sample_rate:
+            await self.app(scope, receive, send)
+            return
+        sampler = self.manager.try_start()
+        if sampler is None:
+            await self.app(scope, receive, send)
+            return
+        label = f"{scope['method']} {scope['path']}"
+        name = self.manager.new_name(label)
+
+        async def send_with_header(message):
+            if message["type"] == "http.response.start":
+                MutableHeaders(scope=message).append("X-Profile-File", f"{name}.speedscope.json")
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_header)
+        finally:
+            await asyncio.to_thread(self.manager.finish, sampler, label, name)
@@ -0,0 +1,135 @@
+"""
+Tokens de sesión propios del backend (HMAC-SHA256, corta duración).
+Se emiten tras una verificación exitosa con Google y se validan localmente sin red.
+Soporta rotación de claves por 'kid' y revocación por contador de versión por usuario.
+"""
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import secrets
+import time
+from typing import Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Prefijo que distingue los tokens de sesión de los tokens de Google
+SESSION_TOKEN_PREFIX = 'ngr1.'
+
+
+class InvalidSessionToken(ValueError):
+    """Token de sesión mal formado, con firma inválida, expirado o revocado"""
+
+
+def _b64url_encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _b64url_decode(segment: str) -> bytes:
+    return base64.urlsafe_b64decode(segment + '=' * (-len(segment) % 4))
+
+
+def is_session_token(token: str) -> bool:
+    return token.startswith(SESSION_TOKEN_PREFIX)
+
+
+def parse_signing_keys(raw: str) -> Dict[str, bytes]:
+    """
+    Parsear claves con formato 'kid1:secreto1,kid2:secreto2'.
+    La primera es la clave activa para firmar; el resto solo se aceptan al verificar.
+    """
+    keys = {}
+    for entry in raw.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        kid, _, secret = entry.partition(':')
+        if not secret:
+            raise ValueError(f"Clave de sesión sin secreto para kid '{kid}'")
+        keys[kid.strip()] = secret.strip().encode('utf-8')
+    return keys
+
+
+class SessionTokenSigner:
+    """Emite y valida tokens de sesión firmados con HMAC-SHA256"""
+
+    def __init__(self, keys: Dict[str, bytes], ttl_seconds: int):
+        if not keys:
+            # Sin claves configuradas: generar una efímera (los tokens no sobreviven reinicios)
+            logger.warning("⚠️ SESSION_SIGNING_KEYS no configurada. Usando clave efímera de proceso.")
+            keys = {'ephemeral': secrets.token_bytes(32)}
+        self.keys = keys
+        self.active_kid = next(iter(keys))
+        self.ttl_seconds = ttl_seconds
+
+    def _sign(self, kid: str, message: bytes) -> bytes:
+        return hmac.new(self.keys[kid], message, hashlib.sha256).digest()
+
+    def issue(self, email: str, role: str, version: int) -> str:
+        """Emitir un token de sesión para un usuario ya verificado"""
+        now = int(time.time())
+        claims = {
+            "kid": self.active_kid,
+            "sub": email,
+            "role": role,
+            "ver": version,
+            "iat": now,
+            "exp": now + self.ttl_seconds,
+        }
+        payload = _b64url_encode(json.dumps(claims, separators=(',', ':')).encode('utf-8'))
+        signature = _b64url_encode(self._sign(self.active_kid, payload.encode('ascii')))
+        return f"{SESSION_TOKEN_PREFIX}{payload}.{signature}"
+
+    def verify(self, token: str, version_for: Callable[[str], int]) -> Dict:
+        """
+        Validar un token de sesión. Solo CPU: no hace llamadas de red.
+
+        Args:
+            token: token con prefijo SESSION_TOKEN_PREFIX
+            version_for: función email -> versión de sesión vigente (revocación)
+        """
+        try:
+            payload, signature = token[len(SESSION_TOKEN_PREFIX):].split('.')
+            claims = json.loads(_b64url_decode(payload))
+            given_signature = _b64url_decode(signature)
+            signed_section = payload.encode('ascii')
+            if not isinstance(claims, dict):
+                raise ValueError("el payload no es un objeto")
+        except (ValueError, TypeError) as e:
+            raise InvalidSessionToken(f"Token de sesión mal formado: {e}")
+
+        kid = claims.get('kid')
+        if kid not in self.keys:
+            raise InvalidSessionToken(f"Clave de firma desconocida: {kid}")
+        if not hmac.compare_digest(self._sign(kid, signed_section), given_signature):
+            raise InvalidSessionToken("Firma de token de sesión inválida")
+        if claims.get('exp', 0) < time.time():
+            raise InvalidSessionToken("Token de sesión expirado")
+        if claims.get('ver') != version_for(claims.get('sub', '')):
+            raise InvalidSessionToken("Token de sesión revocado")
+        return claims
+
+
+class SessionVersions:
+    """Contador de versión de sesión por usuario: incrementarlo revoca sus tokens emitidos"""
+
+    def __init__(self, initial: Optional[Dict[str, int]] = None):
+        self._versions: Dict[str, int] = dict(initial or {})
+
+    def __len__(self):
+        return len(self._versions)
+
+    def get(self, email: str) -> int:
+        return self._versions.get(email, 0)
+
+    def bump(self, email: str) -> int:
+        self._versions[email] = self.get(email) + 1
+        return self._versions[email]
+
+    def update(self, versions: Dict[str, int]):
+        for email, version in versions.items():
+            self._versions[email] = max(self.get(email), int(version))
+
+    def as_dict(self) -> Dict[str, int]:
+        return dict(self._versions)
@@ -0,0 +1,274 @@
+"""
+Índice del maestro de tiendas para normalizar codigo_tienda y tienda_nombre de cada factura.
+El OCR confunde letras ("SAN MARTlN") y el formato estructurado de n8n devuelve lo que leyó,
+así que la misma tienda termina con claves distintas. El índice resuelve:
+- por código exacto (tolerando ceros a la izquierda y, en códigos numéricos, O/I leídas en vez
+  de 0/1; los códigos alfanuméricos se comparan en mayúsculas sin signos);
+- por nombre aproximado con un índice invertido de trigramas (similitud de Jaccard), que solo
+  compara contra las tiendas que comparten los trigramas menos frecuentes del nombre leído.
+El maestro se carga de un archivo local (CSV/JSON/JSONL) o de una tabla de BigQuery y se
+refresca en segundo plano; cada recarga arma un snapshot nuevo y lo reemplaza de una vez.
+normalize_store aplica el maestro a una factura parseada: la usan el servidor y las herramientas
+offline (replay de grabaciones y re-parseo masivo) para producir la misma salida.
+"""
+import csv
+import logging
+import re
+import threading
+import time
+import unicodedata
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import fast_json
+
+logger = logging.getLogger(__name__)
+
+# Confusiones típicas del OCR: en nombres se leen dígitos por letras y en códigos al revés
+_NAME_FOLD = str.maketrans({'0': 'O', '1': 'I', '|': 'I', '5': 'S'})
+_CODE_FOLD = str.maketrans({'O': '0', 'o': '0', 'I': '1', 'l': '1', '|': '1', 'S': '5'})
+
+
+class StoreMatch(NamedTuple):
+    codigo_tienda: str
+    tienda_nombre: str
+    score: float   # 1.0 = código y nombre coinciden; similitud del nombre si se resolvió por nombre
+    method: str    # 'code+name', 'code' o 'name'
+
+
+def normalize_name(name: Optional[str]) -> str:
+    """Mayúsculas sin acentos ni signos, con las confusiones de OCR corregidas"""
+    if not name:
+        return ""
+    text = unicodedata.normalize('NFKD', str(name)).encode('ascii', 'ignore').decode('ascii')
+    text = text.upper().translate(_NAME_FOLD)
+    return re.sub(r'[^A-Z0-9]+', ' ', text).strip()
+
+
+def normalize_code(code: Optional[str]) -> str:
+    """
+    Clave de búsqueda del código. Si la mayoría de los caracteres son dígitos se corrigen las
+    letras leídas por dígitos y se quitan los ceros a la izquierda ('O15' -> '15'); los códigos
+    alfanuméricos ('LIM-A2') quedan en mayúsculas sin espacios ni signos ('LIMA2').
+    """
+    if code is None:
+        return ""
+    compact = re.sub(r'[^A-Za-z0-9|]+', '', str(code))
+    if not compact:
+        return ""
+    if sum(ch.isdigit() for ch in compact) * 2 > len(compact):
+        digits = compact.translate(_CODE_FOLD)
+        if digits.isdigit():
+            return digits.lstrip('0') or '0'
+    return compact.replace('|', 'I').upper()
+
+
+def trigrams(normalized: str) -> frozenset:
+    padded = f"  {normalized} "
+    return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+class _Snapshot:
+    """Maestro cargado (inmutable una vez construido)"""
+
+    def __init__(self, stores: Iterable[Tuple[str, str]]):
+        self.stores: List[Tuple[str, str]] = []
+        self.grams: List[frozenset] = []
+        self.by_code: Dict[str, int] = {}
+        self.by_gram: Dict[str, List[int]] = {}
+        skipped = 0
+        for code, name in stores:
+            key = normalize_code(code)
+            if not key or not name:
+                skipped += 1
+                continue
+            index = len(self.stores)
+            self.stores.append((str(code).strip(), str(name).strip()))
+            grams = trigrams(normalize_name(name))
+            self.grams.append(grams)
+            self.by_code[key] = index
+            for gram in grams:
+                self.by_gram.setdefault(gram, []).append(index)
+        if skipped:
+            logger.warning(f"⚠️ Maestro de tiendas: {skipped} filas sin código o nombre se omitieron")
+
+
+class StoreIndex:
+    """Maestro de tiendas con búsqueda por código y por nombre aproximado"""
+
+    def __init__(self, loader: Callable[[], Iterable[Tuple[str, str]]], refresh_interval: float = 3600.0,
+                 min_similarity: float = 0.5):
+        self.loader = loader
+        self.refresh_interval = refresh_interval
+        self.min_similarity = min_similarity
+        self.loaded_at: Optional[float] = None
+        self._snapshot = _Snapshot(())
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._snapshot.stores)
+
+    def refresh(self) -> int:
+        """Recargar el maestro con el loader y reemplazar el snapshot. Retorna la cantidad de tiendas."""
+        snapshot = _Snapshot(self.loader())
+        self._snapshot = snapshot
+        self.loaded_at = time.time()
+        return len(snapshot.stores)
+
+    def load(self, stores: Iterable[Tuple[str, str]]) -> int:
+        """Cargar tiendas directamente (sin loader)"""
+        self._snapshot = _Snapshot(stores)
+        self.loaded_at = time.time()
+        return len(self._snapshot.stores)
+
+    def by_code(self, code: Optional[str]) -> Optional[Tuple[str, str]]:
+        snapshot = self._snapshot
+        index = snapshot.by_code.get(normalize_code(code))
+        return snapshot.stores[index] if index is not None else None
+
+    def by_name(self, name: Optional[str]) -> Optional[Tuple[Tuple[str, str], float]]:
+        """Tienda con el nombre más parecido (y su similitud) o None si ninguna llega a min_similarity"""
+        snapshot = self._snapshot
+        query = trigrams(normalize_name(name)) if name else frozenset()
+        if not query:
+            return None
+        # Se recorren las listas de los trigramas más raros primero. Después de i trigramas, una
+        # tienda todavía no vista comparte a lo sumo |q| - i con el nombre leído, así que su Jaccard
+        # es <= (|q| - i) / |q|: cuando esa cota no supera al mejor encontrado (o al mínimo) se corta.
+        ordered = sorted(query, key=lambda gram: len(snapshot.by_gram.get(gram, ())))
+        size = len(query)
+        seen = set()
+        best, best_score = None, 0.0
+        for i, gram in enumerate(ordered):
+            bound = (size - i) / size
+            if bound < self.min_similarity or (best is not None and bound <= best_score):
+                break
+            for index in snapshot.by_gram.get(gram, ()):
+                if index in seen:
+                    continue
+                seen.add(index)
+                grams = snapshot.grams[index]
+                common = len(query & grams)
+                score = common / (size + len(grams) - common)
+                if score > best_score:
+                    best, best_score = index, score
+        if best is None or best_score < self.min_similarity:
+            return None
+        return snapshot.stores[best], best_score
+
+    def resolve(self, code: Optional[str], name: Optional[str]) -> Optional[StoreMatch]:
+        """
+        Resolver la tienda leída. El código manda si el nombre lo confirma (o no hay nombre);
+        si el nombre apunta claramente a otra tienda se usa el nombre (el código se leyó mal);
+        si el nombre no se parece a ninguna, se usa el código solo.
+        """
+        store = self.by_code(code)
+        if store is not None:
+            if not name:
+                return StoreMatch(store[0], store[1], 0.9, 'code')
+            similarity = self._similarity(name, store[1])
+            if similarity >= self.min_similarity:
+                return StoreMatch(store[0], store[1], 1.0, 'code+name')
+        named = self.by_name(name)
+        if named is not None:
+            (found_code, found_name), similarity = named
+            return StoreMatch(found_code, found_name, round(similarity, 2), 'name')
+        if store is not None:
+            return StoreMatch(store[0], store[1], 0.9, 'code')
+        return None
+
+    @staticmethod
+    def _similarity(a: str, b: str) -> float:
+        grams_a, grams_b = trigrams(normalize_name(a)), trigrams(normalize_name(b))
+        union = len(grams_a | grams_b)
+        return len(grams_a & grams_b) / union if union else 0.0
+
+    def start(self):
+        """Iniciar el hilo que carga el maestro y lo refresca cada refresh_interval"""
+        self._thread = threading.Thread(target=self._refresh_loop, name="store-index", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _refresh_loop(self):
+        delay = 0.0
+        while not self._stop.wait(delay):
+            try:
+                start_time = time.time()
+                count = self.refresh()
+                logger.info(f"✅ Maestro de tiendas cargado: {count} tiendas en {time.time() - start_time:.2f}s")
+                delay = self.refresh_interval
+            except Exception as e:
+                # Se conserva el snapshot anterior; se reintenta antes del próximo refresco normal
+                logger.warning(f"⚠️ Error al cargar el maestro de tiendas: {e}")
+                delay = min(self.refresh_interval, 60.0)
+
+
+def normalize_store(record, store_index: Optional[StoreIndex]) -> Optional[StoreMatch]:
+    """
+    Reemplazar la tienda leída (InvoiceRecord o dict) por la del maestro y ajustar su confianza.
+    Una tienda que no está en el maestro baja la confianza para que no se guarde sin revisión.
+    Sin maestro (o vacío) no cambia nada.
+    """
+    if store_index is None or not len(store_index):
+        return None
+    codigo_tienda, tienda_nombre = record.get('codigo_tienda'), record.get('tienda_nombre')
+    match = store_index.resolve(codigo_tienda, tienda_nombre)
+    confidence = record.get('confidence')
+    if match is None:
+        if confidence:
+            for field in ('codigo_tienda', 'tienda_nombre'):
+                if field in confidence:
+                    confidence[field] = round(confidence[field] * 0.5, 2)
+        logger.warning(f"⚠️ Tienda fuera del maestro: {codigo_tienda} {tienda_nombre}")
+        return None
+    if (match.codigo_tienda, match.tienda_nombre) != (codigo_tienda, tienda_nombre):
+        logger.info(f"Tienda normalizada ({match.method}): {codigo_tienda} {tienda_nombre} "
+                    f"-> {match.codigo_tienda} {match.tienda_nombre}")
+    record['codigo_tienda'] = match.codigo_tienda
+    record['tienda_nombre'] = match.tienda_nombre
+    if confidence is not None:
+        confidence['codigo_tienda'] = confidence['tienda_nombre'] = match.score
+    return match
+
+
+def load_store_file(path: str) -> List[Tuple[str, str]]:
+    """
+    Leer el maestro de un archivo local: CSV con columnas codigo_tienda y tienda_nombre,
+    o JSON/JSONL con objetos con esas claves.
+    """
+    if path.endswith('.csv'):
+        with open(path, newline='', encoding='utf-8-sig') as f:
+            return [(row.get('codigo_tienda'), row.get('tienda_nombre')) for row in csv.DictReader(f)]
+    with open(path, 'rb') as f:
+        content = f.read()
+    if path.endswith('.jsonl'):
+        items = [fast_json.loads(line) for line in content.splitlines() if line.strip()]
+    else:
+        items = fast_json.loads(content)
+    return [(item.get('codigo_tienda'), item.get('tienda_nombre')) for item in items]
+
+
+def bigquery_store_loader(client, table_id: str) -> Callable[[], List[Tuple[str, str]]]:
+    """Loader que lee codigo_tienda y tienda_nombre de una tabla de BigQuery"""
+    def load() -> List[Tuple[str, str]]:
+        job = client.query(f"SELECT codigo_tienda, tienda_nombre FROM `{table_id}`")
+        return [(row['codigo_tienda'], row['tienda_nombre']) for row in job.result(page_size=10_000)]
+    return load
+
+
+def load_store_master(path: Optional[str] = None, table_id: Optional[str] = None,
+                      client=None) -> Optional[List[Tuple[str, str]]]:
+    """
+    Leer el maestro completo de una vez (herramientas de línea de comandos): del archivo si se
+    indica, si no de la tabla de BigQuery. Retorna None si no se indicó ninguno.
+    """
+    if path:
+        return load_store_file(path)
+    if table_id:
+        if client is None:
+            from google.cloud import bigquery
+            client = bigquery.Client()
+        return bigquery_store_loader(client, table_id)()
+    return None
@@ -0,0 +1,154 @@
+"""StorageWriteSink contra un stream de appends fake: offsets, reintentos y AlreadyExists"""
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("google.cloud.bigquery_storage_v1")
+from google.api_core import exceptions as api_exceptions  # noqa: E402
+
+from bigquery_sinks import StorageWriteSink  # noqa: E402
+
+
+class FakeResult:
+    def __init__(self, error=None):
+        self.error = error
+
+    def result(self):
+        if self.error is not None:
+            raise self.error
+
+
+class FakeBackend:
+    """
+    Streams COMMITTED en memoria. `faults` define qué pasa con cada append en orden:
+    None (se escribe), "fail" (error sin escribir) o "lost" (se escribe pero la respuesta se pierde).
+    """
+
+    def __init__(self, faults=()):
+        self.streams = {}
+        self.faults = list(faults)
+
+    def table_path(self, project_id, dataset_id, table_id):
+        return f"projects/{project_id}/datasets/{dataset_id}/tables/{table_id}"
+
+    def create_write_stream(self, parent, write_stream):
+        name = f"{parent}/streams/{len(self.streams)}"
+        self.streams[name] = []
+        return SimpleNamespace(name=name)
+
+    def append(self, stream_name, request):
+        fault = self.faults.pop(0) if self.faults else None
+        if fault == "fail":
+            return FakeResult(api_exceptions.ServiceUnavailable("conexión caída"))
+        rows = self.streams[stream_name]
+        if request.offset < len(rows):
+            return FakeResult(api_exceptions.AlreadyExists(f"offset {request.offset} ya escrito"))
+        if request.offset > len(rows):
+            return FakeResult(api_exceptions.OutOfRange(f"offset {request.offset} fuera de rango"))
+        rows.extend(request.proto_rows.rows.serialized_rows)
+        if fault == "lost":
+            return FakeResult(api_exceptions.DeadlineExceeded("respuesta perdida"))
+        return FakeResult()
+
+
+class FakeConnection:
+    def __init__(self, backend, stream_name):
+        self.backend = backend
+        self.stream_name = stream_name
+
+    def send(self, request):
+        return self.backend.append(self.stream_name, request)
+
+    def close(self):
+        pass
+
+
+class FakeStorageWriteSink(StorageWriteSink):
+    def _connect(self, request_template):
+        return FakeConnection(self.client, request_template.write_stream)
+
+
+def make_sink(backend, max_attempts=3):
+    return FakeStorageWriteSink("proj", "ds", "facturas", linger_seconds=0.0,
+                                max_attempts=max_attempts, client=backend)
+
+
+def row(id_check):
+    return {"id_check": id_check, "codigo_tienda": "015", "fecha": "2024-11-06",
+            "importe_total": 2690.0, "fecha_carga": "2024-11-06T12:31:00Z"}
+
+
+def written_ids(sink, serialized_rows):
+    return [sink.message_class.FromString(data).id_check for data in serialized_rows]
+
+
+@pytest.fixture
+def backend():
+    return FakeBackend()
+
+
+def test_batches_advance_the_offset_on_the_same_stream(backend):
+    sink = make_sink(backend)
+    try:
+        assert sink.insert_rows([row("a"), row("b")]) == []
+        assert sink.insert_rows([row("c")]) == []
+    finally:
+        sink.close()
+    assert len(backend.streams) == 1
+    [rows] = backend.streams.values()
+    assert written_ids(sink, rows) == ["a", "b", "c"]
+
+
+def test_retry_after_lost_response_does_not_duplicate(backend):
+    backend.faults = ["lost"]
+    sink = make_sink(backend)
+    try:
+        assert sink.insert_rows([row("a")]) == []
+        assert sink.insert_rows([row("b")]) == []
+    finally:
+        sink.close()
+    [rows] = backend.streams.values()
+    assert written_ids(sink, rows) == ["a", "b"]
+
+
+def test_exhausted_retries_do_not_hide_the_next_batch(backend):
+    # El último intento se escribe pero su respuesta se pierde: el batch se informa como fallido
+    # y el siguiente no puede darse por escrito con el AlreadyExists de ese offset
+    backend.faults = ["fail", "lost"]
+    sink = make_sink(backend, max_attempts=2)
+    try:
+        errors = sink.insert_rows([row("a")])
+        assert len(errors) == 1 and errors[0]["index"] == 0
+        assert sink.insert_rows([row("b")]) == []
+    finally:
+        sink.close()
+    all_ids = [i for rows in backend.streams.values() for i in written_ids(sink, rows)]
+    assert "b" in all_ids
+    assert len(backend.streams) == 2
+
+
+def test_stale_offset_opens_a_new_stream(backend):
+    sink = make_sink(backend)
+    try:
+        assert sink.insert_rows([row("a")]) == []
+        # Otro escritor ocupa el offset que el sink iba a usar
+        [stream_name] = backend.streams
+        backend.streams[stream_name].append(b"")
+        assert sink.insert_rows([row("b")]) == []
+    finally:
+        sink.close()
+    assert len(backend.streams) == 2
+    first, second = backend.streams.values()
+    assert written_ids(sink, first)[0] == "a"
+    assert written_ids(sink, second) == ["b"]
+
+
+def test_unencodable_row_fails_alone(backend):
+    sink = make_sink(backend)
+    try:
+        errors = sink.insert_rows([row("a"), {"id_check": "x", "fecha": "no-es-fecha"}, row("c")])
+    finally:
+        sink.close()
+    assert [e["index"] for e in errors] == [1]
+    [rows] = backend.streams.values()
+    assert written_ids(sink, rows) == ["a", "c"]
@@ -0,0 +1,168 @@
+"""Exportación en streaming (invoice_export) contra la fuente fake en memoria"""
+import csv
+import io
+import threading
+import time
+
+import pytest
+
+pa = pytest.importorskip("pyarrow")
+import pyarrow.parquet as pq  # noqa: E402
+
+from invoice_archive import rows_to_table  # noqa: E402
+from invoice_export import (  # noqa: E402
+    EXPORT_COLUMNS, ExportError, ExportFilters, ExportSession, MemoryReadSource, export_invoices,
+)
+
+
+def make_row(i, anio=2024, mes=11, codigo_tienda="015"):
+    return {
+        "id_caja": "3", "canal": "salon", "codigo_tienda": codigo_tienda, "tienda_nombre": "SAN MARTIN",
+        "fecha": f"{anio}-{mes:02d}-06", "hora": "12:30:00", "ticket_electronico": "74598230012345",
+        "id_boleta": str(100000 + i), "id_check": f"chk-{i}", "monto_op_gravada": 2690.0,
+        "importe_total": 2690.0, "recargo_consumo": 0.0, "monto_tarifario": 2690.0, "mes": mes, "anio": anio,
+        "momento": f"{anio}-{mes:02d}-06T12:30:00", "a_c": "12", "fecha_carga": "2024-11-06T12:31:00Z",
+        "usuario_carga": "finanzas@example.com",
+    }
+
+
+ROWS = (
+    [make_row(i) for i in range(25)]
+    + [make_row(100 + i, codigo_tienda="040") for i in range(5)]
+    + [make_row(200 + i, mes=10) for i in range(5)]
+    + [make_row(300 + i, anio=2023) for i in range(5)]
+)
+
+
+def source(rows=ROWS):
+    # Batches chicos para que la salida se arme con varios streams y varios batches
+    return MemoryReadSource(lambda: rows, batch_size=4)
+
+
+def export(fmt, filters=ExportFilters(), rows=ROWS):
+    return b"".join(export_invoices(source(rows), filters, fmt, max_streams=3))
+
+
+def read_csv(data):
+    return list(csv.reader(io.StringIO(data.decode("utf-8"))))
+
+
+def test_filters_by_anio_mes_and_codigo_tienda():
+    data = export("csv", ExportFilters(anio=2024, mes=11, codigo_tienda="015"))
+    rows = read_csv(data)[1:]
+    id_check = list(EXPORT_COLUMNS).index("id_check")
+    assert sorted(row[id_check] for row in rows) == sorted(f"chk-{i}" for i in range(25))
+
+    assert len(read_csv(export("csv", ExportFilters(anio=2024)))) - 1 == 35
+    assert len(read_csv(export("csv", ExportFilters(codigo_tienda="040")))) - 1 == 5
+
+
+def test_csv_header_and_row_content():
+    rows = read_csv(export("csv", ExportFilters(anio=2023)))
+    assert rows[0] == list(EXPORT_COLUMNS)
+    assert len(rows) == 6
+    record = dict(zip(rows[0], min(rows[1:], key=lambda row: row[rows[0].index("id_check")])))
+    assert record["id_check"] == "chk-300"
+    assert record["codigo_tienda"] == "015"
+    assert record["fecha"] == "2023-11-06"
+    assert record["hora"] == "12:30:00"
+    assert float(record["importe_total"]) == 2690.0
+    assert record["anio"] == "2023"
+
+
+def test_parquet_reads_back():
+    table = pq.read_table(pa.BufferReader(export("parquet", ExportFilters(anio=2024, mes=11))))
+    assert table.column_names == list(EXPORT_COLUMNS)
+    assert table.num_rows == 30
+    assert table.schema == rows_to_table([]).select(list(EXPORT_COLUMNS)).schema
+    assert sorted(table["codigo_tienda"].to_pylist()).count("040") == 5
+
+
+def test_empty_result_has_schema_only():
+    rows = read_csv(export("csv", ExportFilters(anio=2030)))
+    assert rows == [list(EXPORT_COLUMNS)]
+
+    table = pq.read_table(pa.BufferReader(export("parquet", ExportFilters(anio=2030))))
+    assert table.num_rows == 0
+    assert table.column_names == list(EXPORT_COLUMNS)
+
+    assert read_csv(export("csv", rows=[])) == [list(EXPORT_COLUMNS)]
+
+
+@pytest.mark.parametrize("fmt, filters", [
+    ("xml", ExportFilters()),
+    ("csv", ExportFilters(codigo_tienda='015" OR TRUE OR "')),
+    ("csv", ExportFilters(mes=13)),
+])
+def test_invalid_parameters(fmt, filters):
+    with pytest.raises(ExportError):
+        export_invoices(source(), filters, fmt)
+
+
+class EndlessSource(MemoryReadSource):
+    """Streams que no terminan nunca (simula una exportación enorme)"""
+
+    def open(self, filters, max_streams):
+        table = rows_to_table(ROWS[:4]).select(list(EXPORT_COLUMNS))
+        batch = table.to_batches()[0]
+
+        def read():
+            while True:
+                yield batch
+
+        return ExportSession(table.schema, [read] * max_streams)
+
+
+def export_threads():
+    return [thread for thread in threading.enumerate() if thread.name.startswith("export-stream-")]
+
+
+def test_close_stops_reader_threads():
+    stream = export_invoices(EndlessSource(lambda: []), ExportFilters(), "csv", max_streams=3, prefetch=2)
+    assert next(stream)
+    assert len(export_threads()) == 3
+    stream.close()
+    deadline = time.monotonic() + 5
+    while export_threads() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert export_threads() == []
+
+
+@pytest.fixture(scope="module")
+def client(tmp_path_factory):
+    from fastapi.testclient import TestClient
+
+    with pytest.MonkeyPatch.context() as mp:
+        for name in ("JOBS_DIR", "INVOICE_ARCHIVE_DIR", "PROFILE_DIR"):
+            mp.setenv(name, str(tmp_path_factory.mktemp(name.lower())))
+        mp.setenv("INVOICE_ROLLUPS_PATH", str(tmp_path_factory.mktemp("rollups") / "rollups.json"))
+        mp.setenv("BIGQUERY_SINK", "memory")
+        mp.setenv("EXPORT_SOURCE", "memory")
+        import app
+
+        app.app.dependency_overrides[app.verify_token] = lambda: "finanzas@example.com"
+        app.invoice_sink.rows[:] = [dict(row) for row in ROWS]
+        try:
+            with TestClient(app.app) as test_client:
+                yield test_client
+        finally:
+            app.app.dependency_overrides.clear()
+            app.invoice_sink.rows.clear()
+
+
+def test_endpoint_streams_file(client):
+    response = client.get("/api/export", params={"anio": 2024, "mes": 11, "codigo_tienda": "040"})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/csv")
+    assert 'filename="facturas_2024_11_040.csv"' in response.headers["content-disposition"]
+    assert len(read_csv(response.content)) == 6
+
+
+@pytest.mark.parametrize("params", [
+    {"format": "xml"},
+    {"codigo_tienda": "015\" OR TRUE OR \""},
+    {"mes": 0},
+])
+def test_endpoint_rejects_invalid_parameters(client, params):
+    response = client.get("/api/export", params=params)
+    assert response.status_code == 400
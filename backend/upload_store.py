@@ -0,0 +1,246 @@
+"""
+Subidas reanudables por partes (protocolo al estilo tus).
+El cliente crea la subida con el tamaño total, envía bloques con su offset y, si la conexión
+se corta, consulta el offset confirmado y retoma desde ahí. Los bloques se escriben en un
+directorio spool; el offset confirmado es el tamaño del archivo en disco, así sobrevive
+reinicios del servidor. Al finalizar se verifica el sha256 del archivo completo.
+"""
+import base64
+import hashlib
+import logging
+import os
+import threading
+import time
+import uuid
+from typing import Callable, Dict, Optional
+
+import fast_json
+
+logger = logging.getLogger(__name__)
+
+
+class UploadError(Exception):
+    """Error de una subida con código HTTP asociado"""
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+def parse_upload_checksum(header: Optional[str]) -> Optional[bytes]:
+    """Header Upload-Checksum de tus ("sha256 <base64>") -> digest; None si no se envió"""
+    if not header:
+        return None
+    algorithm, _, value = header.strip().partition(' ')
+    if algorithm.lower() != 'sha256':
+        raise UploadError(400, "Upload-Checksum solo admite sha256")
+    try:
+        return base64.b64decode(value.strip(), validate=True)
+    except ValueError:
+        raise UploadError(400, "Upload-Checksum con base64 inválido")
+
+
+class UploadStore:
+    """Subidas en curso: metadatos en JSON y datos en un archivo .part por subida"""
+
+    def __init__(self, directory: str, ttl_seconds: int, max_size: int, gc_interval: int = 300):
+        self.directory = directory
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+        self.gc_interval = gc_interval
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._upload_locks: Dict[str, threading.Lock] = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _meta_path(self, upload_id: str) -> str:
+        return os.path.join(self.directory, f"{upload_id}.json")
+
+    def data_path(self, upload_id: str) -> str:
+        return os.path.join(self.directory, f"{upload_id}.part")
+
+    def _upload_lock(self, upload_id: str) -> threading.Lock:
+        with self._lock:
+            return self._upload_locks.setdefault(upload_id, threading.Lock())
+
+    def _write_meta(self, meta: Dict):
+        tmp_path = self._meta_path(meta["upload_id"]) + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(fast_json.dumps(meta))
+        os.replace(tmp_path, self._meta_path(meta["upload_id"]))
+
+    def _read_meta(self, upload_id: str) -> Dict:
+        # upload_id viene de la URL: solo se aceptan UUIDs para no salir del directorio
+        try:
+            uuid.UUID(upload_id)
+        except ValueError:
+            raise UploadError(404, "Subida no encontrada o expirada")
+        try:
+            with open(self._meta_path(upload_id), 'rb') as f:
+                meta = fast_json.loads(f.read())
+        except FileNotFoundError:
+            raise UploadError(404, "Subida no encontrada o expirada")
+        if meta["expires_at"] < time.time():
+            raise UploadError(404, "Subida no encontrada o expirada")
+        return meta
+
+    def _offset(self, upload_id: str) -> int:
+        try:
+            return os.path.getsize(self.data_path(upload_id))
+        except FileNotFoundError:
+            return 0
+
+    def _public(self, meta: Dict) -> Dict:
+        return {
+            "upload_id": meta["upload_id"],
+            "filename": meta["filename"],
+            "content_type": meta["content_type"],
+            "length": meta["length"],
+            # Finalizada: los datos ya se movieron al job
+            "offset": meta["length"] if meta.get("job_id") else self._offset(meta["upload_id"]),
+            "job_id": meta.get("job_id"),
+            "expires_at": meta["expires_at"],
+        }
+
+    def create(self, email: str, filename: str, content_type: str, length: int,
+               sha256: Optional[str] = None, callback_url: Optional[str] = None,
+               options: Optional[Dict] = None) -> Dict:
+        """
+        Registrar una subida nueva con su tamaño total (y opcionalmente el sha256 esperado).
+        options son las opciones de procesamiento que se pasan al job al finalizar.
+        """
+        if length <= 0:
+            raise UploadError(400, "length debe ser mayor a 0")
+        if length > self.max_size:
+            raise UploadError(413, f"El archivo supera el máximo de {self.max_size} bytes")
+        now = time.time()
+        meta = {
+            "upload_id": str(uuid.uuid4()),
+            "email": email,
+            "filename": filename,
+            "content_type": content_type,
+            "length": length,
+            "sha256": sha256.lower() if sha256 else None,
+            "callback_url": callback_url,
+            "options": options,
+            "job_id": None,
+            "created_at": now,
+            "expires_at": now + self.ttl_seconds,
+        }
+        open(self.data_path(meta["upload_id"]), 'wb').close()
+        self._write_meta(meta)
+        return self._public(meta)
+
+    def get(self, upload_id: str, email: str) -> Dict:
+        return self._public(self._owned(upload_id, email))
+
+    def _owned(self, upload_id: str, email: Optional[str]) -> Dict:
+        meta = self._read_meta(upload_id)
+        if email is not None and meta["email"] != email:
+            raise UploadError(404, "Subida no encontrada o expirada")
+        return meta
+
+    def append(self, upload_id: str, email: Optional[str], offset: int, data: bytes,
+               checksum: Optional[bytes] = None) -> int:
+        """
+        Escribir un bloque en la posición offset. Retorna el nuevo offset confirmado.
+        Si el offset no coincide con lo ya recibido responde 409 para que el cliente lo consulte.
+        """
+        if checksum is not None and hashlib.sha256(data).digest() != checksum:
+            # Código 460 de tus: el bloque llegó corrupto y se descarta completo
+            raise UploadError(460, "El checksum del bloque no coincide")
+        with self._upload_lock(upload_id):
+            meta = self._owned(upload_id, email)
+            if meta.get("job_id"):
+                raise UploadError(409, "La subida ya fue finalizada")
+            current = self._offset(upload_id)
+            if offset != current:
+                raise UploadError(409, f"Offset {offset} no coincide con el recibido ({current})")
+            if current + len(data) > meta["length"]:
+                raise UploadError(413, "El bloque excede el tamaño declarado de la subida")
+            with open(self.data_path(upload_id), 'ab') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            return current + len(data)
+
+    def finalize(self, upload_id: str, email: Optional[str], create_job: Callable[[Dict, str], str],
+                 sha256: Optional[str] = None) -> Dict:
+        """
+        Verificar que la subida esté completa y que su sha256 coincida, y crear el job con
+        create_job(meta, ruta_del_archivo) -> job_id. Es idempotente: repetir el finalize
+        (ej. porque se perdió la respuesta) retorna el mismo job sin crear otro.
+        """
+        with self._upload_lock(upload_id):
+            meta = self._owned(upload_id, email)
+            if meta.get("job_id"):
+                return self._public(meta)
+            received = self._offset(upload_id)
+            if received != meta["length"]:
+                raise UploadError(409, f"Subida incompleta: {received} de {meta['length']} bytes")
+            expected = (sha256 or meta.get("sha256") or "").lower()
+            if expected:
+                digest = hashlib.sha256()
+                with open(self.data_path(upload_id), 'rb') as f:
+                    for block in iter(lambda: f.read(1024 * 1024), b''):
+                        digest.update(block)
+                if digest.hexdigest() != expected:
+                    # Datos corruptos: se descarta lo recibido para que el cliente reinicie
+                    open(self.data_path(upload_id), 'wb').close()
+                    raise UploadError(460, "El sha256 del archivo no coincide; la subida se reinició")
+            meta["job_id"] = create_job(meta, self.data_path(upload_id))
+            self._write_meta(meta)
+            return self._public(meta)
+
+    def delete(self, upload_id: str, email: Optional[str]):
+        with self._upload_lock(upload_id):
+            self._owned(upload_id, email)
+            self._remove(upload_id)
+
+    def _remove(self, upload_id: str):
+        for path in (self.data_path(upload_id), self._meta_path(upload_id)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        with self._lock:
+            self._upload_locks.pop(upload_id, None)
+
+    def purge_expired(self) -> int:
+        """Eliminar subidas expiradas (abandonadas o ya finalizadas). Retorna la cantidad eliminada."""
+        now = time.time()
+        removed = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            upload_id = name[:-len('.json')]
+            try:
+                with open(self._meta_path(upload_id), 'rb') as f:
+                    expires_at = fast_json.loads(f.read())["expires_at"]
+            except (OSError, ValueError, KeyError):
+                continue
+            if expires_at < now:
+                self._remove(upload_id)
+                removed += 1
+        return removed
+
+    def start(self):
+        """Iniciar el hilo que elimina subidas expiradas"""
+        self._thread = threading.Thread(target=self._gc_loop, name="upload-gc", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+
+    def _gc_loop(self):
+        while not self._stop.wait(self.gc_interval):
+            try:
+                removed = self.purge_expired()
+                if removed:
+                    logger.info(f"🧹 Eliminadas {removed} subidas expiradas")
+            except Exception as e:
+                logger.warning(f"⚠️ Error al eliminar subidas expiradas: {e}")
@@ -1,4 +1,5 @@
 import axios from 'axios'
+import { attachAuthInterceptors } from './auth'
 
 const API_BASE_URL = import.meta.env.VITE_API_URL || 'http://localhost:8000'
 
@@ -9,14 +10,8 @@ const api = axios.create({
   },
 })
 
-// Interceptor para agregar el token de autenticación a todas las peticiones
-api.interceptors.request.use((config) => {
-  const token = localStorage.getItem('google_token')
-  if (token) {
-    config.headers.Authorization = `Bearer ${token}`
-  }
-  return config
-})
+// Interceptores para agregar el token de autenticación y renovar la sesión si expira
+attachAuthInterceptors(api)
 
 export interface UserListResponse {
   superadmins: string[]
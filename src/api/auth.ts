@@ -0,0 +1,45 @@
+import axios, { AxiosInstance } from 'axios'
+
+const API_BASE_URL = import.meta.env.VITE_API_URL || 'http://localhost:8000'
+
+// Token a enviar al backend: el token de sesión propio (se valida sin llamar a Google)
+// o, si no existe, el token de Google
+export const getAuthToken = (): string | null =>
+  localStorage.getItem('session_token') || localStorage.getItem('google_token')
+
+// Renovar el token de sesión usando el token de Google guardado
+export const refreshSessionToken = async (): Promise<string | null> => {
+  const googleToken = localStorage.getItem('google_token')
+  if (!googleToken) return null
+  const response = await axios.post(`${API_BASE_URL}/api/verify-token`, { token: googleToken })
+  if (response.data.valid && response.data.authorized && response.data.session_token) {
+    localStorage.setItem('session_token', response.data.session_token)
+    return response.data.session_token
+  }
+  localStorage.removeItem('session_token')
+  return null
+}
+
+// Agregar el token a cada petición y reintentar una vez con un token de sesión renovado si expira
+export const attachAuthInterceptors = (api: AxiosInstance) => {
+  api.interceptors.request.use((config) => {
+    const token = getAuthToken()
+    if (token) {
+      config.headers.Authorization = `Bearer ${token}`
+    }
+    return config
+  })
+
+  api.interceptors.response.use(undefined, async (error) => {
+    const config = error.config
+    if (error.response?.status === 401 && config && !config._sessionRetry && localStorage.getItem('session_token')) {
+      config._sessionRetry = true
+      const token = await refreshSessionToken().catch(() => null)
+      if (token) {
+        config.headers.Authorization = `Bearer ${token}`
+        return api.request(config)
+      }
+    }
+    return Promise.reject(error)
+  })
+}
@@ -1,4 +1,5 @@
 import axios from 'axios'
+import { attachAuthInterceptors } from './auth'
 import { MappedInvoiceData, ValidatedInvoiceData } from '../types'
 
 const API_BASE_URL = import.meta.env.VITE_API_URL || 'http://localhost:8000'
@@ -10,34 +11,193 @@ const api = axios.create({
   },
 })
 
-// Interceptor para agregar el token de autenticación a todas las peticiones
-api.interceptors.request.use((config) => {
-  const token = localStorage.getItem('google_token')
-  if (token) {
-    config.headers.Authorization = `Bearer ${token}`
-  }
-  return config
-})
+// Interceptores para agregar el token de autenticación y renovar la sesión si expira
+attachAuthInterceptors(api)
 
 export const processInvoice = async (file: File): Promise<MappedInvoiceData> => {
   const formData = new FormData()
   formData.append('invoice_image', file)
 
-  const token = localStorage.getItem('google_token')
-  const headers: Record<string, string> = {
-    'Content-Type': 'multipart/form-data',
+  const response = await api.post<MappedInvoiceData>('/api/process-invoice', formData, {
+    headers: {
+      'Content-Type': 'multipart/form-data',
+    },
+  })
+
+  return response.data
+}
+
+// --- Subida reanudable por partes ---
+// La imagen se envía en bloques (PATCH con Upload-Offset). Si la conexión se corta se consulta
+// el offset confirmado y se sigue desde ahí: un corte cuesta un bloque, no la imagen completa.
+// El id de la subida se guarda en localStorage para poder retomarla incluso tras recargar la página.
+
+interface UploadState {
+  upload_id: string
+  offset: number
+  length: number
+  job_id: string | null
+  chunk_size?: number
+}
+
+interface InvoiceJob {
+  job_id: string
+  status: 'queued' | 'running' | 'done' | 'failed'
+  result: MappedInvoiceData | null
+  error: { status_code: number; detail: string } | null
+}
+
+const UPLOADS_STORAGE_KEY = 'resumable_uploads'
+const MAX_RETRIES = 6
+const JOB_WAIT_SECONDS = 25
+
+const sleep = (ms: number) => new Promise((resolve) => setTimeout(resolve, ms))
+
+const uploadKey = (file: File) => `${file.name}:${file.size}:${file.lastModified}`
+
+const savedUploads = (): Record<string, { upload_id: string; chunk_size: number }> => {
+  try {
+    return JSON.parse(localStorage.getItem(UPLOADS_STORAGE_KEY) || '{}')
+  } catch {
+    return {}
   }
-  if (token) {
-    headers.Authorization = `Bearer ${token}`
+}
+
+const rememberUpload = (file: File, uploadId: string, chunkSize: number) => {
+  const uploads = savedUploads()
+  uploads[uploadKey(file)] = { upload_id: uploadId, chunk_size: chunkSize }
+  localStorage.setItem(UPLOADS_STORAGE_KEY, JSON.stringify(uploads))
+}
+
+const forgetUpload = (file: File) => {
+  const uploads = savedUploads()
+  delete uploads[uploadKey(file)]
+  localStorage.setItem(UPLOADS_STORAGE_KEY, JSON.stringify(uploads))
+}
+
+const toBase64 = (buffer: ArrayBuffer) => btoa(String.fromCharCode(...new Uint8Array(buffer)))
+
+const toHex = (buffer: ArrayBuffer) =>
+  Array.from(new Uint8Array(buffer)).map((b) => b.toString(16).padStart(2, '0')).join('')
+
+// crypto.subtle solo existe en contextos seguros (https o localhost): sin él se omite la verificación
+const sha256 = async (data: ArrayBuffer): Promise<ArrayBuffer | null> =>
+  window.crypto?.subtle ? window.crypto.subtle.digest('SHA-256', data) : null
+
+// Errores de red o 5xx: se reintenta con backoff exponencial. Los 4xx se propagan.
+const isRetryable = (error: any) => !error.response || error.response.status >= 500
+
+const withRetries = async <T>(fn: () => Promise<T>): Promise<T> => {
+  for (let attempt = 0; ; attempt++) {
+    try {
+      return await fn()
+    } catch (error: any) {
+      if (!isRetryable(error) || attempt >= MAX_RETRIES) throw error
+      await sleep(Math.min(1000 * 2 ** attempt, 15000))
+    }
   }
+}
 
-  const response = await api.post<MappedInvoiceData>('/api/process-invoice', formData, {
-    headers,
-  })
+export interface ProcessOptions {
+  autoCommit?: boolean // Guardar en BigQuery si todos los campos superan su umbral de confianza
+  canal?: string
+}
 
+const openUpload = async (
+  file: File,
+  fileHash: string | null,
+  options: ProcessOptions
+): Promise<UploadState & { chunk_size: number }> => {
+  const saved = savedUploads()[uploadKey(file)]
+  if (saved) {
+    try {
+      const response = await withRetries(() => api.get<UploadState>(`/api/uploads/${saved.upload_id}`))
+      return { ...response.data, chunk_size: saved.chunk_size }
+    } catch (error: any) {
+      if (error.response?.status !== 404) throw error
+      forgetUpload(file) // Expiró o fue eliminada: se crea una nueva
+    }
+  }
+  const response = await withRetries(() =>
+    api.post<UploadState & { chunk_size: number }>('/api/uploads', {
+      filename: file.name,
+      content_type: file.type,
+      length: file.size,
+      sha256: fileHash,
+      auto_commit: options.autoCommit ?? false,
+      canal: options.canal ?? null,
+    })
+  )
+  rememberUpload(file, response.data.upload_id, response.data.chunk_size)
   return response.data
 }
 
+const waitForJob = async (jobId: string): Promise<MappedInvoiceData> => {
+  for (;;) {
+    const response = await withRetries(() => api.get<InvoiceJob>(`/api/jobs/${jobId}`, { params: { wait: JOB_WAIT_SECONDS } }))
+    const job = response.data
+    if (job.status === 'done' && job.result) return job.result
+    if (job.status === 'failed') {
+      // Misma forma que un error de axios para que los componentes muestren el detalle
+      const error: any = new Error(job.error?.detail || 'Error al procesar la factura')
+      error.response = { status: job.error?.status_code, data: { detail: job.error?.detail } }
+      throw error
+    }
+  }
+}
+
+export const processInvoiceResumable = async (
+  file: File,
+  onProgress?: (sent: number, total: number) => void,
+  options: ProcessOptions = {}
+): Promise<MappedInvoiceData> => {
+  const buffer = await file.arrayBuffer()
+  const digest = await sha256(buffer)
+  const fileHash = digest ? toHex(digest) : null
+  const upload = await openUpload(file, fileHash, options)
+
+  let jobId = upload.job_id
+  if (!jobId) {
+    let offset = upload.offset
+    let failures = 0
+    onProgress?.(offset, file.size)
+    while (offset < file.size) {
+      const chunk = buffer.slice(offset, offset + upload.chunk_size)
+      const headers: Record<string, string> = {
+        'Content-Type': 'application/offset+octet-stream',
+        'Upload-Offset': String(offset),
+      }
+      const chunkDigest = await sha256(chunk)
+      if (chunkDigest) headers['Upload-Checksum'] = `sha256 ${toBase64(chunkDigest)}`
+      try {
+        const response = await api.patch(`/api/uploads/${upload.upload_id}`, chunk, { headers })
+        offset = Number(response.headers['upload-offset'])
+        failures = 0
+        onProgress?.(offset, file.size)
+      } catch (error: any) {
+        // 409 (offset desfasado) y 460 (bloque corrupto) se resuelven consultando el offset confirmado
+        const status = error.response?.status
+        if (!isRetryable(error) && status !== 409 && status !== 460) throw error
+        if (++failures > MAX_RETRIES) throw error
+        await sleep(Math.min(1000 * 2 ** (failures - 1), 15000))
+        const head = await withRetries(() => api.head(`/api/uploads/${upload.upload_id}`))
+        offset = Number(head.headers['upload-offset'])
+      }
+    }
+    try {
+      const response = await withRetries(() =>
+        api.post<{ job_id: string }>(`/api/uploads/${upload.upload_id}/finalize`, { sha256: fileHash })
+      )
+      jobId = response.data.job_id
+    } catch (error: any) {
+      if (error.response?.status === 460) forgetUpload(file) // El servidor descartó los datos corruptos
+      throw error
+    }
+  }
+  forgetUpload(file)
+  return waitForJob(jobId)
+}
+
 export const saveInvoice = async (data: ValidatedInvoiceData): Promise<{ success: boolean; id_check: string; message: string }> => {
   const response = await api.post('/api/save-invoice', data)
   return response.data
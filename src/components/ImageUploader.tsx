@@ -1,5 +1,5 @@
 import { useRef, useState } from 'react'
-import { processInvoice, saveInvoice } from '../api/invoiceApi'
+import { processInvoiceResumable, saveInvoice } from '../api/invoiceApi'
 import { MappedInvoiceData, ValidatedInvoiceData } from '../types'
 import Modal from './Modal'
 
@@ -66,7 +66,13 @@ export default function ImageUploader({
 
     onProcessingStart()
     try {
-      const data = await processInvoice(selectedFile)
+      const data = await processInvoiceResumable(selectedFile)
+      if (data.near_duplicate) {
+        alert(`Atención: esta foto parece un duplicado de ${data.near_duplicate.filename}. Verifica antes de guardar.`)
+      }
+      if (data.incomplete) {
+        alert('La lectura del ticket quedó incompleta: completa los campos faltantes antes de guardar.')
+      }
       const imageUrl = URL.createObjectURL(selectedFile)
       onDataExtracted(data, imageUrl)
     } catch (error: any) {
@@ -111,7 +117,41 @@ export default function ImageUploader({
 
       try {
         // Procesar la imagen
-        const data = await processInvoice(file)
+        // Con confianza alta en todos los campos el backend la guarda en la misma llamada
+        const data = await processInvoiceResumable(file, undefined, { autoCommit: true })
+
+        // Foto casi idéntica a una reciente (aunque se haya reusado el resultado previo):
+        // siempre a revisión manual para no guardar dos veces el mismo ticket
+        if (data.near_duplicate) {
+          errorCount++
+          const errorMessage = `${file.name}: Posible foto duplicada de ${data.near_duplicate.filename}`
+          errorsList.push(errorMessage)
+          errorItems.push({ file, imageUrl: URL.createObjectURL(file), data, error: errorMessage })
+          continue
+        }
+
+        if (data.auto_commit?.committed) {
+          successCount++
+          continue
+        }
+
+        // Confianza baja en algún campo: revisión manual en el formulario
+        if (data.auto_commit?.reason === 'low_confidence') {
+          errorCount++
+          const errorMessage = `${file.name}: Revisar ${data.auto_commit.blocked_fields.join(', ')} (confianza baja)`
+          errorsList.push(errorMessage)
+          errorItems.push({ file, imageUrl: URL.createObjectURL(file), data, error: errorMessage })
+          continue
+        }
+
+        // Job reanudado tras un reinicio: pudo haberse guardado antes, no guardar de nuevo sin revisión
+        if (data.auto_commit?.reason === 'resumed') {
+          errorCount++
+          const errorMessage = `${file.name}: Procesamiento reanudado, verificar si ya fue guardada`
+          errorsList.push(errorMessage)
+          errorItems.push({ file, imageUrl: URL.createObjectURL(file), data, error: errorMessage })
+          continue
+        }
 
         // Validar campos requeridos
         if (!data.fecha || !data.canal) {
@@ -1,7 +1,8 @@
+import { GoogleLogin } from '@react-oauth/google'
 import { useAuth } from '../contexts/AuthContext'
 
 export default function Login() {
-  const { login } = useAuth()
+  const { login, loginWithIdToken } = useAuth()
 
   return (
     <div className="min-h-screen bg-black flex items-center justify-center">
@@ -23,6 +24,21 @@ export default function Login() {
         </div>
 
         <div className="space-y-4">
+          {/* Sign In With Google entrega un ID token que el backend valida localmente */}
+          <div className="flex justify-center">
+            <GoogleLogin
+              onSuccess={(credentialResponse) => {
+                if (credentialResponse.credential) {
+                  loginWithIdToken(credentialResponse.credential)
+                }
+              }}
+              onError={() => alert('Error al iniciar sesión con Google')}
+              width="384"
+              text="continue_with"
+            />
+          </div>
+
+          {/* Alternativa con access token (verificación vía userinfo de Google) */}
           <button
             onClick={login}
             className="w-full flex items-center justify-center gap-3 px-4 py-3 bg-white border-2 border-orange-500 rounded-lg hover:border-orange-400 hover:bg-gray-50 transition-colors shadow-lg"
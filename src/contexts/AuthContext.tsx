@@ -15,9 +15,23 @@ interface AuthContextType {
   isLoading: boolean
   isSuperadmin: boolean
   login: () => void
+  loginWithIdToken: (credential: string) => Promise<void>
   logout: () => void
 }
 
+// Decodificar el payload de un ID token de Google (JWT) para mostrar nombre y foto.
+// La firma la valida el backend; aquí solo se leen los datos de perfil.
+const decodeIdTokenPayload = (credential: string): Record<string, any> => {
+  const payload = credential.split('.')[1].replace(/-/g, '+').replace(/_/g, '/')
+  const json = decodeURIComponent(
+    atob(payload)
+      .split('')
+      .map((c) => '%' + ('00' + c.charCodeAt(0).toString(16)).slice(-2))
+      .join('')
+  )
+  return JSON.parse(json)
+}
+
 const AuthContext = createContext<AuthContextType | undefined>(undefined)
 
 export const useAuth = () => {
@@ -53,6 +67,9 @@ export const AuthProvider = ({ children }: AuthProviderProps) => {
             })
             
             if (response.data.valid && response.data.authorized) {
+              if (response.data.session_token) {
+                localStorage.setItem('session_token', response.data.session_token)
+              }
               const parsedUser = JSON.parse(userData)
               const userWithRole = {
                 ...parsedUser,
@@ -63,12 +80,14 @@ export const AuthProvider = ({ children }: AuthProviderProps) => {
             } else {
               // Token inválido o usuario no autorizado
               localStorage.removeItem('google_token')
+              localStorage.removeItem('session_token')
               localStorage.removeItem('user_data')
             }
           } catch (error) {
             // Error al verificar, limpiar datos
             console.error('Error al verificar token:', error)
             localStorage.removeItem('google_token')
+            localStorage.removeItem('session_token')
             localStorage.removeItem('user_data')
           }
         }
@@ -82,13 +101,61 @@ export const AuthProvider = ({ children }: AuthProviderProps) => {
     checkAuth()
   }, [])
 
+  // Verificar con el backend que el usuario está autorizado y guardar la sesión
+  const completeLogin = async (token: string, userData: { email: string; name: string; picture: string }) => {
+    // Guardar token temporalmente
+    localStorage.setItem('google_token', token)
+
+    try {
+      const API_URL = import.meta.env.VITE_API_URL || 'http://localhost:8000'
+      console.log('Enviando verificación al backend:', { email: userData.email })
+      const authResponse = await axios.post(`${API_URL}/api/verify-user`, {
+        email: userData.email,
+        token,
+      })
+      
+      console.log('Respuesta del backend:', authResponse.data)
+      
+      if (authResponse.data.authorized) {
+        // Token de sesión del backend: las llamadas a la API ya no requieren verificar con Google
+        if (authResponse.data.session_token) {
+          localStorage.setItem('session_token', authResponse.data.session_token)
+        }
+        const userWithRole = {
+          ...userData,
+          isSuperadmin: authResponse.data.is_superadmin || false
+        }
+        setUser(userWithRole)
+        setIsSuperadmin(authResponse.data.is_superadmin || false)
+        localStorage.setItem('user_data', JSON.stringify(userWithRole))
+      } else {
+        localStorage.removeItem('google_token')
+        alert(`❌ No tienes acceso a esta aplicación.\n\nEmail: ${userData.email}\n\nContacta al administrador para agregar tu email a la lista de usuarios autorizados.`)
+      }
+    } catch (error: any) {
+      console.error('Error durante el login:', error)
+      const errorMessage = error.response?.data?.detail || error.message || 'Error desconocido'
+      console.error('Mensaje de error del backend:', errorMessage)
+      localStorage.removeItem('google_token')
+      alert(`Error al iniciar sesión:\n\n${errorMessage}\n\nPor favor, verifica tu configuración o contacta al administrador.`)
+    }
+  }
+
+  // Login con ID token (Sign In With Google): el backend lo valida localmente sin llamar a Google
+  const loginWithIdToken = async (credential: string) => {
+    const claims = decodeIdTokenPayload(credential)
+    await completeLogin(credential, {
+      email: claims.email,
+      name: claims.name,
+      picture: claims.picture,
+    })
+  }
+
+  // Login con access token (flujo implícito): el backend lo valida con el endpoint userinfo
   const login = useGoogleLogin({
     flow: 'implicit',
     onSuccess: async (tokenResponse) => {
       try {
-        // Guardar token temporalmente
-        localStorage.setItem('google_token', tokenResponse.access_token)
-        
         // Obtener información del usuario de Google
         const userInfoResponse = await axios.get(
           'https://www.googleapis.com/oauth2/v2/userinfo',
@@ -99,40 +166,14 @@ export const AuthProvider = ({ children }: AuthProviderProps) => {
           }
         )
         
-        const userData = {
+        await completeLogin(tokenResponse.access_token, {
           email: userInfoResponse.data.email,
           name: userInfoResponse.data.name,
           picture: userInfoResponse.data.picture,
-        }
-        
-        // Verificar con el backend si el usuario está autorizado
-        const API_URL = import.meta.env.VITE_API_URL || 'http://localhost:8000'
-        console.log('Enviando verificación al backend:', { email: userData.email })
-        const authResponse = await axios.post(`${API_URL}/api/verify-user`, {
-          email: userData.email,
-          token: tokenResponse.access_token,
         })
-        
-        console.log('Respuesta del backend:', authResponse.data)
-        
-        if (authResponse.data.authorized) {
-          const userWithRole = {
-            ...userData,
-            isSuperadmin: authResponse.data.is_superadmin || false
-          }
-          setUser(userWithRole)
-          setIsSuperadmin(authResponse.data.is_superadmin || false)
-          localStorage.setItem('user_data', JSON.stringify(userWithRole))
-        } else {
-          localStorage.removeItem('google_token')
-          alert(`❌ No tienes acceso a esta aplicación.\n\nEmail: ${userData.email}\n\nContacta al administrador para agregar tu email a la lista de usuarios autorizados.`)
-        }
       } catch (error: any) {
         console.error('Error durante el login:', error)
-        const errorMessage = error.response?.data?.detail || error.message || 'Error desconocido'
-        console.error('Mensaje de error del backend:', errorMessage)
-        localStorage.removeItem('google_token')
-        alert(`Error al iniciar sesión:\n\n${errorMessage}\n\nPor favor, verifica tu configuración o contacta al administrador.`)
+        alert(`Error al iniciar sesión:\n\n${error.message || 'Error desconocido'}`)
       }
     },
     onError: (error: any) => {
@@ -157,6 +198,7 @@ export const AuthProvider = ({ children }: AuthProviderProps) => {
     setUser(null)
     setIsSuperadmin(false)
     localStorage.removeItem('google_token')
+    localStorage.removeItem('session_token')
     localStorage.removeItem('user_data')
   }
 
@@ -168,6 +210,7 @@ export const AuthProvider = ({ children }: AuthProviderProps) => {
         isLoading,
         isSuperadmin,
         login,
+        loginWithIdToken,
         logout,
       }}
     >
@@ -17,6 +17,25 @@ export interface MappedInvoiceData {
   momento: string | null
   a_c: string | null
   raw_extracted_text?: string // Texto crudo extraído por OCR
+  near_duplicate?: NearDuplicate // Presente si la foto es casi idéntica a una procesada recientemente
+  confidence?: Record<string, number> | null // Confianza por campo (0 a 1)
+  incomplete?: boolean // El parseo se cortó por tiempo y faltan campos
+  auto_commit?: AutoCommitResult // Presente si se pidió el guardado automático
+}
+
+export interface AutoCommitResult {
+  committed: boolean // true si la factura ya quedó guardada en BigQuery
+  reason: 'disabled' | 'near_duplicate' | 'incomplete' | 'low_confidence' | 'save_failed' | 'resumed' | null
+  blocked_fields: string[] // Campos que no alcanzaron su umbral de confianza
+  detail?: string
+}
+
+export interface NearDuplicate {
+  distance: number // Bits distintos del hash perceptual (0 = misma imagen)
+  age_seconds: number
+  id_check: string
+  filename: string
+  reused: boolean // true si se devolvió el resultado previo sin repetir el OCR
 }
 
 export interface ValidatedInvoiceData extends MappedInvoiceData {